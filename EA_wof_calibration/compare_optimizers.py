@@ -0,0 +1,89 @@
+"""
+Compares the calibration optimizers on the same plots, objective (absolute yield error) and worker pool:
+the GA of first_ea.py and the batch ask/tell optimizers of wof_tools/optimizers.py (CMA-ES, differential evolution,
+random search). Every method starts from the typical individual of the crop and gets the same evaluation budget.
+The report gives, per method, the evaluations needed to bring the error under target_error * realized yield.
+"""
+import numpy as np
+import pandas as pd
+import inspyred
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
+from wof_tools.wof_ea_interface import set_up_problem
+from wof_tools.scheduler import TaskScheduler
+from wof_tools.memo_store import configure_memo_store
+from wof_tools.optimizers import OPTIMIZERS, run_optimizer, compare_report
+from wof_tools.planner import SimulationPlan
+from wof_tools.preflight import preflight, print_preflight_report
+from wof_tools.sims_table import read_sims_table, unit_id
+from first_ea import one_plot_ea, pool_evaluator, init_typical_individual, space
+
+
+def ga_run(row, problem, pool, max_evaluations, target):
+    """
+    The GA of first_ea.py, its best fitness recorded after every generation.
+    Its evaluator counts the evaluations, so that the first candidate at or below the target is known exactly
+    (as in run_optimizer), not at the end of its generation.
+    """
+    trace = []
+    counts = {"n_evaluations": 0, "evaluations_to_target": None}
+
+    def counting_evaluator(candidates, args):
+        fitness = pool_evaluator(candidates, args)
+        if counts["evaluations_to_target"] is None:
+            reached = np.flatnonzero(np.asarray(fitness, dtype=float) <= target)
+            if len(reached) > 0:
+                counts["evaluations_to_target"] = counts["n_evaluations"] + int(reached[0]) + 1
+        counts["n_evaluations"] += len(candidates)
+        return fitness
+
+    def trace_observer(population, num_generations, num_evaluations, args):
+        trace.append((num_evaluations, min(individual.fitness for individual in population)))
+    candidate, fitness, n_evaluations = one_plot_ea(row, problem, pool, observer=trace_observer,
+                                                    max_evaluations=max_evaluations, return_evaluations=True,
+                                                    evaluator=counting_evaluator)
+    return {"best_x": np.asarray(candidate), "best_f": fitness, "n_evaluations": n_evaluations,
+            "evaluations_to_target": counts["evaluations_to_target"], "trace": trace}
+
+
+def compare_plot(row, problem, pool, methods, max_evaluations, target_error, seed=42):
+    target = target_error * row["RealizedYield"]
+    runs = []
+    for method in methods:
+        if method == "ga":
+            result = ga_run(row, problem, pool, max_evaluations, target)
+        else:
+            optimizer = OPTIMIZERS[method](space.num_vars, x0=init_typical_individual(row["crop"]), seed=seed)
+            result = run_optimizer(optimizer, lambda X: pool.evaluate(unit_id(row), space.decode(X)),
+                                   max_evaluations=max_evaluations, target=target)
+        runs.append({"plot_id": row["id"], "year": row["crop_end_date"].year, "crop": row["crop"], "method": method, "target": target,
+                     "best_f": result["best_f"], "n_evaluations": result["n_evaluations"],
+                     "evaluations_to_target": result["evaluations_to_target"],
+                     "best_candidate": space.decode(result["best_x"]).tolist()})
+    return runs
+
+
+if __name__ == "__main__":
+    problem = set_up_problem()
+    configure_memo_store("output/memo_store.sqlite") # Shared with the other experiments
+    sims_data = read_sims_table(limit=100)
+    simulations = sims_data.to_dict(orient="records")
+    simulations, quarantine = preflight(simulations, n_jobs=70, require=("RealizedYield",))
+    print_preflight_report(simulations, quarantine)
+    plan = SimulationPlan(simulations, extra_keys=("RealizedYield",))
+    methods = ["ga", "cmaes", "de", "random"]
+    max_evaluations = 1000
+    target_error = 0.02 # The target is an error of 2% of the realized yield
+    with TaskScheduler(plan.units, problem, n_workers=70, vectorized=True) as pool:
+        with ThreadPoolExecutor(max_workers=2*pool.n_workers) as executor:
+            runs = list(tqdm(executor.map(lambda row: compare_plot(row, problem, pool, methods, max_evaluations,
+                                                                   target_error),
+                                          plan.units),
+                             total=len(plan.units),
+                             desc="Comparing the optimizers..."))
+    runs_df = pd.DataFrame([run for plot_runs in runs for run in plot_runs])
+    runs_df.to_csv("output/optimizers_comparison.csv", index=False)
+    report = compare_report(runs_df.to_dict(orient="records"))
+    report.to_csv("output/optimizers_comparison_report.csv")
+    print(f"Evaluations to an error under {target_error:.0%} of the realized yield (budget {max_evaluations}):")
+    print(report.to_string(float_format=lambda x: f"{x:.2f}"))
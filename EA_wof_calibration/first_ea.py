@@ -1,33 +1,32 @@
 import math
+import shutil
+import numpy as np
 import pandas as pd
 import inspyred
 import random
-import pickle
-from joblib import Parallel, delayed
-from joblib_progress import joblib_progress
+from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor, Future
 import matplotlib.pyplot as plt # TODO: Dont forget to install show the final graph
-from wof_tools.wof_ea_interface import set_up_problem, WofostTranslator
-from wof_tools.wofost_exec import wof_one_simulation
-
-initial_values = {"wheat": {"TSUM1": 706, "TSUM2": 975},
-                  "barley": {"TSUM1": 800, "TSUM2": 750},
-                  "fababean": {"TSUM1": 833, "TSUM2": 1351},
-                  "maize": {"TSUM1": 600, "TSUM2": 1211},
-                  "sunflower": {"TSUM1": 1050, "TSUM2": 1000},
-                  "sorghum": {"TSUM1": 730, "TSUM2": 600},
-                  "rapeseed": {"TSUM1": 240, "TSUM2": 600},
-                  "miller": {"TSUM1": 772, "TSUM2": 483},
-                 }
-traductor = WofostTranslator()
+from wof_tools.wof_ea_interface import set_up_problem, ParameterSpace, CALIBRATED_PARAMETERS, compute_fitness
+from wof_tools.worker_pool import PlotAffinePool
+from wof_tools.scheduler import TaskScheduler
+from wof_tools.steady_state import SteadyStateEA
+from wof_tools.memo_store import configure_memo_store
+from wof_tools.checkpoint import CheckpointStore, dump_rng_state, load_rng_state
+from wof_tools.planner import SimulationPlan
+from wof_tools.preflight import preflight, print_preflight_report
+from wof_tools.sims_table import PLOTS_COORDS_PATH, read_sims_table, unit_id
+from wof_tools.instrumentation import configure_instrumentation, run_report, print_run_report
+from wof_tools.warm_start import WarmStartArchive
+
+space = ParameterSpace(CALIBRATED_PARAMETERS)
 
 def init_typical_individual(crop):
     """
     This function initializes a typical individual for a given crop.
     The individual is a dictionary with the crop name as the key and the initial values as the value.
     """
-    if crop not in initial_values:
-        raise ValueError(f"Crop {crop} not found in initial values.")
-    return traductor.wofost_to_genes(list(initial_values[crop].values()))
+    return space.encode(space.typical(crop)).tolist()
 
 def naive_generator(random, args):
     initial_values = args.get('initial_values')  # "seed" vector
@@ -37,61 +36,128 @@ def naive_generator(random, args):
     return [v + random.gauss(0, noise_std) for v in initial_values]
 
 
-def naive_parallel_evaluator(candidates, args):
+def pool_evaluator(candidates, args):
+    """
+    This function evaluates a whole population in one batch on the worker pool (TaskScheduler or PlotAffinePool).
+    The fitness is the absolute error between the simulated and the realized yield.
+    """
+    paramsets = space.decode(candidates) # The whole population at once
+    fitness = args["pool"].evaluate(unit_id(args["row"]), paramsets) # A vector containing the fitness for each individual in the population
+    return fitness.tolist()
+
+
+def pool_submitter(candidates, args):
     """
-    This function is the naive evaluator. It takes a candidate and returns a score.
-    The score is the mean squared error between the candidate and the target.
+    Asynchronous pool_evaluator for the steady-state EA: the candidates are submitted to the pool and
+    a future of their fitness is returned at once.
     """
-    def evaluate_one(candidate):
-            y_pred = wof_one_simulation(args["row"],
-                                        override_params_mode=True,
-                                        paramset=traductor.genes_to_wofost(candidate),
-                                        problem=args["problem"])
-            return abs(args["rdt"] - y_pred)
-    with joblib_progress(description ="Parallel process track..."):
-         fitness = Parallel(n_jobs=-1)(delayed(evaluate_one)(cand) for cand in candidates) # A vector containing the fitness for each individual in the population
+    fitness = Future()
+
+    def simulated(future):
+        if future.exception() is not None:
+            fitness.set_exception(future.exception())
+        else:
+            fitness.set_result(compute_fitness(args["rdt"], future.result()).tolist())
+    args["pool"].submit(unit_id(args["row"]), space.decode(candidates)).add_done_callback(simulated)
     return fitness
 
 
-def naive_sequential_evaluator(candidates, args):
+def surrogate_pool_evaluator(candidates, args):
     """
-    This function is the naive evaluator. It takes a candidate and returns a score.
-    The score is the mean squared error between the candidate and the target.
+    Same as pool_evaluator, but every evaluated candidate is also recorded to train the surrogate.
     """
-    fitness = []
-    for candidate in candidates:
-        y_pred = wof_one_simulation(params_row=args["row"],
-                                    override_params_mode=True,
-                                    paramset=traductor.genes_to_wofost(candidate),
-                                    problem=args["problem"])
-        mse = abs(args["rdt"] - y_pred)
-        fitness.append(mse)
+    fitness = pool_evaluator(candidates, args)
+    args["surrogate"].add(candidates, fitness)
     return fitness
 
 
-def one_plot_ea(row, problem):
+def surrogate_screening(random, candidates, args):
+    """
+    Last variator of the surrogate-assisted EA: only the offspring with the best predicted fitness
+    (a fraction screen_fraction of them) are kept and sent to WOFOST.
+    """
+    return args["surrogate"].screen(candidates, args.get("screen_fraction", 0.3))
+
+
+def checkpoint_observer(population, num_generations, num_evaluations, args):
+    """
+    Records the population of the plot and the state of the random generator in the checkpoint store
+    every checkpoint_every generations, so that an interrupted EA can be continued (see one_plot_ea).
+    """
+    if num_generations % args["checkpoint_every"] != 0:
+        return
+    args["checkpoint"].append("states", [{"plot_id": unit_id(args["row"]),
+                                          "num_generations": args["generation_offset"] + num_generations,
+                                          "num_evaluations": args["evaluation_offset"] + num_evaluations,
+                                          "candidates": [list(individual.candidate) for individual in population],
+                                          "fitness": [individual.fitness for individual in population],
+                                          "rng_state": dump_rng_state(args["_ec"]._random)}])
+
+
+def one_plot_ea(row, problem, pool, observer=inspyred.ec.observers.plot_observer,
+                max_evaluations=1000, surrogate=None, screen_fraction=0.3, return_evaluations=False,
+                checkpoint=None, checkpoint_every=1, resume_state=None, steady_state=False, max_in_flight=16,
+                batch_size=4, warm_start=None, evaluator=pool_evaluator):
     """
     This function performs the evolutionary algorithm for one plot using the WOFOST model ast the evaluation component.
     It takes a row of the dataframe as input and returns the best individual and its fitness.
+    With a surrogate (e.g. wof_tools.surrogate.RBFSurrogate) the offspring are pre-screened by the model
+    and only the most promising screen_fraction of each generation is simulated.
+    With a checkpoint store the population is saved every checkpoint_every generations. Given the last saved state
+    (resume_state), the EA restarts from that population and random state with the remaining evaluation budget.
+    The saved population is evaluated again, which costs nothing when the memo store is enabled.
+    With steady_state the EA is asynchronous (wof_tools/steady_state.py): max_in_flight candidates are always being
+    simulated, by batches of batch_size, and each completed evaluation goes through the replacer right away instead of
+    waiting for the slowest simulation of a generation. A "generation" (observers, checkpoints) is then pop_size
+    evaluations. Its small batches cost a whole population each with the batched engine, so it refuses a vectorized pool.
+    warm_start holds parameter sets to start from (e.g. WarmStartArchive.seeds): they are put in the initial population
+    and the rest of it is generated around the first one instead of the typical individual of the crop.
+    evaluator replaces pool_evaluator in the generational EA (without surrogate), e.g. to count the evaluations.
     """
+    if steady_state and pool.vectorized:
+        raise ValueError("The steady-state EA needs a pool running the pcse engine (vectorized=False).")
     random_number_generator = random.Random()
     random_number_generator.seed(42)
+    seeds = None
+    generation_offset = evaluation_offset = 0
+    center = init_typical_individual(row["crop"])
+    if resume_state is None and warm_start is not None and len(warm_start) > 0:
+        seeds = np.clip(space.encode(warm_start), 0.0, 1.0).tolist()
+        center = seeds[0]
+    if resume_state is not None:
+        seeds = [[float(gene) for gene in candidate] for candidate in resume_state["candidates"]]
+        load_rng_state(random_number_generator, resume_state["rng_state"])
+        generation_offset = int(resume_state["num_generations"])
+        evaluation_offset = int(resume_state["num_evaluations"]) - len(seeds)
 
-    evolutionary_algorithm = inspyred.ec.EvolutionaryComputation(random_number_generator)
+    if steady_state:
+        evolutionary_algorithm = SteadyStateEA(random_number_generator)
+    else:
+        evolutionary_algorithm = inspyred.ec.EvolutionaryComputation(random_number_generator)
     # and now, we specify every part of the evolutionary algorithm
-    evolutionary_algorithm.observer = inspyred.ec.observers.plot_observer
+    evolutionary_algorithm.observer = observer if checkpoint is None else [observer, checkpoint_observer]
     evolutionary_algorithm.selector = inspyred.ec.selectors.tournament_selection # by default, tournament selection has tau=2 (two individuals), but it can be modified (see below)
     evolutionary_algorithm.variator = [inspyred.ec.variators.uniform_crossover, inspyred.ec.variators.gaussian_mutation] # the genetic operators are put in a list, and executed one after the other
+    if surrogate is not None:
+        evolutionary_algorithm.variator.append(surrogate_screening)
     evolutionary_algorithm.replacer = inspyred.ec.replacers.plus_replacement # "plus" -> "mu+lambda"
     evolutionary_algorithm.terminator = inspyred.ec.terminators.evaluation_termination # the algorithm terminates when a given number of evaluations (see below) is reached
-    
+    if steady_state:
+        # The candidates go to the pool as soon as a worker is free, their fitness is recorded when they come back
+        if surrogate is not None:
+            evolutionary_algorithm.on_evaluated = lambda candidates, fitness, args: surrogate.add(candidates, fitness)
+        evaluation = {"submitter": pool_submitter, "max_in_flight": max_in_flight, "batch_size": batch_size}
+    else:
+        evaluation = {"evaluator": evaluator if surrogate is None else surrogate_pool_evaluator}
+
     final_population = evolutionary_algorithm.evolve(
         generator = naive_generator, # of course, we need to specify the generator
-        evaluator = naive_sequential_evaluator, # and the corresponding evaluator
+        seeds = seeds, # the saved population when resuming
+        **evaluation, # the evaluator, or the submitter of the steady-state EA
         pop_size = 100,# 100 # size of the population
         num_selected = 150, # 200 # size of the offspring (children individuals)
         maximize = False, # this is a minimization problem, but inspyred can also manage maximization problem
-        max_evaluations = 1000, # 2000? Don't sure maximum number of evaluations before stopping, used by the terminator
+        max_evaluations = max_evaluations - evaluation_offset, # 2000? Don't sure maximum number of evaluations before stopping, used by the terminator
         tournament_size = 2, # size of the tournament selection; we need to specify it only if we need it different from 2
         crossover_rate = 1.0, # probability of applying crossover
         mutation_rate = 0.3, # probability of applying mutation
@@ -99,37 +165,110 @@ def one_plot_ea(row, problem):
                                     upper_bound=1.0),
         # I add a bounder to warranty the values are between 0 and 1, because the genes are normalized
         # all arguments specified below, THAT ARE NOT part of the "evolve" method, will be automatically placed in "args"
-        initial_values = init_typical_individual(row["crop"]),
+        initial_values = center, # the center of the generated individuals
         rdt = row["RealizedYield"],
         row = row,
         problem = problem,
+        pool = pool,
+        surrogate = surrogate,
+        screen_fraction = screen_fraction,
+        checkpoint = checkpoint,
+        checkpoint_every = checkpoint_every,
+        generation_offset = generation_offset,
+        evaluation_offset = evaluation_offset,
         )
     best_individual = final_population[0]
+    if return_evaluations:
+        return best_individual.candidate, best_individual.fitness, evaluation_offset + evolutionary_algorithm.num_evaluations
     return best_individual.candidate, best_individual.fitness
 
 
-def evaluate_simulation(row):
-    candidate, fitness = one_plot_ea(row, problem)
-    return row["id"], candidate, fitness
+def evaluate_simulation(row, pool, checkpoint, resume_states, steady_state=False, archive=None):
+    """
+    Runs (or continues) the EA of a plot and appends its result to the checkpoint store as soon as it is done.
+    With an archive of previous calibrations, the EA starts from the ones of the plot and of its neighbours.
+    """
+    # No plot_observer here: the EAs run in threads and pyplot is not thread safe.
+    candidate, fitness = one_plot_ea(row, problem, pool, observer=inspyred.ec.observers.default_observer,
+                                     checkpoint=checkpoint, resume_state=resume_states.get(unit_id(row)),
+                                     steady_state=steady_state,
+                                     warm_start=None if archive is None else archive.seeds_for(row))
+    checkpoint.append("results", [{"plot_id": unit_id(row), "candidate": list(candidate), "fitness": fitness}])
+    return unit_id(row), candidate, fitness
 
 
 if __name__ == "__main__":
     problem = set_up_problem()
-    with open("src/sims_setup.pickle", 'rb') as f:
-        sims_data = pickle.load(f)
+    configure_memo_store("output/memo_store.sqlite") # Shared with the other experiments
+    # instrument: time the phases of every simulation in the workers, report in output/instrumentation/wofost_ea_1
+    instrument = False
+    if instrument:
+        configure_instrumentation("output/instrumentation/wofost_ea_1")
+    sims_data = read_sims_table()
     simulations = sims_data.to_dict(orient="records")
-    with joblib_progress(description="Running parallel WOFOST simulations...", total=len(simulations)):
-        results = Parallel(n_jobs=70)(
-            delayed(evaluate_simulation)(row) for row in simulations
-        )
-    # Unpack results
-    id_list, candidate_list, fitness_list = zip(*results)
-    
-    candidate_wofost_list = [traductor.genes_to_wofost(cand) for cand in candidate_list]
+    # The rows that cannot be simulated (no weather, NaT dates, unknown crop or soil, failing run) are set aside
+    simulations, quarantine = preflight(simulations, n_jobs=70, require=("RealizedYield",))
+    print_preflight_report(simulations, quarantine)
+    quarantine.to_csv("output/wofost_ea_1_quarantine.csv", index=False)
+    # One EA per distinct (inputs, realized yield): the duplicated rows get the result of their unit
+    plan = SimulationPlan(simulations, extra_keys=("RealizedYield",))
+    plan.print_report()
+    checkpoint_path = "output/checkpoints/wofost_ea_1"
+    resume = True # True: skip the plots finished by a previous run and continue the interrupted EAs, False: start over
+    if not resume:
+        shutil.rmtree(checkpoint_path, ignore_errors=True)
+    checkpoint = CheckpointStore(checkpoint_path)
+    done = checkpoint.completed()
+    resume_states = {state["plot_id"]: state for state in checkpoint.read("states").to_dict(orient="records")}
+    todo = [row for row in plan.units if unit_id(row) not in done]
+    print(f"{len(plan.units) - len(todo)} plot seasons already calibrated, {len(todo)} to go "
+          f"({sum(unit_id(row) in resume_states for row in todo)} interrupted).")
+    use_plot_affinity = False # True: each worker owns a set of plots, False: one global queue of (plot, candidates) chunks
+    use_vectorized_engine = True # True: a population is simulated in one call of wof_tools/batch_wofost.py
+    # True: asynchronous steady-state EAs, no generation waits for its slowest simulation. It submits small batches,
+    # so it needs the per-simulation pcse engine (use_vectorized_engine = False).
+    use_steady_state = False
+    # True: each EA starts from the calibrations of the same plot in earlier years and of its nearest same-crop plots,
+    # archived by the previous runs (wof_tools/warm_start.py). It reads the plots coordinates file and writes the archive.
+    use_warm_start = False
+    archive = None
+    if use_warm_start:
+        plots_coords = pd.read_parquet(PLOTS_COORDS_PATH, columns=["PlotId", "Longitude", "Latitude"])
+        archive = WarmStartArchive.load(plots_coords)
+        print(f"{len(archive)} archived calibrations")
+    # The EA loops are cheap, they run in threads of this process while the simulations go to the pool,
+    # so there is no nested parallelism oversubscribing the machine.
+    backend = PlotAffinePool if use_plot_affinity else TaskScheduler
+    with backend(plan.units, problem, n_workers=70, vectorized=use_vectorized_engine) as pool:
+        with ThreadPoolExecutor(max_workers=2*pool.n_workers) as executor:
+            list(tqdm(executor.map(lambda row: evaluate_simulation(row, pool, checkpoint, resume_states,
+                                                                 use_steady_state, archive), todo),
+                      total=len(todo),
+                      desc="Running WOFOST calibrations..."))
+    if instrument:
+        print_run_report(run_report("output/instrumentation/wofost_ea_1",
+                                    "output/instrumentation/wofost_ea_1_report.json"))
+    checkpoint.compact("results")
+    checkpoint.compact("states")
+    # The results of every session are read back from the store
+    results = checkpoint.read("results").set_index("plot_id")
+    id_list = [row["id"] for row in simulations]
+    unit_id_list = [unit_id(unit) for unit in plan.fan_out(plan.units)]
+    fitness_list = [results.loc[unit, "fitness"] for unit in unit_id_list]
+    candidate_wofost_list = space.decode([list(results.loc[unit, "candidate"]) for unit in unit_id_list]).tolist()
 
     results_df = pd.DataFrame({"ID": id_list,
                                "candidate": candidate_wofost_list,
                                "fitness": fitness_list,})
     results_df.to_pickle("output/wofost_ea_1_results.pkl")
     results_df.to_csv("output/wofost_ea_1_results.csv", index=False)
-    print(results_df.head())
\ No newline at end of file
+    print(results_df.head())
+    if use_warm_start:
+        # The calibrations of this run seed the next ones
+        archived = space.decode([list(results.loc[unit_id(unit), "candidate"]) for unit in plan.units])
+        archive.add(pd.DataFrame({"plot_id": [unit["id"] for unit in plan.units],
+                                  "year": [unit["crop_end_date"].year for unit in plan.units],
+                                  "crop": [unit["crop"] for unit in plan.units],
+                                  "fitness": [results.loc[unit_id(unit), "fitness"] for unit in plan.units],
+                                  **dict(zip(space.names, archived.T))}))
+        archive.save()
\ No newline at end of file
@@ -0,0 +1,80 @@
+"""
+Side-by-side comparison of the naive EA (first_ea.py) and its surrogate-assisted version on the same plots.
+The surrogate EA pre-screens each offspring batch with an RBF model and only simulates the most promising fraction,
+so it is given a fraction of the simulator budget of the naive EA.
+The two EAs run one after the other, each with a fresh memo store of its own, so that neither reuses the simulations of
+the other (they start from the same seed) and the WOFOST runs of each are counted.
+"""
+import os
+import inspyred
+import pandas as pd
+from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
+from first_ea import one_plot_ea
+from wof_tools.wof_ea_interface import set_up_problem
+from wof_tools.scheduler import TaskScheduler
+from wof_tools.memo_store import configure_memo_store, MemoStore
+from wof_tools.surrogate import RBFSurrogate
+from wof_tools.sims_table import read_sims_table
+
+NAIVE_MAX_EVALUATIONS = 1000
+SURROGATE_MAX_EVALUATIONS = 300
+SCREEN_FRACTION = 0.3
+MEMO_STORE_DIR = "output/memo_surrogate_vs_naive"
+
+
+def naive_run(row, problem, pool):
+    _, fitness, evaluations = one_plot_ea(row, problem, pool, observer=inspyred.ec.observers.default_observer,
+                                          max_evaluations=NAIVE_MAX_EVALUATIONS, return_evaluations=True)
+    return {"id": row["id"], "naive_fitness": fitness, "naive_evaluations": evaluations}
+
+
+def surrogate_run(row, problem, pool):
+    surrogate = RBFSurrogate()
+    _, fitness, evaluations = one_plot_ea(row, problem, pool, observer=inspyred.ec.observers.default_observer,
+                                          max_evaluations=SURROGATE_MAX_EVALUATIONS,
+                                          surrogate=surrogate,
+                                          screen_fraction=SCREEN_FRACTION,
+                                          return_evaluations=True)
+    return {"id": row["id"], "surrogate_fitness": fitness, "surrogate_evaluations": evaluations,
+            "surrogate_fits": surrogate.n_fits}
+
+
+def run_arm(name, run_plot, simulations, problem):
+    """
+    Run one EA on every plot, with its own pool and a fresh memo store: an arm never reuses the simulations of the
+    other one, and the entries of its store at the end are the WOFOST runs it actually needed.
+    Returns the results of the plots and that number of runs (the failed simulations are not stored, not counted).
+    """
+    memo_path = os.path.join(MEMO_STORE_DIR, f"{name}.sqlite")
+    for suffix in ["", "-wal", "-shm"]:
+        if os.path.exists(memo_path + suffix):
+            os.remove(memo_path + suffix)
+    configure_memo_store(memo_path, max_entries=100_000_000) # Never evicted: it counts the runs
+    with TaskScheduler(simulations, problem, n_workers=70) as pool:
+        with ThreadPoolExecutor(max_workers=2*pool.n_workers) as executor:
+            results = list(tqdm(executor.map(lambda row: run_plot(row, problem, pool), simulations),
+                                total=len(simulations),
+                                desc=f"Running the {name} EA..."))
+    return results, len(MemoStore(memo_path))
+
+
+if __name__ == "__main__":
+    problem = set_up_problem()
+    sims_data = read_sims_table(limit=50)
+    simulations = sims_data.to_dict(orient="records")
+    naive_results, naive_runs = run_arm("naive", naive_run, simulations, problem)
+    surrogate_results, surrogate_runs = run_arm("surrogate", surrogate_run, simulations, problem)
+
+    comparison_df = pd.concat([pd.DataFrame(naive_results), pd.DataFrame(surrogate_results).drop(columns="id")], axis=1)
+    comparison_df.to_csv("output/surrogate_vs_naive_ea.csv", index=False)
+    summary = pd.DataFrame({"naive": [comparison_df["naive_fitness"].median(),
+                                      comparison_df["naive_fitness"].mean(),
+                                      comparison_df["naive_evaluations"].sum(),
+                                      naive_runs],
+                            "surrogate": [comparison_df["surrogate_fitness"].median(),
+                                          comparison_df["surrogate_fitness"].mean(),
+                                          comparison_df["surrogate_evaluations"].sum(),
+                                          surrogate_runs]},
+                           index=["median fitness", "mean fitness", "simulator calls", "WOFOST runs"])
+    print(summary)
@@ -1,83 +1,76 @@
 """
 Reusing the logic herited from wofost_plot_ea, this script is designed to run a random search baseline for the WOFOST model.
 """
-import random
-import pickle
+import shutil
+import numpy as np
 import pandas as pd
-import tqdm as tqdm
-from joblib import Parallel, delayed
-from joblib_progress import joblib_progress
 from tqdm import tqdm
-from wof_tools.wof_ea_interface import set_up_problem, WofostTranslator
-from wof_tools.wofost_exec import wof_one_simulation
+from wof_tools.wof_ea_interface import set_up_problem, ParameterSpace, CALIBRATED_PARAMETERS, compute_fitness
+from wof_tools.scheduler import TaskScheduler
+from wof_tools.memo_store import configure_memo_store
+from wof_tools.checkpoint import CheckpointStore
+from wof_tools.planner import SimulationPlan
+from wof_tools.preflight import preflight, print_preflight_report
+from wof_tools.sims_table import read_sims_table, unit_id
 
-#TODO: This dictionary is present in multiple scripts
-initial_values = {"wheat": {"TSUM1": 706, "TSUM2": 975},
-                  "barley": {"TSUM1": 800, "TSUM2": 750},
-                  "fababean": {"TSUM1": 833, "TSUM2": 1351},
-                  "maize": {"TSUM1": 600, "TSUM2": 1211},
-                  "sunflower": {"TSUM1": 1050, "TSUM2": 1000},
-                  "sorghum": {"TSUM1": 730, "TSUM2": 600},
-                  "rapeseed": {"TSUM1": 240, "TSUM2": 600},
-                  "millet": {"TSUM1": 772, "TSUM2": 483},
-                   }
-traductor = WofostTranslator()
+space = ParameterSpace(CALIBRATED_PARAMETERS)
 
-def random_generator(ranges):
-    """
-    This function generates a random individual based on the initial values and noise standard deviation.
-    """
-    return [random.uniform(min_val, max_val) for min_val, max_val in ranges]
-
-
-def random_searcher(row, problem, n_iterations=1000):
+def random_searcher(row, scheduler, n_iterations=1000):
     """
     This function performs a random search for the WOFOST model.
-    It generates a random individual and evaluates it using the WOFOST model.
+    The candidates of the plot are submitted to the global scheduler, the future gives their simulated yields.
     """
-    def evaluate_one(candidate):
-        """
-        This function evaluates a single candidate by running the WOFOST model and returning the fitness.
-        """
-        y_pred = wof_one_simulation(params_row=row,
-                                    override_params_mode=True,
-                                    paramset=candidate,
-                                    problem=problem)
-        fitness = abs(row["RealizedYield"] - y_pred)
-        return candidate, fitness
-
     crop = row["crop"]
-    candidates = [list(initial_values[crop].values())]
-    ranges = traductor.ranges
-    next_candidates = [random_generator(ranges) for _ in range(n_iterations-1)]
-    candidates.extend(next_candidates)
+    candidates = np.vstack([space.typical(crop),
+                            space.sample(n_iterations-1)]) # Uniform random individuals within the ranges
+    return candidates, scheduler.submit(unit_id(row), candidates)
+
+
+def best_candidate(row, candidates, y_pred):
+    fitness = compute_fitness(row["RealizedYield"], y_pred)
+    best = int(np.argmin(fitness))
+    return candidates[best], fitness[best]
 
-    # with joblib_progress(description ="Parallel process track..."):
-    #TODO: Try the parallelization over the plots not the candidates. This improves the performance?
-    results = Parallel(n_jobs=60)(delayed(evaluate_one)(cand) for cand in candidates)
-    results.sort(key=lambda x: x[1])
-    best_candidate, best_fitness = results[0]
-    return best_candidate, best_fitness
 
 if __name__ == "__main__":
     problem = set_up_problem()
-    with open("src/sims_setup.pickle", 'rb') as f:
-        sims_data = pickle.load(f)
+    configure_memo_store("output/memo_store.sqlite") # Shared with the other experiments
+    sims_data = read_sims_table()
     simulations = sims_data.to_dict(orient="records")
-    id_list = []
-    candidate_list = []
-    candidate_wofost_list = []
-    fitness_list = []
-    for row in tqdm(simulations):
-        candidate, fitness = random_searcher(row, problem, n_iterations=100)
-        # print(candidate, fitness)
-        id_list.append(row["id"])
-        candidate_list.append(candidate)
-        fitness_list.append(fitness)
+    # The rows that cannot be simulated (no weather, NaT dates, unknown crop or soil, failing run) get no calibration budget
+    simulations, quarantine = preflight(simulations, n_jobs=70, require=("RealizedYield",))
+    print_preflight_report(simulations, quarantine)
+    quarantine.to_csv("output/random_search_quarantine.csv", index=False)
+    # One search per distinct (inputs, realized yield): the duplicated rows get the result of their unit
+    plan = SimulationPlan(simulations, extra_keys=("RealizedYield",))
+    plan.print_report()
+    checkpoint_path = "output/checkpoints/random_search"
+    resume = True # True: the plots finished by a previous run are not searched again, False: start over
+    if not resume:
+        shutil.rmtree(checkpoint_path, ignore_errors=True)
+    checkpoint = CheckpointStore(checkpoint_path)
+    done = checkpoint.completed()
+    todo = [row for row in plan.units if unit_id(row) not in done]
+    print(f"{len(plan.units) - len(todo)} plot seasons already searched, {len(todo)} to go.")
+    # Every (plot, candidate) of the run goes to the same work queue, the workers never wait for a plot to finish.
+    # With the vectorized engine the candidates of a plot are simulated in one call.
+    with TaskScheduler(plan.units, problem, n_workers=60, vectorized=True) as scheduler:
+        submitted = [random_searcher(row, scheduler, n_iterations=100) for row in todo]
+        for row, (candidates, future) in tqdm(zip(todo, submitted), total=len(todo)):
+            candidate, fitness = best_candidate(row, candidates, future.result())
+            # Each plot is saved as soon as it is done
+            checkpoint.append("results", [{"plot_id": unit_id(row), "candidate": candidate.tolist(), "fitness": fitness}])
+    checkpoint.compact("results")
+
+    results = checkpoint.read("results").set_index("plot_id")
+    id_list = [row["id"] for row in simulations]
+    unit_id_list = [unit_id(unit) for unit in plan.fan_out(plan.units)]
+    candidate_list = [list(results.loc[unit, "candidate"]) for unit in unit_id_list]
+    fitness_list = [results.loc[unit, "fitness"] for unit in unit_id_list]
 
     results_df = pd.DataFrame({"id": id_list,
                                "candidate": candidate_list,
                                "fitness": fitness_list,})
     results_df.to_pickle("output/random_search_results.pkl")
     results_df.to_csv("output/random_search_results.csv", index=False)
-    print(results_df.head())
\ No newline at end of file
+    print(results_df.head())
@@ -0,0 +1,250 @@
+"""
+Micro and macro benchmarks of the hot paths, on synthetic data (see synthetic_data.py):
+    idw_interpolation      one day of silo weather interpolated on every plot
+    stream_interpolation   a whole campaign window interpolated on every plot (the batched IDW)
+    weather_files          the interpolated weather converted and written as one PCSE CSV per plot
+    wof_one_simulation     one WOFOST run with parameter overrides (warm input cache, no memo store)
+    vectorized_population  one population simulated by the batched engine
+    ea_generations         the EA of first_ea.py on one plot, simulations on the task scheduler
+    sobol_pipeline         Sobol sample -> SampleStudy -> indices on a few plots
+Each benchmark records its latency (min / median / max over the repeats) and its throughput in items per second.
+The results are written as JSON. Given a baseline JSON, the throughputs are compared and the run fails when one of them
+dropped by more than the tolerance, e.g.
+    python benchmarks/run_benchmarks.py --size small --output output/benchmarks/latest.json --baseline benchmarks/baseline.json
+Run it from the root of the repository (the WOFOST templates path is relative).
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import subprocess
+import numpy as np
+import pandas as pd
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+for script_dir in ["setup_meteo_data", "EA_wof_calibration", "sensitivity_anlaysis"]:
+    sys.path.insert(0, os.path.join(HERE, "..", script_dir))
+from synthetic_data import build_synthetic_tree, synthetic_tree_paths, METEO_TEMPLATE
+from IDW_interpolation_to_plots import idw_interpolation, stream_interpolation, WEATHER_COLUMNS
+from interpolated_to_WOF_files import plots_coords_to_WOFtable, write_WOF_files
+from wof_tools.sims_table import read_sims_table
+from wof_tools.wofost_exec import wof_one_simulation, disable_logging
+from wof_tools.batch_wofost import wof_vectorized_simulation
+from wof_tools.wof_ea_interface import set_up_problem, ParameterSpace
+from wof_tools.scheduler import TaskScheduler
+from wof_tools.sensitivity import SampleStudy, analyze_sobol
+
+SIZES = {"small": {"n_silos": 30, "n_plots": 100, "repeats": 5, "population": 50, "ea_evaluations": 400,
+                   "sobol_plots": 2, "sobol_samples": 8},
+         "medium": {"n_silos": 100, "n_plots": 1000, "repeats": 5, "population": 100, "ea_evaluations": 1000,
+                    "sobol_plots": 4, "sobol_samples": 32},
+         "large": {"n_silos": 300, "n_plots": 10000, "repeats": 3, "population": 250, "ea_evaluations": 2000,
+                   "sobol_plots": 16, "sobol_samples": 64},
+         }
+
+
+def timed(func, repeats, warmup=0):
+    """
+    Wall times of repeats calls of func (after warmup untimed calls).
+    """
+    for _ in range(warmup):
+        func()
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+    return times
+
+
+def record(times, items, unit):
+    """
+    Latency statistics of the calls and throughput (items per second of the median call).
+    """
+    median = float(np.median(times))
+    return {"unit": unit,
+            "items": items,
+            "repeats": len(times),
+            "latency_s": {"min": float(np.min(times)), "median": median, "max": float(np.max(times))},
+            "throughput": items / median if median > 0 else float("inf"),
+            }
+
+
+def bench_idw_interpolation(paths, config):
+    weather = pd.read_parquet(paths["weather"])
+    day = weather[weather["date_mesure"] == weather["date_mesure"].iloc[0]]
+    obs = day[["silo_id", "longitude", "latitude"] + WEATHER_COLUMNS].to_numpy(dtype=float)
+    targets = pd.read_parquet(paths["plots"])[["Longitude", "Latitude"]].to_numpy()
+    times = timed(lambda: idw_interpolation(obs, targets), config["repeats"] * 4, warmup=1)
+    return record(times, len(targets), "plots/s")
+
+
+def bench_stream_interpolation(paths, config):
+    from request_meteoDB import campaign_window
+    year = int(pd.read_parquet(paths["plots"], columns=["YearId"])["YearId"].iloc[0])
+    output_path = os.path.join(paths["root"], "bench_interpolated.parquet")
+    run = lambda: stream_interpolation([(year, paths["weather"], campaign_window(year))], paths["plots"], output_path)
+    times = timed(run, max(config["repeats"] // 2, 1))
+    n_rows = pd.read_parquet(output_path, columns=["PlotId"]).shape[0]
+    return record(times, n_rows, "plot-days/s")
+
+
+def bench_weather_files(paths, config):
+    df = pd.read_parquet(paths["interpolated"])
+    out_dir = os.path.join(paths["root"], "bench_meteo_data")
+    os.makedirs(out_dir, exist_ok=True)
+
+    def run():
+        df_pcse, plots = plots_coords_to_WOFtable(df)
+        write_WOF_files(df_pcse, plots, METEO_TEMPLATE, out_dir)
+    times = timed(run, config["repeats"], warmup=1)
+    return record(times, df["PlotId"].nunique(), "files/s")
+
+
+def bench_wof_one_simulation(paths, config, rows, problem):
+    space = ParameterSpace(problem["names"])
+    paramsets = space.sample(config["repeats"] * 4, rng=np.random.default_rng(0))
+    row = rows[0]
+    calls = iter(paramsets)
+    run = lambda: wof_one_simulation(row, wofost_data_path=paths["wofost_data"], override_params_mode=True,
+                                     paramset=next(calls), problem=problem, target="TWSO")
+    wof_one_simulation(row, wofost_data_path=paths["wofost_data"], override_params_mode=True,
+                       paramset=paramsets[0], problem=problem, target="TWSO")  # inputs in the cache
+    times = timed(run, len(paramsets))
+    return record(times, 1, "simulations/s")
+
+
+def bench_vectorized_population(paths, config, rows, problem):
+    space = ParameterSpace(problem["names"])
+    paramsets = space.sample(config["population"], rng=np.random.default_rng(1))
+    run = lambda: wof_vectorized_simulation(rows[0], paramsets, problem, wofost_data_path=paths["wofost_data"],
+                                            target="TWSO")
+    times = timed(run, config["repeats"], warmup=1)
+    return record(times, len(paramsets), "simulations/s")
+
+
+def bench_ea_generations(paths, config, rows, problem, n_workers):
+    import inspyred
+    import first_ea
+    row = rows[0]
+    with TaskScheduler([row], problem, n_workers=n_workers, wofost_data_path=paths["wofost_data"],
+                       vectorized=True) as pool:
+        run = lambda: first_ea.one_plot_ea(row, problem, pool, observer=inspyred.ec.observers.default_observer,
+                                           max_evaluations=config["ea_evaluations"], return_evaluations=True)
+        n_evaluations = run()[2]  # also starts the workers
+        times = timed(run, max(config["repeats"] // 2, 1))
+    return record(times, n_evaluations, "evaluations/s")
+
+
+def bench_sobol_pipeline(paths, config, rows, n_workers):
+    from sobol import set_up_full_problem
+    problem, paramsets = set_up_full_problem(calc_second_order=True, n_samples=config["sobol_samples"], seed=42)
+    plots = rows[:config["sobol_plots"]]
+    study_path = os.path.join(paths["root"], "bench_sobol")
+
+    def run():
+        shutil.rmtree(study_path, ignore_errors=True)
+        study = SampleStudy(study_path, plots, problem, paramsets)
+        study.run(n_workers=n_workers, chunk_size=64, wofost_data_path=paths["wofost_data"], target="TWSO")
+        analyze_sobol(study, calc_second_order=True, n_jobs=1, seed=42)
+    times = timed(run, max(config["repeats"] // 2, 1))
+    return record(times, len(plots) * len(paramsets), "simulations/s")
+
+
+def run_benchmarks(paths, config, n_workers, only=None):
+    disable_logging()
+    problem = set_up_problem()
+    # A wheat plot: the longest crop cycle of the synthetic crops
+    sims = read_sims_table(paths["sims"])
+    rows = sims.sort_values("crop", key=lambda crop: crop != "wheat", kind="stable").to_dict(orient="records")
+    benchmarks = {"idw_interpolation": lambda: bench_idw_interpolation(paths, config),
+                  "stream_interpolation": lambda: bench_stream_interpolation(paths, config),
+                  "weather_files": lambda: bench_weather_files(paths, config),
+                  "wof_one_simulation": lambda: bench_wof_one_simulation(paths, config, rows, problem),
+                  "vectorized_population": lambda: bench_vectorized_population(paths, config, rows, problem),
+                  "ea_generations": lambda: bench_ea_generations(paths, config, rows, problem, n_workers),
+                  "sobol_pipeline": lambda: bench_sobol_pipeline(paths, config, rows, n_workers),
+                  }
+    results = {}
+    for name, bench in benchmarks.items():
+        if only is not None and name not in only:
+            continue
+        print(f"Running {name}...")
+        results[name] = bench()
+        print(f"    {results[name]['throughput']:.1f} {results[name]['unit']} "
+              f"(median {results[name]['latency_s']['median']*1000:.1f} ms)")
+    return results
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=HERE).stdout.strip()
+    except OSError:
+        commit = None
+    return {"commit": commit,
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            }
+
+
+def compare(results, baseline, tolerance=0.2):
+    """
+    Throughput of every benchmark against the baseline.
+    Returns the comparison table and the names of the benchmarks that regressed by more than the tolerance.
+    """
+    lines = []
+    for name, result in results["benchmarks"].items():
+        if name not in baseline["benchmarks"]:
+            continue
+        reference = baseline["benchmarks"][name]["throughput"]
+        ratio = result["throughput"] / reference
+        lines.append({"benchmark": name, "unit": result["unit"], "baseline": reference,
+                      "current": result["throughput"], "ratio": ratio, "regression": ratio < 1 - tolerance})
+    table = pd.DataFrame(lines, columns=["benchmark", "unit", "baseline", "current", "ratio", "regression"])
+    return table, table.loc[table["regression"], "benchmark"].tolist()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks of the hot paths on synthetic data.")
+    parser.add_argument("--size", choices=list(SIZES), default="small")
+    parser.add_argument("--workers", type=int, default=2, help="worker processes of the EA and Sobol benchmarks")
+    parser.add_argument("--data-dir", default=None, help="where the synthetic data is built (kept between runs)")
+    parser.add_argument("--only", nargs="+", default=None, help="run only these benchmarks")
+    parser.add_argument("--output", default="output/benchmarks/latest.json")
+    parser.add_argument("--baseline", default=None, help="JSON of a previous run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="accepted relative drop of throughput")
+    args = parser.parse_args()
+
+    config = SIZES[args.size]
+    data_dir = args.data_dir or f"output/benchmarks/data_{args.size}"
+    if not os.path.exists(os.path.join(data_dir, "sims_setup.parquet")):
+        t0 = time.time()
+        build_synthetic_tree(data_dir, n_silos=config["n_silos"], n_plots=config["n_plots"])
+        print(f"Synthetic data built in {data_dir} in {time.time() - t0:.1f}s")
+    paths = synthetic_tree_paths(data_dir)
+
+    results = {"size": args.size, "config": config, "workers": args.workers, "environment": environment(),
+               "benchmarks": run_benchmarks(paths, config, args.workers, args.only)}
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("size") != args.size:
+            print(f"Warning: the baseline was run with size {baseline.get('size')}, not {args.size}")
+        table, regressions = compare(results, baseline, args.tolerance)
+        print(table.to_string(index=False, float_format=lambda x: f"{x:.2f}"))
+        if regressions:
+            print(f"Performance regression (more than {args.tolerance:.0%} slower): {', '.join(regressions)}")
+            sys.exit(1)
@@ -0,0 +1,189 @@
+"""
+Synthetic inputs for the benchmarks: they have the shapes and types of the private data (src/raw_data and wofost_data/),
+so every step of the pipeline can run on a CI node.
+    - silo weather: the year partitioned dataset of request_meteoDB.py (seasonal cycles plus noise, rounded to 2 decimals)
+    - plots: the coordinates file of the plots (PlotId, YearId, Longitude, Latitude, crop, dates, yield)
+    - wofost_data/: crop and soil files built from the demo database shipped with pcse, and one weather CSV
+      per plot produced by the real pipeline (IDW interpolation, then interpolated_to_WOF_files.py)
+    - the simulations table (src/sims_setup.parquet format)
+Everything is seeded, the same sizes always give the same data.
+"""
+import os
+import sys
+import sqlite3
+import datetime as dt
+import yaml
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "setup_meteo_data"))
+from request_meteoDB import SCHEMA, PARTITIONING, WEATHER_COLUMNS, campaign_window
+from IDW_interpolation_to_plots import stream_interpolation
+from interpolated_to_WOF_files import plots_coords_to_WOFtable, write_WOF_files
+from wof_tools.sims_table import write_sims_table
+
+# Bounding box of the plots and silos (lon, lat)
+BOX = ((-1.5, 3.5), (43.0, 46.0))
+# Crops of the pcse demo database: (crop_no, variety, Geofolia name, sowing month/day, harvest month/day, harvest year offset)
+DEMO_CROPS = {"wheat": (1, "Winter_wheat_105", "Blé tendre d'hiver", (10, 15), (7, 20), 1),
+              "maize": (2, "Grain_maize_202", "Maïs grain", (4, 20), (10, 1), 0)}
+DEMO_GRID = 31031
+# Parameters of WOFOST 7.3 that the demo database predates (CO2 effects, reallocation, vernalisation)
+EXTRA_CROP_PARAMETERS = {"CO2AMAXTB": [40.0, 0.0, 360.0, 1.0, 720.0, 1.35, 1000.0, 1.5, 2000.0, 1.5],
+                         "CO2EFFTB": [40.0, 0.0, 360.0, 1.0, 720.0, 1.11, 1000.0, 1.11, 2000.0, 1.11],
+                         "CO2TRATB": [40.0, 0.0, 360.0, 1.0, 720.0, 0.9, 1000.0, 0.9, 2000.0, 0.9],
+                         "REALLOC_DVS": 2.0, "REALLOC_EFFICIENCY": 0.0, "REALLOC_LEAF_FRACTION": 0.0,
+                         "REALLOC_LEAF_RATE": 0.0, "REALLOC_STEM_FRACTION": 0.0, "REALLOC_STEM_RATE": 0.0,
+                         "VERNBASE": 14, "VERNDVS": 0.3, "VERNSAT": 70,
+                         "VERNRTB": [-8.0, 0.0, -4.0, 0.0, 3.0, 1.0, 10.0, 1.0, 17.0, 0.0, 20.0, 0.0]}
+SOILS = ["ec1", "ec2", "ec3", "ec4", "ec5", "ec6"]
+METEO_TEMPLATE = [["## Site Characteristics"], ["Country = 'FR'"], ["Station = 'plot {}'"],
+                  ["Description = 'Synthetic weather'"], ["Source = 'benchmarks'"], ["Contact = 'none'"]]
+
+
+def synthetic_silo_weather(n_silos, first_date, last_date, seed=0):
+    """
+    Daily weather of n_silos silos in the columns of request_meteoDB.SCHEMA, ordered by date and silo.
+    """
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range(first_date, last_date, freq="D")
+    n_dates = len(dates)
+    lon = rng.uniform(*BOX[0], n_silos)
+    lat = rng.uniform(*BOX[1], n_silos)
+    season = np.sin(2 * np.pi * (dates.dayofyear.to_numpy() - 110) / 365.25)[:, None]
+    # Warmer to the south, plus day to day noise shared by the neighbour silos and a local part
+    regional = rng.normal(0, 2.5, (n_dates, 1))
+    t_mean = 12 + 9 * season - 0.6 * (lat - 44.5)[None, :] + regional + rng.normal(0, 0.8, (n_dates, n_silos))
+    amplitude = np.clip(10 + 3 * season + rng.normal(0, 1.5, (n_dates, n_silos)), 3, None)
+    rain = np.where(rng.random((n_dates, n_silos)) < 0.35, rng.gamma(0.8, 6.0, (n_dates, n_silos)), 0.0)
+    values = {"T2M_MAX": t_mean + amplitude / 2,
+              "T2M_MEAN": t_mean,
+              "T2M_MIN": t_mean - amplitude / 2,
+              "SSI_MEAN": np.clip(180 + 110 * season - 8 * rain + rng.normal(0, 30, (n_dates, n_silos)), 15, None),
+              "PRECIP_SUM": rain,
+              "WS2M_MEAN": rng.gamma(4.0, 0.8, (n_dates, n_silos)),
+              "DEWT2M_MEAN": t_mean - amplitude / 2 - rng.uniform(0, 3, (n_dates, n_silos)),
+              }
+    df = pd.DataFrame({"silo_name": np.tile([f"silo_{i}" for i in range(n_silos)], n_dates),
+                       "date_mesure": np.repeat(dates.date, n_silos),
+                       "silo_id": np.tile(np.arange(1, n_silos + 1), n_dates),
+                       "longitude": np.tile(lon, n_dates),
+                       "latitude": np.tile(lat, n_dates)})
+    for col in WEATHER_COLUMNS:
+        df[col] = np.round(values[col].ravel(), 2)
+    return df
+
+
+def synthetic_plots(n_plots, year, crops=tuple(DEMO_CROPS), seed=0):
+    """
+    Plots of one campaign year with the columns of the plots coordinates file.
+    """
+    rng = np.random.default_rng(seed + 1)
+    crop = rng.choice(list(crops), n_plots)
+    sowing, harvest, names = [], [], []
+    for name in crop:
+        _, _, geofolia, (sow_m, sow_d), (harv_m, harv_d), offset = DEMO_CROPS[name]
+        shift = dt.timedelta(days=int(rng.integers(-10, 11)))
+        sowing.append(dt.datetime(year - offset, sow_m, sow_d) + shift)
+        harvest.append(dt.datetime(year, harv_m, harv_d) + shift)
+        names.append(geofolia)
+    return pd.DataFrame({"PlotId": np.arange(1, n_plots + 1),
+                         "YearId": year,
+                         "Longitude": np.round(rng.uniform(*BOX[0], n_plots), 6),
+                         "Latitude": np.round(rng.uniform(*BOX[1], n_plots), 6),
+                         "CropName": names,
+                         "SowingDate": pd.DatetimeIndex(sowing).strftime("%d/%m/%Y %H:%M:%S"),
+                         "HarvestingDate": pd.DatetimeIndex(harvest).strftime("%d/%m/%Y %H:%M:%S"),
+                         "RealizedYield": np.round(rng.uniform(3000, 9000, n_plots), 1)})
+
+
+def synthetic_sims(plots, seed=0):
+    """
+    The simulations table of the plots (same columns as create_sims_df.py).
+    """
+    rng = np.random.default_rng(seed + 2)
+    crop_of = {geofolia: (name, variety) for name, (_, variety, geofolia, *_) in DEMO_CROPS.items()}
+    sims = pd.DataFrame({"id": plots["PlotId"],
+                         "crop": plots["CropName"].map({k: v[0] for k, v in crop_of.items()}),
+                         "variety": plots["CropName"].map({k: v[1] for k, v in crop_of.items()}),
+                         "soil": rng.choice(SOILS, len(plots)),
+                         "crop_start_date": pd.to_datetime(plots["SowingDate"], format="%d/%m/%Y %H:%M:%S"),
+                         "crop_end_date": pd.to_datetime(plots["HarvestingDate"], format="%d/%m/%Y %H:%M:%S")})
+    sims["site"] = "wofost_data/sites_data/mean_site.YAML"
+    sims["weather"] = "wofost_data/meteo_data/" + plots["PlotId"].astype(str) + ".csv"
+    sims["real_crop"] = plots["CropName"]
+    sims["RealizedYield"] = plots["RealizedYield"]
+    return sims
+
+
+def write_demo_crops_and_soils(wofost_data_path):
+    """
+    Crop (YAML) and soil (CABO) files from the demo database of pcse, in the layout of wofost_data/.
+    """
+    from pcse.settings import settings
+    from pcse.tests import db_input
+    from pcse.tests.run_wofost import namedtuple_factory
+
+    os.makedirs(os.path.join(wofost_data_path, "crops_data"), exist_ok=True)
+    os.makedirs(os.path.join(wofost_data_path, "soils_data"), exist_ok=True)
+    conn = sqlite3.connect(os.path.join(settings.PCSE_USER_HOME, "pcse.db"))
+    conn.row_factory = namedtuple_factory
+    try:
+        for name, (crop_no, variety, *_) in DEMO_CROPS.items():
+            cropdata = db_input.fetch_cropdata(conn, DEMO_GRID, 2000, crop_no)
+            cropdata = {**EXTRA_CROP_PARAMETERS, **cropdata}
+            if cropdata["TSUMEM"] == 0:
+                # The demo crop starts at emergence, the agromanagement starts the crops at sowing
+                cropdata.update(TSUMEM=110.0, TBASEM=0.0)
+            params = {key: [value, "", ""] for key, value in cropdata.items() if key != "CRPNAM"}
+            with open(os.path.join(wofost_data_path, "crops_data", f"{name}.yaml"), "w") as f:
+                yaml.safe_dump({"Version": "1.0.0", "CropParameters": {"Varieties": {variety: params}}}, f)
+        with open(os.path.join(wofost_data_path, "crops_data", "crops.yaml"), "w") as f:
+            yaml.safe_dump({"available_crops": list(DEMO_CROPS)}, f)
+        soildata = db_input.fetch_soildata(conn, DEMO_GRID)
+    finally:
+        conn.close()
+    lines = ["** Synthetic soil (pcse demo database)"]
+    for key, value in soildata.items():
+        lines.append(f"{key} = {', '.join(map(str, value)) if isinstance(value, (list, tuple)) else value}")
+    for soil in SOILS:
+        with open(os.path.join(wofost_data_path, "soils_data", f"{soil}.soil"), "w") as f:
+            f.write("\n".join(lines) + "\n")
+
+
+def synthetic_tree_paths(root):
+    return {"root": root,
+            "weather": os.path.join(root, "meteo_dataset"),
+            "plots": os.path.join(root, "plots.parquet"),
+            "interpolated": os.path.join(root, "interpolated.parquet"),
+            "wofost_data": os.path.join(root, "wofost_data") + "/",
+            "sims": os.path.join(root, "sims_setup.parquet")}
+
+
+def build_synthetic_tree(root, n_silos=50, n_plots=200, year=2022, seed=0):
+    """
+    Write a complete synthetic data tree under root and return its paths:
+    meteo_dataset/ (hive partitioned by year), plots.parquet, interpolated.parquet, wofost_data/ and sims_setup.parquet.
+    """
+    paths = synthetic_tree_paths(root)
+    os.makedirs(root, exist_ok=True)
+    first, last = campaign_window(year)
+    weather = synthetic_silo_weather(n_silos, first, last, seed)
+    table = pa.Table.from_pandas(weather, preserve_index=False).cast(SCHEMA)
+    table = table.append_column("year", pa.array(pd.DatetimeIndex(weather["date_mesure"]).year, pa.int32()))
+    ds.write_dataset(table, paths["weather"], format="parquet", partitioning=PARTITIONING,
+                     existing_data_behavior="delete_matching")
+
+    plots = synthetic_plots(n_plots, year, seed=seed)
+    plots.to_parquet(paths["plots"], index=False)
+    stream_interpolation([(year, paths["weather"], (first, last))], paths["plots"], paths["interpolated"])
+
+    write_demo_crops_and_soils(paths["wofost_data"])
+    meteo_dir = os.path.join(paths["wofost_data"], "meteo_data")
+    os.makedirs(meteo_dir, exist_ok=True)
+    df_pcse, plot_ranges = plots_coords_to_WOFtable(pd.read_parquet(paths["interpolated"]))
+    write_WOF_files(df_pcse, plot_ranges, METEO_TEMPLATE, meteo_dir)
+    write_sims_table(synthetic_sims(plots, seed), paths["sims"])
+    return paths
@@ -0,0 +1,151 @@
+"""
+Cheap screening of the WOFOST parameters: eFAST (first and total order indices, like Sobol) and Morris elementary effects.
+Both use the problem of sobol.py (all the parameters of ParameterSpace) and the same execution path (SampleStudy of
+wof_tools/sensitivity.py, vectorized engine, memo store), so they can be run over thousands of plots before spending
+a Sobol budget on the parameters that survive the screening.
+Cost per plot with D parameters: eFAST N*D (N > 4*M**2), Morris r*(D+1) for r trajectories,
+against N*(D+2) for first order Sobol and N*(2D+2) for second order Sobol.
+With the D=18 parameters, M=2 (N=17) and r=10, eFAST costs 306 simulations per plot and Morris 190, against 640 for
+first order and 1216 for second order Sobol with N=32: eFAST is 48% of first order Sobol (25% of second order),
+Morris 30% (16%). With M=4 (N=65), eFAST would cost 1170 simulations, more than first order Sobol.
+"""
+import os
+import time
+import shutil
+import pickle
+from functools import partial
+import numpy as np
+import pandas as pd
+from SALib.sample import fast_sampler, morris as morris_sample
+from SALib.analyze import fast as fast_analyze, morris as morris_analyze
+from wof_tools.memo_store import configure_memo_store
+from wof_tools.wof_ea_interface import ParameterSpace
+from wof_tools.sensitivity import SampleStudy, analyze_study
+from wof_tools.planner import SimulationPlan
+from wof_tools.preflight import preflight, print_preflight_report
+from wof_tools.sims_table import read_sims_table
+
+
+def efast_indices(Y, problem, M=2, seed=None):
+    S = fast_analyze.analyze(problem, Y, M=M, seed=seed)
+    return {key: np.asarray(S[key]) for key in ["S1", "S1_conf", "ST", "ST_conf"]}
+
+
+def morris_indices(Y, problem, X, num_levels=4, seed=None):
+    S = morris_analyze.analyze(problem, X, Y, num_levels=num_levels, seed=seed)
+    return {key: np.asarray(S[key], dtype=float) for key in ["mu", "mu_star", "sigma", "mu_star_conf"]}
+
+
+def run_screening(name, simulations, problem, paramsets, analyze, study_root="output/sensitivity", n_workers=None,
+                  resume=True):
+    """
+    Simulate a screening sample on every plot and analyze each plot.
+    Returns
+    -------
+    results: list of dict
+        The indices of each plot
+    cost: dict
+        The cost of the method (simulations per plot, total, run time)
+    """
+    study_path = os.path.join(study_root, name)
+    if not resume:
+        shutil.rmtree(study_path, ignore_errors=True)
+    study = SampleStudy(study_path, simulations, problem, paramsets)
+    t0 = time.time()
+    n_simulated = study.run(n_workers=n_workers, chunk_size=256, target="TWSO", vectorized=True)
+    run_time = time.time() - t0
+    t0 = time.time()
+    results = analyze_study(study, analyze)
+    cost = {"method": name,
+            "plots": len(simulations),
+            "simulations_per_plot": study.n_samples,
+            "simulations": study.n_samples * len(simulations),
+            "simulated_now": n_simulated,  # the others were done by a previous run
+            "failed": int(np.isnan(study.outputs()).sum()),
+            "run_time_s": run_time,
+            "analysis_time_s": time.time() - t0,
+            }
+    return results, cost
+
+
+def mean_screening_indices(results, keys):
+    """
+    Mean over the plots of each index (the plots with failed simulations give NaN and are ignored).
+    """
+    return {key: np.nanmean(np.array([res[key] for res in results]), axis=0) for key in keys}
+
+
+def screening_table(problem, efast_results, morris_results):
+    """
+    One row per parameter with the mean indices of both methods, their rank, and the mean normalized mu_star
+    (mu_star / max mu_star of the plot) that makes Morris comparable across plots and with the eFAST indices.
+    """
+    efast = mean_screening_indices(efast_results, ["S1", "S1_conf", "ST", "ST_conf"])
+    morris = mean_screening_indices(morris_results, ["mu_star", "sigma", "mu_star_conf"])
+    normalized_mu_star = np.nanmean(np.array([res["mu_star"] / np.max(res["mu_star"]) for res in morris_results]), axis=0)
+    table = pd.DataFrame({"efast_S1": efast["S1"], "efast_S1_conf": efast["S1_conf"],
+                          "efast_ST": efast["ST"], "efast_ST_conf": efast["ST_conf"],
+                          "morris_mu_star": morris["mu_star"], "morris_mu_star_conf": morris["mu_star_conf"],
+                          "morris_sigma": morris["sigma"], "morris_mu_star_normalized": normalized_mu_star},
+                         index=problem["names"])
+    table["efast_rank"] = table["efast_ST"].rank(ascending=False)
+    table["morris_rank"] = table["morris_mu_star"].rank(ascending=False)
+    return table.sort_values("efast_ST", ascending=False)
+
+
+def cost_report(costs, num_vars, sobol_n_samples=32):
+    """
+    The costs of the screening methods, next to the costs first and second order Sobol would have had on the same plots.
+    """
+    report = pd.DataFrame(costs)
+    for order, sobol_per_plot in [("first", sobol_n_samples * (num_vars + 2)),
+                                  ("second", sobol_n_samples * (2 * num_vars + 2))]:
+        report[f"sobol_{order}_order_simulations_per_plot"] = sobol_per_plot
+        report[f"fraction_of_sobol_{order}_order"] = report["simulations_per_plot"] / sobol_per_plot
+    report["simulations_per_s"] = report["simulated_now"] / report["run_time_s"]
+    return report
+
+
+if __name__ == "__main__":
+
+    # Separate from the calibration store: the large samples would evict the entries of the EAs
+    configure_memo_store("output/memo_sensitivity.sqlite") # Shared by the sensitivity analyses
+    sims_data = read_sims_table(limit=2000) # Screening is cheap enough for thousands of plots
+    simulations = sims_data.to_dict(orient="records")
+    # Plots that would fail every evaluation are quarantined before the sample is run
+    simulations, quarantine = preflight(simulations, n_jobs=70)
+    print_preflight_report(simulations, quarantine)
+    quarantine.to_csv("output/screening_quarantine.csv", index=False)
+    # The rows with the same inputs are simulated once, their indices are shared
+    plan = SimulationPlan(simulations)
+    plan.print_report()
+    problem = ParameterSpace().problem # All the crop and soil parameters of wof_ea_interface.py
+    resume = True # True: the simulations of a previous run are not run again, False: start over
+
+    # eFAST: N*D simulations per plot, N must be > 4*M**2. M=2 keeps it under half the cost of first order Sobol
+    M = 2
+    efast_paramsets = fast_sampler.sample(problem, 4 * M**2 + 1, M=M, seed=42)
+    efast_results, efast_cost = run_screening("efast", plan.units, problem, efast_paramsets,
+                                              partial(efast_indices, problem=problem, M=M, seed=42),
+                                              n_workers=70, resume=resume)
+
+    # Morris: r trajectories of D+1 simulations per plot
+    # (the samples are seeded, so a resumed study and its analysis get the same sample again)
+    num_levels = 4
+    morris_paramsets = morris_sample.sample(problem, 10, num_levels=num_levels, seed=42)
+    morris_results, morris_cost = run_screening("morris", plan.units, problem, morris_paramsets,
+                                                partial(morris_indices, problem=problem, X=morris_paramsets,
+                                                        num_levels=num_levels, seed=42),
+                                                n_workers=70, resume=resume)
+
+    efast_results, morris_results = plan.fan_out(efast_results), plan.fan_out(morris_results)
+    table = screening_table(problem, efast_results, morris_results)
+    report = cost_report([efast_cost, morris_cost], problem["num_vars"])
+    report["rows"] = len(simulations) # The plots column counts the work units
+    print(table.round(3))
+    print(report)
+    table.to_csv("screening_results.csv")
+    report.to_csv("screening_cost.csv", index=False)
+    with open("screening_results.pkl", "wb") as f:
+        pickle.dump({"problem": problem, "efast": efast_results, "morris": morris_results,
+                     "table": table, "cost": report}, f)
@@ -1,131 +1,29 @@
-import os
+import shutil
+import pickle
 import numpy as np
-import pandas as pd
-import pcse
-from tqdm import tqdm
-import pyarrow as pa
-import pyarrow.parquet as pq
-from wof_tools.wofost_exec import disable_logging
-from pcse.input import YAMLCropDataProvider
-from pcse.input import CABOFileReader
-from pcse.input import WOFOST73SiteDataProvider
-from pcse.input import YAMLAgroManagementReader
-from pcse.input import CSVWeatherDataProvider
-from pcse.base import ParameterProvider
-from pcse.models import Wofost73_WLP_CWB, Wofost73_PP
-from SALib.sample import saltelli
-from joblib import Parallel, delayed, effective_n_jobs
-from joblib_progress import joblib_progress
-from SALib.analyze import sobol as sobol_analyze
+from wof_tools.memo_store import configure_memo_store
+from wof_tools.wof_ea_interface import ParameterSpace
+from wof_tools.planner import SimulationPlan
+from wof_tools.preflight import preflight, print_preflight_report
+from wof_tools.sensitivity import SampleStudy, analyze_sobol, adaptive_sobol
+from wof_tools.sims_table import read_sims_table
+from wof_tools.instrumentation import configure_instrumentation, run_report, print_run_report
 from SALib.sample import sobol as sobol_sample
-import pickle
-import yaml
 
 def set_up_full_problem(calc_second_order=False,
-                        n_samples= 32):
+                        n_samples= 32,
+                        seed=None):
     """
     Creates the problem dictionaries for sensitivity analysis.
+    With a seed, the sample of n_samples starts with the sample of any smaller power of two (see adaptive_sobol).
     """
-    RANGES_VAR = {"TSUM1": (100, 2000),
-                  "TSUM2": (100, 2000),
-                  "SPAN":  (10, 70),
-                  "CFET": (0.1, 1.0),
-                  "CVL": (0.1, 1.0),
-                  "CVO": (0.1, 1.0),
-                  "CVR": (0.1, 1.0),
-                  "CVS": (0.1, 1.0),
-                  "TBASE": (0, 15),
-                  "TBASEM": (0, 15),
-                  "VERNBASE": (5, 15),
-                  "RDI": (9, 11),
-                  "RDMCR": (60, 300),
-                  "RGRLAI": (0.001, 0.8),
-                  }
+    problem = ParameterSpace().problem # All the crop and soil parameters of wof_ea_interface.py
 
-    RANGES_SOIL = {"K0": (10, 100),
-                   "SOPE": (0.2, 15),
-                   "KSUB": (0.1, 30),
-                   "RDMSOL": (90, 150),
-    #                "SMW": (0.01, 0.5),
-    #                "SMFCF": (0.01, 0.6),
-    #                "CRAIRC": (0.01, 0.1),
-                   }
-    
-    problem = {
-        "num_vars": len(RANGES_VAR) + len(RANGES_SOIL),
-        "names": list(RANGES_VAR.keys()) + list(RANGES_SOIL.keys()),
-        "bounds": [list(bounds) for bounds in RANGES_VAR.values()] + [list(bounds) for bounds in RANGES_SOIL.values()]
-        }
-
-    paramsets = sobol_sample.sample(problem, n_samples, calc_second_order=calc_second_order)
+    paramsets = sobol_sample.sample(problem, n_samples, calc_second_order=calc_second_order, seed=seed)
     print(f"Generated {len(paramsets)} parameter sets for sensitivity analysis.")
 
     return problem, paramsets
 
-def one_simulation_sensitivity(params_row,
-                               problem,
-                               paramsets,
-                               wofost_data_path="wofost_data/",
-                               output_path="output"):
-    target_results = []
-    os.makedirs(output_path, exist_ok=True)
-    with open("wof_tools/wofost_exec_templates.yaml") as f:
-        templates = yaml.safe_load(f)
-    
-    agro_str = templates["agromanage"].format(
-                 date_campaign=f"{str(params_row['crop_end_date'].year-1)}-01-01",
-                 crop=params_row["crop"],
-                 variety=params_row["variety"],
-                 crop_start= params_row["crop_start_date"].strftime("%Y-%m-%d"),
-                 crop_end=params_row["crop_end_date"].strftime("%Y-%m-%d")
-             )
-
-    agromanag_params = yaml.safe_load(agro_str)
-
-    disable_logging()
-    crop_params = YAMLCropDataProvider(fpath=f"{wofost_data_path}crops_data")
-    crop_params.set_active_crop(params_row["crop"], params_row["variety"])
-    soil_params = CABOFileReader(f"{wofost_data_path}soils_data/{params_row['soil']}.soil")
-    site_params = WOFOST73SiteDataProvider(WAV=100, CO2=410.0)
-    weatherdata = CSVWeatherDataProvider(f"{wofost_data_path}meteo_data/{params_row['id']}.csv")
-
-    parameters = ParameterProvider(cropdata=crop_params,
-                                    soildata=soil_params,
-                                    sitedata=site_params
-                                    )
-    for i, paramset in (enumerate(paramsets)):
-        parameters.clear_override()
-        for name, value in zip(problem["names"], paramset):
-            parameters.set_override(name, value)
-        try:
-            wofsim = Wofost73_WLP_CWB(parameters,
-                                      weatherdata,
-                                      agromanag_params)
-
-            wofsim.run_till_terminate()
-            output = wofsim.get_output()
-            summary_output = wofsim.get_summary_output()
-            target_result = summary_output[0]["TWSO"]
-            if target_result is None:
-                print("Target variable is not available in summary output!")
-            target_results.append(target_result)
-        except Exception as e:
-            print(f"Simulation failed for {params_row['id']}, paramset {i}: {e}")
-            target_results.append(np.nan)  # Append NaN if simulation fails
-    return np.array(target_results)
-
-
-def wrapper_row(row):
-    problem, paramsets = set_up_full_problem(calc_second_order=True)
-    results = one_simulation_sensitivity(
-        row,
-        problem,
-        paramsets,
-        wofost_data_path="wofost_data/",
-        output_path="output"
-    )
-    return problem, results
-
 
 def mean_sobol_indices(results):
     def stack(key):
@@ -150,19 +48,45 @@ def mean_sobol_indices(results):
 
 if __name__ == "__main__":
 
-    with open("src/sims_setup.pickle", 'rb') as f:
-        sims_data = pickle.load(f)
-    simulations = sims_data[:50].to_dict(orient="records")
-
-    with joblib_progress(description ="Parallel process track...",
-                             total=len(simulations)):
-        outputs = Parallel(n_jobs=70)(
-            delayed(wrapper_row)(row) for row in simulations)
-
-    all_problems, all_results = zip(*outputs)
-
-    sensitivity_results = [sobol_analyze.analyze(problem, results, calc_second_order=True) for problem, results in zip(all_problems, all_results)]
-    Si = mean_sobol_indices(sensitivity_results)
-    problem = all_problems[0]
+    # Separate from the calibration store: the large samples would evict the entries of the EAs
+    configure_memo_store("output/memo_sensitivity.sqlite") # Shared by the sensitivity analyses
+    # instrument: time the phases of every simulation in the workers, report in output/instrumentation/sobol
+    instrument = False
+    if instrument:
+        configure_instrumentation("output/instrumentation/sobol")
+    sims_data = read_sims_table(limit=50)
+    simulations = sims_data.to_dict(orient="records")
+    # Plots that would fail every evaluation are quarantined before the sample is run
+    simulations, quarantine = preflight(simulations, n_jobs=70)
+    print_preflight_report(simulations, quarantine)
+    quarantine.to_csv("output/sobol_quarantine.csv", index=False)
+    # The rows with the same inputs are simulated once, their indices are shared
+    plan = SimulationPlan(simulations)
+    plan.print_report()
+    # adaptive: N grows from 32 (up to 1024) on the plots whose indices have not converged yet, otherwise fixed N=32
+    adaptive = False
+    problem, paramsets = set_up_full_problem(calc_second_order=True, n_samples=1024 if adaptive else 32, seed=42)
+
+    study_path = "output/sensitivity/sobol_adaptive" if adaptive else "output/sensitivity/sobol"
+    resume = True # True: the simulations of a previous run are not run again, False: start over
+    if not resume:
+        shutil.rmtree(study_path, ignore_errors=True)
+    # The sample is written once in the study and mapped read-only by the workers. A resumed study keeps the sample
+    # it was started with, even if n_samples or the seed have changed since.
+    study = SampleStudy(study_path, plan.units, problem, paramsets)
+    if adaptive:
+        sensitivity_results, n_used, convergence_log = adaptive_sobol(study, n_start=32, tol=0.05, budget=1_000_000,
+                                                                      calc_second_order=True, n_workers=70,
+                                                                      chunk_size=256, target="TWSO", vectorized=True)
+    else:
+        # (plot, chunk of 256 parameter sets) tasks, simulated by the vectorized engine straight into the outputs array
+        n_simulated = study.run(n_workers=70, chunk_size=256, target="TWSO", vectorized=True)
+        print(f"{n_simulated} simulations run, {study.done.sum()} of {study.done.size} done.")
+        sensitivity_results = analyze_sobol(study, calc_second_order=True)
+
+    if instrument:
+        print_run_report(run_report("output/instrumentation/sobol", "output/instrumentation/sobol_report.json"))
+
+    Si = mean_sobol_indices(plan.fan_out(sensitivity_results))
     with open("sensitivity_results.pkl", "wb") as f:
-        pickle.dump({"problem": problem, "mean_results": Si}, f)
\ No newline at end of file
+        pickle.dump({"problem": problem, "mean_results": Si}, f)
@@ -3,9 +3,13 @@ import pandas as pd
 from datetime import date
 from scipy.spatial import cKDTree
 import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
 import pyarrow.parquet as pq
-from joblib import Parallel, delayed, effective_n_jobs
-from joblib_progress import joblib_progress
+from request_meteoDB import DATASET_PATH, campaign_window
+from wof_tools.sims_table import PLOTS_COORDS_PATH
+
+WEATHER_COLUMNS = ["T2M_MAX", "T2M_MEAN", "T2M_MIN", "SSI_MEAN", "PRECIP_SUM", "WS2M_MEAN", "DEWT2M_MEAN"]
 
 
 def meteo_to_df(input_path):
@@ -73,39 +77,193 @@ def one_day_interpolation(date, weather_df, plots_df):
     return interpolated_df
 
 
-def wrapper_year_interpolation(year, weather_path, plots_path, output_path, n_jobs=-1):
+def idw_weights(silo_xy, xy_targets, k=3, power=2):
+    """
+    Neighbours and normalized IDW weights of every target, computed once for a fixed set of silos.
+    Returns
+    -------
+    idxs, weights: np.array
+        (n_targets, k) indices of the nearest silos and their weights (same formula as idw_interpolation)
+    """
+    tree = cKDTree(silo_xy)
+    dists, idxs = tree.query(xy_targets, k=k)
+    weights = 1 / (dists ** power + 1e-12)
+    weights /= weights.sum(axis=1)[:, None]
+    return idxs, weights
+
+
+def pivot_weather(weather_df, silo_ids=None, silo_xy=None):
+    """
+    Pivot the long weather table into a (date x silo x variable) array.
+    Parameters
+    ----------
+    weather_df: pd.DataFrame
+        Long weather table (silo_id, date_mesure, longitude, latitude, WEATHER_COLUMNS)
+    silo_ids, silo_xy: np.array
+        Sorted ids and coordinates of the silos of the whole file (see weather_silos). By default the silos
+        of weather_df are used, when streaming a file by chunks of dates the silos of the whole file must be given
+        so that every chunk uses the same silos, the same KD-tree and the same "complete" definition.
+    Returns
+    -------
+    dates: np.array
+        The dates in order of appearance in weather_df
+    silo_xy: np.array
+        (n_silos, 2) coordinates of the silos
+    cube: np.array
+        (n_dates, n_silos, n_variables) values of WEATHER_COLUMNS
+    complete: np.array
+        (n_dates,) True when every silo has a row on that date
+    """
+    dates, date_idx = np.unique(weather_df["date_mesure"].to_numpy(), return_inverse=True)
+    order = pd.unique(weather_df["date_mesure"])
+    if silo_ids is None:
+        silo_ids, silo_first, silo_idx = np.unique(weather_df["silo_id"].to_numpy(), return_index=True, return_inverse=True)
+        silo_xy = weather_df[["longitude", "latitude"]].to_numpy()[silo_first]
+    else:
+        silo_idx = np.searchsorted(silo_ids, weather_df["silo_id"].to_numpy())
+    cube = np.full((len(dates), len(silo_ids), len(WEATHER_COLUMNS)), np.nan)
+    cube[date_idx, silo_idx, :] = weather_df[WEATHER_COLUMNS].to_numpy(dtype=float)
+    present = np.zeros((len(dates), len(silo_ids)), dtype=bool)
+    present[date_idx, silo_idx] = True
+    # Back to the order of appearance, as the per-date interpolation did
+    reorder = np.searchsorted(dates, order)
+    return order, silo_xy, cube[reorder], present[reorder].all(axis=1)
+
+
+def interpolate_cube(cube, idxs, weights, chunk_dates=64):
+    """
+    Batched IDW: (n_dates, n_silos, n_var) -> (n_dates, n_targets, n_var), rounded like idw_interpolation.
+    The neighbours are summed in the same order as idw_interpolation, so the values are identical.
+    Dates are processed in chunks to bound the size of the gathered neighbour values.
+    """
+    out = np.empty((cube.shape[0], len(idxs), cube.shape[2]))
+    for start in range(0, cube.shape[0], chunk_dates):
+        block = cube[start:start+chunk_dates]
+        acc = np.zeros((block.shape[0], len(idxs), cube.shape[2]))
+        for j in range(idxs.shape[1]):
+            acc += weights[None, :, j, None] * block[:, idxs[:, j], :]
+        out[start:start+chunk_dates] = np.round(acc, decimals=2)
+    return out
+
+
+def weather_silos(dataset, date_filter=None):
+    """
+    Sorted ids and coordinates of every silo of a weather dataset. Only the three columns are scanned, batch by batch.
+    """
+    silos = []
+    for batch in dataset.to_batches(columns=["silo_id", "longitude", "latitude"], filter=date_filter):
+        silos.append(batch.to_pandas().drop_duplicates("silo_id"))
+    silos = pd.concat(silos, ignore_index=True).drop_duplicates("silo_id").sort_values("silo_id")
+    return silos["silo_id"].to_numpy(), silos[["longitude", "latitude"]].to_numpy(dtype=float)
+
+
+def weather_date_chunks(dataset, chunk_days, date_filter=None):
+    """
+    Split the dates of a weather dataset in consecutive ranges of chunk_days dates.
+    Returns a list of (first, last) arrow scalars, to be used as filters on date_mesure.
+    """
+    dates = [pc.unique(batch.column("date_mesure"))
+             for batch in dataset.to_batches(columns=["date_mesure"], filter=date_filter)]
+    dates = pc.unique(pa.chunked_array(dates))
+    dates = dates.take(pc.sort_indices(dates))
+    return [(dates[start], dates[min(start + chunk_days, len(dates)) - 1])
+            for start in range(0, len(dates), chunk_days)]
+
+
+def interpolate_chunk(weather_df, plots_coords, silo_ids, silo_xy, idxs, weights):
+    """
+    Interpolate a chunk of dates of the weather table on the plots. Same output (and row order) as the per-date
+    interpolation: for each date in order of appearance, one row per plot.
+    The dates where some silo is missing go through the per-date interpolation (their neighbours differ).
+    """
+    dates, _, cube, complete = pivot_weather(weather_df, silo_ids, silo_xy)
+    values = interpolate_cube(cube, idxs, weights)
+    for i in np.flatnonzero(~complete):
+        incomplete = one_day_interpolation(dates[i], weather_df, plots_coords)
+        values[i] = incomplete[WEATHER_COLUMNS].to_numpy()
+
+    n_dates, n_plots = len(dates), len(plots_coords)
+    objective_array = plots_coords.loc[:, ["Longitude", "Latitude"]].to_numpy()
+    chunk_df = pd.DataFrame({"Longitude": np.tile(objective_array[:, 0], n_dates),
+                             "Latitude": np.tile(objective_array[:, 1], n_dates)})
+    for j, col in enumerate(WEATHER_COLUMNS):
+        chunk_df[col] = values[:, :, j].ravel()
+    chunk_df["date_mesure"] = np.repeat(dates, n_plots)
+    chunk_df["PlotId"] = np.tile(plots_coords["PlotId"].values, n_dates)
+    chunk_df["YearId"] = np.tile(plots_coords["YearId"].values, n_dates)
+    return chunk_df, int(np.sum(~complete))
+
+
+def stream_interpolation(jobs, plots_path, output_path, chunk_days=32):
+    """
+    Out-of-core interpolation of several campaign years into one parquet file.
+    Each weather file is read by ranges of chunk_days dates (the filter on date_mesure is pushed down to the
+    parquet row groups, and only the used columns are read), each chunk is interpolated and appended to the output
+    as soon as it is done. The peak memory is then bounded by chunk_days x (silos + plots), whatever the number of
+    years and dates.
+    Parameters
+    ----------
+    jobs: list
+        (year, weather_path) or (year, weather_path, (first_date, last_date)). weather_path is a parquet file
+        (or a directory / list of files, like the year partitioned dataset of request_meteoDB.py) holding the
+        weather of the campaign year, only the plots of that year are interpolated on it.
+        When the dates are given only that window of the weather is used.
+    plots_path: str
+        Parquet file of the plots coordinates (PlotId, YearId, Longitude, Latitude)
+    output_path: str
+        The output parquet file
+    chunk_days: int
+        Number of dates interpolated at once
+    """
+    columns = ["silo_id", "date_mesure", "longitude", "latitude"] + WEATHER_COLUMNS
+    writer = None
+    try:
+        for year, weather_path, *window in jobs:
+            plots_coords = pq.read_table(plots_path, filters=[("YearId", "==", year)]).to_pandas()
+            print(f"{year}: plots DF shape:", plots_coords.shape)
+            dataset = ds.dataset(weather_path, format="parquet", partitioning="hive")
+            window_filter = None
+            if window:
+                first, last = [pa.scalar(date.fromisoformat(str(d))).cast(dataset.schema.field("date_mesure").type)
+                               for d in window[0]]
+                window_filter = (ds.field("date_mesure") >= first) & (ds.field("date_mesure") <= last)
+            # The silos and the plots do not move within a year: one KD-tree and one set of weights per year.
+            silo_ids, silo_xy = weather_silos(dataset, window_filter)
+            idxs, weights = idw_weights(silo_xy, plots_coords.loc[:, ["Longitude", "Latitude"]].to_numpy())
+
+            n_dates, n_incomplete = 0, 0
+            for first, last in weather_date_chunks(dataset, chunk_days, window_filter):
+                date_filter = (ds.field("date_mesure") >= first) & (ds.field("date_mesure") <= last)
+                weather_df = dataset.to_table(columns=columns, filter=date_filter).to_pandas()
+                chunk_df, chunk_incomplete = interpolate_chunk(weather_df, plots_coords, silo_ids, silo_xy, idxs, weights)
+                table = pa.Table.from_pandas(chunk_df, preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(output_path, table.schema)
+                writer.write_table(table.cast(writer.schema))
+                n_dates += weather_df["date_mesure"].nunique()
+                n_incomplete += chunk_incomplete
+            print(f"{year}: {n_dates} dates interpolated, {n_incomplete} of them with missing silos.")
+    finally:
+        if writer is not None:
+            writer.close()
+    print(f"Interpolation complete. Saved to {output_path}")
+
+
+def wrapper_year_interpolation(year, weather_path, plots_path, output_path, chunk_days=32):
     """
     Due to RAM limitations I'll try to manage each interpolation on an annual basis. Following this procces:
         1. Creating Multiple parquet files: one for each campaing year t : [t-1, t]
         2. At each iteration of the current function I filter the plots_coords to retain only the plots on the campaing year
         3. I only interpolate over this filter plots and using the cropped weather data.
+    The year is now streamed by chunks of dates (see stream_interpolation), so the memory no longer depends on the
+    length of the weather file. Several years can go in one file with stream_interpolation directly.
     """
-    weather_df = meteo_to_df(weather_path)
-    print("wheater DF shape:", weather_df.shape)
-    plots_coords = plots_to_df(plots_path)
-    plots_coords = plots_coords.loc[plots_coords["YearId"] == year, :]
-    print("plots DF shape:", plots_coords.shape)
-
-    unique_dates = weather_df["date_mesure"].unique()
-
-    # Parallel processing over dates
-    with joblib_progress("Parallel process track..."):
-        all_interpolated = Parallel(n_jobs=n_jobs)(
-            delayed(one_day_interpolation)(date, weather_df, plots_coords)
-            for date in unique_dates
-        )
-
-    final_df = pd.concat(all_interpolated, ignore_index=True)
-    final_df.to_parquet(output_path, index=False)
-    print(f"Parallel interpolation complete. Saved to {output_path}")
+    stream_interpolation([(year, weather_path)], plots_path, output_path, chunk_days=chunk_days)
 
 
 if __name__ == "__main__":
-    # An exemple of the daily parallel interpolation
-    print("Using all cpu cores: ", effective_n_jobs(-1))
     for year in range(2020, 2025):
-        wrapper_year_interpolation(year = year,
-                                   weather_path=f"src/raw_data/multi_meteo/Agrial_meteo_{year}_13.05.2025.parquet",
-                                   plots_path="src/raw_data/COORDS_pro_parcelles_02.06.2025.parquet",                                                               
-                                   output_path = "src/raw_data/PLOTS_WITH_COORDS_{}_{}.parquet".format(year, date.today().strftime("%d.%m.%Y")),
-                                   n_jobs=-1)
\ No newline at end of file
+        # The weather of each campaign is read from the dataset extracted by request_meteoDB.py
+        stream_interpolation(jobs=[(year, DATASET_PATH, campaign_window(year))],
+                             plots_path=PLOTS_COORDS_PATH,
+                             output_path="src/raw_data/PLOTS_WITH_COORDS_{}_{}.parquet".format(year, date.today().strftime("%d.%m.%Y")))
@@ -1,80 +1,98 @@
 import os
-import math
+import csv
+import time
+import numpy as np
 import pandas as pd
 import pyarrow.parquet as pq
-import random
-import csv
-from joblib import Parallel, delayed, effective_n_jobs
-from joblib_progress import joblib_progress
-
-Wh_to_kJ = lambda x: x * 86.4
-
-def ea_from_tdew(tdew):
-    if tdew < -95.0 or tdew > 65.0:
-        raise ValueError(f'tdew={tdew} is not in range -95 to +60 deg C')
-    tmp = (17.27 * tdew) / (tdew + 237.3)
-    return 0.6108 * math.exp(tmp)
-
-tdew_to_kpa = lambda x: ea_from_tdew(x)
-
-def plots_coords_to_WOFcsv(df_plot):
-    df_pcse = pd.DataFrame({
-        "DAY": df_plot["date_mesure"].dt.strftime("%Y%m%d"),  # YYYYMMDD
-        "TMAX": df_plot["T2M_MAX"],  # °C
-        "TMIN": df_plot["T2M_MIN"],  # °C
-        "TEMP": df_plot["T2M_MEAN"],  # °C
-        "IRRAD": df_plot["SSI_MEAN"].apply(Wh_to_kJ).round(2),  # kJ/m^2
-        "RAIN": df_plot["PRECIP_SUM"],  # mm
-        "WIND": df_plot["WS2M_MEAN"],
-        "VAP": df_plot["DEWT2M_MEAN"].apply(tdew_to_kpa).round(2),  # kPa
-        "SNOWDEPTH": "NaN",  # cm
-    })
-
-    lon = df_plot["Longitude"].unique()
-    lat = df_plot["Latitude"].unique()
-    plot_id = df_plot["PlotId"].unique()
-
-    if len(lon) != 1 or len(lat) != 1 or len(plot_id) != 1:
+from wof_tools.weather_store import tdew_to_kpa_array
+
+WEATHER_COLUMNS = ["PlotId", "date_mesure", "Longitude", "Latitude", "T2M_MAX", "T2M_MIN", "T2M_MEAN",
+                   "SSI_MEAN", "PRECIP_SUM", "WS2M_MEAN", "DEWT2M_MEAN"]
+PCSE_COLUMNS = ["DAY", "TMAX", "TMIN", "TEMP", "IRRAD", "RAIN", "WIND", "VAP", "SNOWDEPTH"]
+
+
+def floats_to_str(values):
+    """
+    Same strings as astype(str) (shortest repr), but only the distinct values are formatted: the weather variables
+    are rounded to 2 decimals so there are few of them. The values are compared bitwise to keep -0.0 apart from 0.0.
+    """
+    bits = np.ascontiguousarray(values, dtype=np.float64).view(np.int64)
+    distinct, inverse = np.unique(bits, return_inverse=True)
+    return distinct.view(np.float64).astype(str)[inverse]
+
+
+def plots_coords_to_WOFtable(df):
+    """
+    Convert a whole year of interpolated weather to the PCSE CSV columns, in one vectorized pass.
+    The rows are sorted once by plot (stable, the dates keep their order), so that each plot is a contiguous range of rows.
+    Returns
+    -------
+    df_pcse: pd.DataFrame
+        The PCSE columns already formatted as strings (the same strings as astype(str) on each plot)
+    plots: pd.DataFrame
+        One row per plot: PlotId, start, stop (row range in df_pcse), LON, LAT
+    """
+    df = df.sort_values("PlotId", kind="stable").reset_index(drop=True)
+    # Only the distinct dates are formatted
+    days, day_idx = np.unique(df["date_mesure"].to_numpy(), return_inverse=True)
+    days = pd.DatetimeIndex(days).strftime("%Y%m%d").to_numpy(dtype=str)
+    columns = {
+        "DAY": days[day_idx],  # YYYYMMDD
+        "TMAX": df["T2M_MAX"],  # °C
+        "TMIN": df["T2M_MIN"],  # °C
+        "TEMP": df["T2M_MEAN"],  # °C
+        "IRRAD": np.round(df["SSI_MEAN"].to_numpy() * 86.4, 2),  # Wh/m^2 -> kJ/m^2
+        "RAIN": df["PRECIP_SUM"],  # mm
+        "WIND": df["WS2M_MEAN"],
+        "VAP": np.round(tdew_to_kpa_array(df["DEWT2M_MEAN"]), 2),  # kPa
+    }
+    df_pcse = pd.DataFrame({col: values if col == "DAY" else floats_to_str(values) for col, values in columns.items()})
+    df_pcse["SNOWDEPTH"] = "NaN"  # cm
+
+    plot_ids = df["PlotId"].to_numpy()
+    starts = np.flatnonzero(np.r_[True, plot_ids[1:] != plot_ids[:-1]])
+    stops = np.r_[starts[1:], len(df)]
+    lon, lat = df["Longitude"].to_numpy(), df["Latitude"].to_numpy()
+    same_plot = plot_ids[1:] == plot_ids[:-1]
+    if np.any(same_plot & ((lon[1:] != lon[:-1]) | (lat[1:] != lat[:-1]))):
         raise ValueError("Inconsistent coordinates or plot IDs in group")
+    plots = pd.DataFrame({"PlotId": plot_ids[starts], "start": starts, "stop": stops,
+                          "LON": lon[starts], "LAT": lat[starts]})
+    return df_pcse, plots
+
+
+def write_WOF_files(df_pcse, plots, base_template, out_dir="wofost_data/meteo_data", elevation=30):
+    """
+    Write one PCSE CSV file per plot. The data rows of all the plots are joined into lines once,
+    each file is then written with a single write of its contiguous range of lines.
+    """
+    lines = list(map(",".join, zip(*[df_pcse[col].to_numpy() for col in PCSE_COLUMNS])))
+
+    for plot_id, start, stop, lon, lat in plots.itertuples(index=False):
+        rows = [[row[0].format(plot_id)] if '{}' in row[0] else [row[0]] for row in base_template]
+        # It shoul be awesome to have a real elevation here
+        rows.append([f"Longitude = {lon}; Latitude = {lat}; Elevation = {elevation}; AngstromA = 0.18; AngstromB = 0.55; HasSunshine = False"])
+        rows.append(["## Daily weather observations (missing values are NaN)"])
+        rows.append(PCSE_COLUMNS)
+        with open(f"{out_dir}/{plot_id}.csv", "w", newline='') as f:
+            csv.writer(f).writerows(rows)
+            # csv.writer ends its lines with \r\n, the data lines need no quoting
+            f.write("\r\n".join(lines[start:stop]))
+            f.write("\r\n")
 
-    plot_info = {"ID": plot_id[0], "LON": lon[0], "LAT": lat[0], "ELEV": 30} # It shoul be awesome to have a real elevation here
-    return df_pcse, plot_info
-
-def fill_csv(plot_id, plot_info, df_pcse, base_template):
-    rows = [[row[0].format(plot_id)] if '{}' in row[0] else [row[0]] for row in base_template]
-    rows.append([f"Longitude = {plot_info['LON']}; Latitude = {plot_info['LAT']}; Elevation = {plot_info['ELEV']}; AngstromA = 0.18; AngstromB = 0.55; HasSunshine = False"])
-    rows.append(["## Daily weather observations (missing values are NaN)"])
-    rows.append(list(df_pcse.columns))
-    rows.extend(df_pcse.astype(str).values.tolist())
-
-    out_path = f"wofost_data/meteo_data/{plot_id}.csv"
-    with open(out_path, "w", newline='') as f:
-        csv.writer(f).writerows(rows)
-
-def process_and_write(plot_id, df_plot, base_template):
-    df_pcse, plot_info = plots_coords_to_WOFcsv(df_plot)
-    fill_csv(plot_id, plot_info, df_pcse, base_template)
 
 if __name__ == "__main__":
-    print("Using all CPU cores:", effective_n_jobs(-1))
-
-    for year in range(2020, 2025):  # TODO: Adjust years here
-        out_dir = f"wofost_data/meteo_data"
-        os.makedirs(out_dir, exist_ok=True)
-
-        # Load full data
-        table = pq.read_table(f"src/raw_data/PLOTS_WITH_COORDS_{year}_02.06.2025.parquet")
-        df = table.to_pandas()
+    out_dir = f"wofost_data/meteo_data"
+    os.makedirs(out_dir, exist_ok=True)
 
-        # Load base template only once
-        with open("src/templates/meteo_wofost.csv", "r", newline='') as f:
-            base_template = list(csv.reader(f))
+    # Load base template only once
+    with open("src/templates/meteo_wofost.csv", "r", newline='') as f:
+        base_template = list(csv.reader(f))
 
-        grouped = list(df.groupby("PlotId"))
-        # grouped = random.sample(grouped, 100)
-
-        with joblib_progress(description="Parallel processing...", total=len(grouped)):
-            Parallel(n_jobs=-1)(
-                delayed(process_and_write)(plot_id, group.reset_index(), base_template)
-                for plot_id, group in grouped
-            )
+    for year in range(2020, 2025):  # TODO: Adjust years here
+        t0 = time.time()
+        df = pq.read_table(f"src/raw_data/PLOTS_WITH_COORDS_{year}_02.06.2025.parquet", columns=WEATHER_COLUMNS).to_pandas()
+        df_pcse, plots = plots_coords_to_WOFtable(df)
+        del df
+        write_WOF_files(df_pcse, plots, base_template, out_dir)
+        print(f"{year}: {len(plots)} weather files written in {time.time() - t0:.1f}s")
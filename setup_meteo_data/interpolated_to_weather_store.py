@@ -0,0 +1,36 @@
+"""
+Builds the binary weather store (one file per campaign year) from the interpolated plots weather.
+It is the columnar alternative to interpolated_to_WOF_files.py: instead of one CSV per plot,
+every plot of a year ends up in wofost_data/meteo_store/weather_{year}.arrow.
+"""
+import os
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+from wof_tools.weather_store import write_weather_store, weather_store_path, tdew_to_kpa_array
+
+
+def plots_coords_to_store_df(df):
+    return pd.DataFrame({
+        "PlotId": df["PlotId"],
+        "DAY": pd.to_datetime(df["date_mesure"]),
+        "Longitude": df["Longitude"],
+        "Latitude": df["Latitude"],
+        "TMAX": df["T2M_MAX"],  # °C
+        "TMIN": df["T2M_MIN"],  # °C
+        "TEMP": df["T2M_MEAN"],  # °C
+        "IRRAD": (df["SSI_MEAN"] * 86.4).round(2),  # kJ/m^2
+        "RAIN": df["PRECIP_SUM"],  # mm
+        "WIND": df["WS2M_MEAN"],
+        "VAP": np.round(tdew_to_kpa_array(df["DEWT2M_MEAN"]), 2),  # kPa
+    })
+
+
+if __name__ == "__main__":
+    os.makedirs("wofost_data/meteo_store", exist_ok=True)
+    for year in range(2020, 2025):  # TODO: Adjust years here
+        table = pq.read_table(f"src/raw_data/PLOTS_WITH_COORDS_{year}_02.06.2025.parquet")
+        store_df = plots_coords_to_store_df(table.to_pandas())
+        output_path = weather_store_path("wofost_data/", year)
+        write_weather_store(store_df, output_path)
+        print(f"{store_df['PlotId'].nunique()} plots written to {output_path}")
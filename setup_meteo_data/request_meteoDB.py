@@ -1,83 +1,179 @@
 # IMPORTANT: This script works only when executing it from a device in the database's host vLAN.
-import pandas as pd
+"""
+Extracts the daily weather of the silos into one parquet dataset partitioned by year (src/raw_data/meteo_dataset/year=YYYY/).
+The rows are streamed from the database by batches (server side cursor with psycopg2) and written as Arrow record batches,
+so nothing is ever held in memory as a whole. A refresh requests the dates after the last date already in the dataset,
+plus a trailing window of the last stored days (overlap_days), which replaces them: the rows of the silos that report
+late are picked up as long as they arrive within that window. The interpolation then reads the window of each campaign from the dataset with a filter
+(see stream_interpolation in IDW_interpolation_to_plots.py).
+Any DB-API connection works (sqlite3 is used as a stand-in to test the extraction).
+"""
+import os
+import glob
+import time
+import uuid
+import sqlite3
+import datetime as dt
 import numpy as np
-import matplotlib.pyplot as plt
-import psycopg2
 import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
 import pyarrow.parquet as pq
-from datetime import date
 
+DATASET_PATH = "src/raw_data/meteo_dataset"
+WEATHER_COLUMNS = ["T2M_MAX", "T2M_MEAN", "T2M_MIN", "SSI_MEAN", "PRECIP_SUM", "WS2M_MEAN", "DEWT2M_MEAN"]
+SCHEMA = pa.schema([("silo_name", pa.string()), ("date_mesure", pa.date32()), ("silo_id", pa.int64()),
+                    ("longitude", pa.float64()), ("latitude", pa.float64())]
+                   + [(col, pa.float64()) for col in WEATHER_COLUMNS])
+PARTITIONING = ds.partitioning(pa.schema([("year", pa.int32())]), flavor="hive")
 
-def query_silos_df():
-    conn = psycopg2.connect(database="meteo",
-                            host="172.26.201.28",
-                            user="postgres",
-                            password="0000",
-                            port="5432")
-    cursor = conn.cursor()
-
-    cursor.execute("""
-                   SELECT silo_id, silo_name, longitude, latitude
-                   FROM silos;
-                   """)
-    answ = cursor.fetchall()
-
-    cursor.close()
-    conn.close()
-    df_silos = pd.DataFrame(answ,
-                            columns=["silo_id",
-                                     "silo_name",
-                                     "longitude",
-                                     "latitude"])
-    return df_silos
-
-def query_weather_df(initial_date = "2019-01-01", final_date = "2024-12-31"):
-    conn = psycopg2.connect(database="meteo",
+
+def connect():
+    import psycopg2
+    return psycopg2.connect(database="meteo",
                             host="172.26.201.28",
                             user="postgres",
                             password="0000",
                             port="5432")
-    cursor = conn.cursor()
-
-    cursor.execute(f"""
-                   SELECT silo_id, date_mesure, T2M_MAX, T2M_MEAN, T2M_MIN, SSI_MEAN, PRECIP_SUM, WS2M_MEAN, DEWT2M_MEAN
-                   FROM daily_weather
-                   WHERE date_mesure >= '{initial_date}' and date_mesure <= '{final_date}'
-                   ;
-                   """)
-    answ = cursor.fetchall()
-    cursor.close()
-    conn.close()
-    df_weather = pd.DataFrame(answ, columns=["silo_id", "date_mesure", "T2M_MAX",
-                                             "T2M_MEAN", "T2M_MIN", "SSI_MEAN",
-                                             "PRECIP_SUM", "WS2M_MEAN", "DEWT2M_MEAN"
-                                             ])
-    return df_weather
-
-def merge_export_df(silos_df, weather_df, output_file):
-    df = pd.merge(left=silos_df,
-                  right=weather_df,
-                  how="left",
-                  on="silo_id")
-    df = df.reindex(["silo_name", "date_mesure", "silo_id",
-                     "longitude", "latitude", "T2M_MAX",
-                     "T2M_MEAN", "T2M_MIN", "SSI_MEAN",
-                     "PRECIP_SUM", "WS2M_MEAN", "DEWT2M_MEAN"],
-                     axis=1)
-    table = pa.Table.from_pandas(df)
-    pq.write_table(table, output_file)
-
-
-def by_year_query_wrapper(year):
-    df_silos = query_silos_df()
-    df_weather = query_weather_df(initial_date = f"{year-2}-01-01",
-                                  final_date = f"{year+1}-06-06")
-    merge_export_df(df_silos, df_weather,
-                    "src/raw_data/multi_meteo/Agrial_meteo_{}_{}.parquet".format(year, date.today().strftime("%d.%m.%Y")))
-# if __name__ == "__main__":
-for year in range(2019, 2025):
-    by_year_query_wrapper(year)
-#     df_silos = query_silos_df()
-#     df_weather = query_weather_df()
-#     df = merge_export_df(df_silos, df_weather,
-#                          "src/raw_data/Agrial_meteo_{}.parquet".format(date.today().strftime("%d.%m.%Y")))
+
+
+def campaign_window(year):
+    """
+    Dates of weather used for the campaign year (the same window as the former per year extractions).
+    """
+    return f"{year-2}-01-01", f"{year+1}-06-06"
+
+
+def _placeholder(conn):
+    return "?" if isinstance(conn, sqlite3.Connection) else "%s"
+
+
+def _stream_cursor(conn, batch_size):
+    if isinstance(conn, sqlite3.Connection):
+        # sqlite3 cursors already step through the result lazily
+        return conn.cursor()
+    # Named cursor: the rows stay on the server and are sent by batches
+    cursor = conn.cursor(name=f"weather_{uuid.uuid4().hex[:8]}")
+    cursor.itersize = batch_size
+    return cursor
+
+
+def stream_weather_batches(conn, initial_date=None, final_date=None, batch_size=100_000):
+    """
+    Yield the weather rows joined with the silos coordinates as Arrow record batches of SCHEMA, ordered by date.
+    Parameters
+    ----------
+    conn:
+        An open DB-API connection (psycopg2 or sqlite3), it is not closed.
+    initial_date, final_date: str
+        Bounds of the dates (both included). None for no bound.
+    """
+    conditions, params = [], []
+    if initial_date is not None:
+        conditions.append(f"w.date_mesure >= {_placeholder(conn)}")
+        params.append(str(initial_date))
+    if final_date is not None:
+        conditions.append(f"w.date_mesure <= {_placeholder(conn)}")
+        params.append(str(final_date))
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    query = f"""
+             SELECT s.silo_name, w.date_mesure, w.silo_id, s.longitude, s.latitude,
+                    w.T2M_MAX, w.T2M_MEAN, w.T2M_MIN, w.SSI_MEAN, w.PRECIP_SUM, w.WS2M_MEAN, w.DEWT2M_MEAN
+             FROM daily_weather w
+             JOIN silos s ON s.silo_id = w.silo_id
+             {where}
+             ORDER BY w.date_mesure, w.silo_id
+             ;
+             """
+    cursor = _stream_cursor(conn, batch_size)
+    try:
+        cursor.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if len(rows) == 0:
+                break
+            # The DB types (numeric, date or text dates in sqlite) are cast to the dataset schema
+            columns = [pa.array(values).cast(field.type) for values, field in zip(zip(*rows), SCHEMA)]
+            yield pa.RecordBatch.from_arrays(columns, schema=SCHEMA)
+    finally:
+        cursor.close()
+
+
+def last_stored_date(dataset_path=DATASET_PATH):
+    """
+    Last date in the dataset, None if it does not exist yet.
+    """
+    if not os.path.isdir(dataset_path) or len(glob.glob(f"{dataset_path}/year=*/*.parquet")) == 0:
+        return None
+    dates = ds.dataset(dataset_path, format="parquet", partitioning=PARTITIONING).to_table(columns=["date_mesure"])
+    return pc.max(dates["date_mesure"]).as_py()
+
+
+def drop_stored_dates(dataset_path, from_date):
+    """
+    Remove the rows dated from_date or later from the files of the dataset (each file is rewritten atomically).
+    """
+    for year in range(from_date.year, last_stored_date(dataset_path).year + 1):
+        for path in glob.glob(f"{dataset_path}/year={year}/part-*.parquet"):
+            table = pq.read_table(path)
+            kept = table.filter(pc.less(table["date_mesure"], pa.scalar(from_date, pa.date32())))
+            if kept.num_rows == table.num_rows:
+                continue
+            if kept.num_rows == 0:
+                os.remove(path)
+                continue
+            tmp_path = f"{os.path.dirname(path)}/.{os.path.basename(path)}.tmp"
+            pq.write_table(kept, tmp_path)
+            os.replace(tmp_path, path)
+
+
+def refresh_weather_dataset(conn, dataset_path=DATASET_PATH, initial_date="2017-01-01", final_date=None, batch_size=100_000,
+                            overlap_days=14):
+    """
+    Download the dates that are not yet in the dataset and append them as new files of the year partitions.
+    The first call downloads everything from initial_date. The last overlap_days stored days are downloaded again and
+    replace the stored ones, for the rows that reached the database after the previous refresh. Rows arriving later
+    than that are only picked up by a new extraction (remove the dataset).
+    Returns the number of rows written.
+    """
+    last = last_stored_date(dataset_path)
+    if last is not None:
+        initial_date = max(dt.date.fromisoformat(str(initial_date)), last - dt.timedelta(days=overlap_days - 1))
+        # Dropped before downloading: if the refresh fails, the dataset ends earlier and the next one fetches them again
+        drop_stored_dates(dataset_path, initial_date)
+    # The files are named after the refresh time, so that listing a partition gives its dates in order
+    token = f"{time.time_ns()}-{uuid.uuid4().hex[:8]}"
+    n_rows, year, writer, written = 0, None, None, []
+    try:
+        # The rows come ordered by date: each year partition gets one new file, written as the batches arrive.
+        for batch in stream_weather_batches(conn, initial_date, final_date, batch_size):
+            years = pc.year(batch.column("date_mesure")).to_numpy()
+            for batch_year in np.unique(years):
+                if batch_year != year:
+                    if writer is not None:
+                        writer.close()
+                    year = batch_year
+                    os.makedirs(f"{dataset_path}/year={year}", exist_ok=True)
+                    written.append(f"{dataset_path}/year={year}/part-{token}.parquet")
+                    writer = pq.ParquetWriter(written[-1], SCHEMA)
+                writer.write_batch(batch.filter(pa.array(years == batch_year)))
+            n_rows += batch.num_rows
+        if writer is not None:
+            writer.close()
+    except BaseException:
+        # Do not leave a partial refresh behind: the next refresh would skip its missing dates
+        if writer is not None:
+            writer.close()
+        for path in written:
+            os.remove(path)
+        raise
+    print(f"{n_rows} rows added to {dataset_path} (dates from {initial_date})")
+    return n_rows
+
+
+if __name__ == "__main__":
+    conn = connect()
+    try:
+        refresh_weather_dataset(conn)
+    finally:
+        conn.close()
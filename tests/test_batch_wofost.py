@@ -0,0 +1,70 @@
+"""
+The batched engine against pcse (Wofost73_WLP_CWB) on the synthetic data tree of the benchmarks: same summary
+variables for every crop and parameter set.
+"""
+import os
+import sys
+import copy
+import numpy as np
+import pytest
+from pcse.base import ParameterProvider
+from pcse.input import WOFOST73SiteDataProvider
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks"))
+from synthetic_data import DEMO_CROPS, build_synthetic_tree
+from wof_tools.batch_wofost import UnsupportedConfiguration, run_wofost_batch
+from wof_tools.input_cache import get_agromanagement, get_crop_params, get_soil_params, get_weather
+from wof_tools.sims_table import read_sims_table
+from wof_tools.wof_ea_interface import ParameterSpace
+from wof_tools.wofost_exec import disable_logging, run_wofost
+
+SUMMARY_VARS = ("TWSO", "TAGP", "DOH")
+N_PARAMSETS = 4
+
+
+@pytest.fixture(scope="module")
+def tree(tmp_path_factory):
+    disable_logging()
+    return build_synthetic_tree(str(tmp_path_factory.mktemp("synthetic")), n_silos=10, n_plots=12)
+
+
+def inputs(paths, row):
+    crop_params = get_crop_params(paths["wofost_data"], row["crop"], row["variety"])
+    soil_params = get_soil_params(paths["wofost_data"], row["soil"])
+    parameters = ParameterProvider(cropdata=crop_params, soildata=soil_params,
+                                   sitedata=WOFOST73SiteDataProvider(WAV=100, CO2=410.0))
+    weatherdata = get_weather(paths["wofost_data"], row["id"], row["crop_end_date"].year)
+    return parameters, weatherdata, get_agromanagement(row)
+
+
+@pytest.mark.parametrize("crop", list(DEMO_CROPS))
+def test_batch_matches_pcse(tree, crop):
+    rows = read_sims_table(tree["sims"], crops=[crop], limit=2).to_dict(orient="records")
+    assert rows, f"No {crop} plot in the synthetic tree"
+    space = ParameterSpace()
+    paramsets = space.sample(N_PARAMSETS, rng=np.random.default_rng(0))
+    for row in rows:
+        parameters, weatherdata, agromanag_params = inputs(tree, row)
+        batch = run_wofost_batch(parameters, weatherdata, agromanag_params, space.names, paramsets,
+                                 summary_vars=SUMMARY_VARS)
+        assert np.all(batch["TAGP"] > 0)
+        for j, paramset in enumerate(paramsets):
+            parameters.clear_override()
+            for name, value in space.overrides(paramset).items():
+                parameters.set_override(name, value)
+            crop_cycle, _ = run_wofost(parameters, weatherdata, agromanag_params, row["crop_end_date"].date(),
+                                       summary_vars=SUMMARY_VARS)
+            assert batch["DOH"][j] == crop_cycle["DOH"]
+            for var in ("TWSO", "TAGP"):
+                assert batch[var][j] == pytest.approx(crop_cycle[var], rel=1e-9, abs=1e-9)
+
+
+def test_unsupported_configuration(tree):
+    row = read_sims_table(tree["sims"], limit=1).to_dict(orient="records")[0]
+    parameters, weatherdata, agromanag_params = inputs(tree, row)
+    agromanag_params = copy.deepcopy(agromanag_params)
+    campaigns = agromanag_params["AgroManagement"] if isinstance(agromanag_params, dict) else agromanag_params
+    calendar = list(campaigns[0].values())[0]["CropCalendar"]
+    calendar["crop_start_type"] = "emergence"
+    with pytest.raises(UnsupportedConfiguration):
+        run_wofost_batch(parameters, weatherdata, agromanag_params, ["TSUM1"], [[800.0]])
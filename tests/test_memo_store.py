@@ -0,0 +1,108 @@
+"""
+Keys, quantization and recency of the memo store.
+"""
+import os
+import time
+import sqlite3
+import multiprocessing
+import pandas as pd
+import pytest
+from wof_tools.memo_store import MemoStore, configure_memo_store, get_memo_store, ENV_PATH, ENV_RESOLUTION, \
+    ENV_MAX_ENTRIES
+
+NAMES = ["TSUM1", "SPAN"]
+RESOLUTION = {"TSUM1": 1.0, "SPAN": 0.5}
+
+
+@pytest.fixture
+def wofost_data(tmp_path):
+    path = tmp_path / "wofost_data"
+    for folder, fname, content in [("meteo_data", "7.csv", "Site\nLongitude,Latitude\n1.0,44.0\n2022-01-01,1,2\n"),
+                                   ("soils_data", "loam.soil", "SMW = 0.1\n"),
+                                   ("crops_data", "wheat.yaml", "Version: 1.0.0\n")]:
+        os.makedirs(path / folder, exist_ok=True)
+        (path / folder / fname).write_text(content)
+    return str(path) + "/"
+
+
+def row():
+    return {"id": 7, "crop": "wheat", "variety": "Winter_wheat_105", "soil": "loam", "real_crop": "Blé tendre d'hiver",
+            "crop_start_date": pd.Timestamp("2021-10-15"), "crop_end_date": pd.Timestamp("2022-07-20")}
+
+
+def child_key(path, wofost_data, paramset, queue):
+    store = MemoStore(path, resolution=RESOLUTION)
+    queue.put(store.key(row(), NAMES, store.quantize(NAMES, paramset), None, wofost_data))
+
+
+def child_lookup(key):
+    # The store of the process is never closed explicitly: its recency is written at exit
+    get_memo_store().get(key)
+
+
+def test_key_is_stable_across_processes(tmp_path, wofost_data):
+    path = str(tmp_path / "memo.sqlite")
+    paramset = [812.3, 31.7]
+    store = MemoStore(path, resolution=RESOLUTION)
+    key = store.key(row(), NAMES, store.quantize(NAMES, paramset), None, wofost_data)
+    # A spawned process has another hash seed, the key must not depend on it
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    process = ctx.Process(target=child_key, args=(path, wofost_data, paramset, queue))
+    process.start()
+    assert queue.get(timeout=60) == key
+    process.join()
+    # Another weather gives another key
+    with open(f"{wofost_data}meteo_data/7.csv", "a") as f:
+        f.write("2022-01-02,1,2\n")
+    assert MemoStore(path, resolution=RESOLUTION).key(row(), NAMES, store.quantize(NAMES, paramset), None,
+                                                      wofost_data) != key
+
+
+def test_quantize_snaps_to_the_key_grid(tmp_path, wofost_data):
+    store = MemoStore(str(tmp_path / "memo.sqlite"), resolution=RESOLUTION)
+    for paramset in [[812.3, 31.7], [812.6, 31.74], [-3.49, 0.26], [1e6 + 0.2, 1e-9]]:
+        quantized = store.quantize(NAMES, paramset)
+        for name, value, snapped in zip(NAMES, paramset, quantized):
+            step = RESOLUTION[name]
+            assert abs(snapped - value) <= step / 2 + 1e-9
+            assert round(snapped / step) * step == snapped
+        # Quantizing again changes nothing, the key is the one of the cell
+        assert store.quantize(NAMES, quantized) == quantized
+        assert store.key(row(), NAMES, quantized, None, wofost_data) == store.key(row(), NAMES, paramset, None,
+                                                                                  wofost_data)
+    cell = store.key(row(), NAMES, store.quantize(NAMES, [812.3, 31.7]), None, wofost_data)
+    assert store.key(row(), NAMES, store.quantize(NAMES, [812.4, 31.6]), None, wofost_data) == cell
+    assert store.key(row(), NAMES, store.quantize(NAMES, [812.6, 31.7]), None, wofost_data) != cell
+
+
+def last_used(path, key):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute("SELECT last_used FROM memo WHERE key = ?", (key,)).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_recency_is_flushed(tmp_path, monkeypatch):
+    path = str(tmp_path / "memo.sqlite")
+    store = MemoStore(path)
+    store.put("a", 1.0)
+    store.put("b", 2.0)
+    written = last_used(path, "a")
+    time.sleep(0.01)
+    assert store.get("a") == 1.0
+    assert last_used(path, "a") == written  # Buffered
+    store.close()
+    assert last_used(path, "a") > written
+
+    # A worker process that exits without closing its store
+    for name in [ENV_PATH, ENV_RESOLUTION, ENV_MAX_ENTRIES]:
+        monkeypatch.setenv(name, "")  # Restored after the test
+    configure_memo_store(path)
+    written = last_used(path, "b")
+    process = multiprocessing.get_context("spawn").Process(target=child_lookup, args=("b",))
+    process.start()
+    process.join(timeout=60)
+    assert process.exitcode == 0
+    assert last_used(path, "b") > written
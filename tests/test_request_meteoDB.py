@@ -0,0 +1,103 @@
+"""
+Streamed extraction and incremental refresh of the weather dataset, on an sqlite database with the tables of the
+meteo database (silos, daily_weather).
+"""
+import os
+import sys
+import sqlite3
+import datetime as dt
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "setup_meteo_data"))
+from request_meteoDB import SCHEMA, PARTITIONING, WEATHER_COLUMNS, stream_weather_batches, last_stored_date, \
+    refresh_weather_dataset
+
+SILOS = [(1, "silo_1", 1.0, 44.0), (2, "silo_2", 2.0, 45.0)]
+
+
+def add_days(conn, first_date, n_days, silo_ids=(1, 2), value=0.0):
+    rows = []
+    for day in range(n_days):
+        date = (first_date + dt.timedelta(days=day)).isoformat()
+        for silo_id in silo_ids:
+            rows.append((silo_id, date, *[value + silo_id + k for k in range(len(WEATHER_COLUMNS))]))
+    conn.executemany(f"INSERT INTO daily_weather VALUES ({', '.join('?' * (2 + len(WEATHER_COLUMNS)))})", rows)
+    conn.commit()
+
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE silos (silo_id INTEGER, silo_name TEXT, longitude REAL, latitude REAL)")
+    conn.execute(f"CREATE TABLE daily_weather (silo_id INTEGER, date_mesure TEXT, "
+                 f"{', '.join(col + ' REAL' for col in WEATHER_COLUMNS)})")
+    conn.executemany("INSERT INTO silos VALUES (?, ?, ?, ?)", SILOS)
+    # Crosses a year boundary: two partitions
+    add_days(conn, dt.date(2021, 12, 20), 30)
+    yield conn
+    conn.close()
+
+
+def read_dataset(path):
+    return (ds.dataset(path, format="parquet", partitioning=PARTITIONING).to_table()
+              .to_pandas().sort_values(["date_mesure", "silo_id"]).reset_index(drop=True))
+
+
+def test_stream_batches(conn):
+    batches = list(stream_weather_batches(conn, "2021-12-25", "2022-01-05", batch_size=7))
+    assert all(batch.schema == SCHEMA for batch in batches)
+    assert [batch.num_rows for batch in batches] == [7, 7, 7, 3]
+    table = pa.Table.from_batches(batches).to_pandas()
+    assert len(table) == 12 * len(SILOS)
+    assert table["date_mesure"].min() == dt.date(2021, 12, 25)
+    assert table["date_mesure"].max() == dt.date(2022, 1, 5)
+    # Ordered by date then silo, joined with the coordinates of the silos
+    assert table[["date_mesure", "silo_id"]].equals(table[["date_mesure", "silo_id"]].sort_values(["date_mesure",
+                                                                                                   "silo_id"]))
+    assert (table.loc[table["silo_id"] == 2, "latitude"] == 45.0).all()
+    assert (table.loc[table["silo_id"] == 1, "T2M_MAX"] == 1.0).all()
+
+
+def test_refresh(conn, tmp_path):
+    path = str(tmp_path / "meteo_dataset")
+    assert refresh_weather_dataset(conn, path, initial_date="2021-01-01", batch_size=16, overlap_days=5) == 60
+    assert sorted(os.listdir(path)) == ["year=2021", "year=2022"]
+    assert last_stored_date(path) == dt.date(2022, 1, 18)
+
+    # New days, a silo reporting late within the trailing window and another one before it
+    add_days(conn, dt.date(2022, 1, 19), 3)
+    add_days(conn, dt.date(2022, 1, 16), 1, silo_ids=(3,))
+    add_days(conn, dt.date(2022, 1, 1), 1, silo_ids=(4,))
+    conn.executemany("INSERT INTO silos VALUES (?, ?, ?, ?)", [(3, "silo_3", 3.0, 46.0), (4, "silo_4", 4.0, 43.0)])
+    conn.commit()
+    # The 5 last stored days are fetched again with the 3 new ones
+    assert refresh_weather_dataset(conn, path, initial_date="2021-01-01", batch_size=16, overlap_days=5) == 8 * 2 + 1
+
+    df = read_dataset(path)
+    assert not df.duplicated(["date_mesure", "silo_id"]).any()
+    assert len(df) == 33 * 2 + 1
+    assert last_stored_date(path) == dt.date(2022, 1, 21)
+    assert ((df["silo_id"] == 3) & (df["date_mesure"] == dt.date(2022, 1, 16))).sum() == 1
+    # Older than the window: not picked up by a refresh
+    assert (df["silo_id"] == 4).sum() == 0
+    assert (df["year"] == df["date_mesure"].map(lambda date: date.year)).all()
+
+
+def test_failed_refresh_is_fetched_again(conn, tmp_path):
+    path = str(tmp_path / "meteo_dataset")
+    refresh_weather_dataset(conn, path, initial_date="2021-01-01", overlap_days=5)
+    add_days(conn, dt.date(2022, 1, 19), 2)
+
+    class FailingConnection:
+        def cursor(self, **kwargs):
+            raise sqlite3.OperationalError("connection lost")
+    with pytest.raises(sqlite3.OperationalError):
+        refresh_weather_dataset(FailingConnection(), path, initial_date="2021-01-01", overlap_days=5)
+    # The trailing window was dropped, the next refresh downloads it again
+    assert last_stored_date(path) == dt.date(2022, 1, 13)
+    refresh_weather_dataset(conn, path, initial_date="2021-01-01", overlap_days=5)
+    df = read_dataset(path)
+    assert len(df) == 32 * 2
+    assert not df.duplicated(["date_mesure", "silo_id"]).any()
@@ -0,0 +1,43 @@
+"""
+SteadyStateEA on a toy fitness evaluated asynchronously by a thread pool.
+"""
+import random
+from concurrent.futures import ThreadPoolExecutor
+import inspyred
+import pytest
+from wof_tools.steady_state import SteadyStateEA
+
+
+def generator(random, args):
+    return [random.uniform(0.0, 1.0) for _ in range(3)]
+
+
+@pytest.mark.parametrize("pop_size, max_in_flight, batch_size, max_evaluations",
+                         [(20, 8, 4, 200), (10, 6, 3, 95), (16, 1, 1, 50)])
+def test_budget_population_and_generations(pop_size, max_in_flight, batch_size, max_evaluations):
+    submitted = []
+    generations = []
+
+    def observer(population, num_generations, num_evaluations, args):
+        generations.append(num_generations)
+        assert len(population) == pop_size
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        def submitter(candidates, args):
+            submitted.append(len(candidates))
+            return executor.submit(lambda: [sum((x - 0.5) ** 2 for x in candidate) for candidate in candidates])
+
+        ea = SteadyStateEA(random.Random(0))
+        ea.observer = observer
+        ea.terminator = inspyred.ec.terminators.evaluation_termination
+        population = ea.evolve(generator, submitter, pop_size=pop_size, maximize=False,
+                               bounder=inspyred.ec.Bounder(0.0, 1.0), max_in_flight=max_in_flight,
+                               batch_size=batch_size, max_evaluations=max_evaluations)
+
+    assert sum(submitted) == ea.num_evaluations == max_evaluations
+    assert max(submitted) <= batch_size
+    assert len(population) == pop_size
+    # Once per generation, a generation being pop_size evaluations after the initial population
+    assert generations == list(range((max_evaluations - pop_size) // pop_size + 1))
+    assert ea.num_generations == generations[-1]
+    assert population[0].fitness == min(individual.fitness for individual in population)
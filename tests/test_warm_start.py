@@ -0,0 +1,86 @@
+"""
+WarmStartArchive.seeds against a brute-force search over the archived calibrations.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+from wof_tools.warm_start import WarmStartArchive, plot_xy
+
+NAMES = ["TSUM1", "TSUM2"]
+N_PLOTS = 60
+
+
+@pytest.fixture(scope="module")
+def archive():
+    rng = np.random.default_rng(0)
+    coordinates = pd.DataFrame({"PlotId": np.arange(N_PLOTS),
+                                "Longitude": rng.uniform(-1.5, 3.5, N_PLOTS),
+                                "Latitude": rng.uniform(43.0, 46.0, N_PLOTS)})
+    n_records = 300
+    records = pd.DataFrame({"plot_id": rng.integers(0, N_PLOTS, n_records),
+                            "year": rng.integers(2018, 2024, n_records),
+                            "crop": rng.choice(["wheat", "maize"], n_records),
+                            "fitness": rng.uniform(0, 1000, n_records),
+                            "TSUM1": rng.uniform(500, 1200, n_records),
+                            "TSUM2": rng.uniform(500, 1200, n_records)})
+    return WarmStartArchive(coordinates, records, names=NAMES)
+
+
+def brute_force(archive, plot_id, crop, year, k, max_fitness):
+    """
+    The expected history and the k nearest admissible records of other plots (with their distance).
+    """
+    records = archive.records
+    if max_fitness is not None:
+        records = records[records["fitness"] <= max_fitness]
+    history = records[(records["plot_id"] == str(plot_id)) & (records["year"] < year)].sort_values("year",
+                                                                                                   ascending=False)
+    others = records[(records["crop"] == crop) & (records["plot_id"] != str(plot_id))]
+    xy = plot_xy(*np.array([archive.coordinates[p] for p in others["plot_id"]]).T)
+    distances = np.linalg.norm(xy - plot_xy(*archive.coordinates[str(plot_id)]), axis=1)
+    return history, others.assign(distance=distances).sort_values("distance").head(k)
+
+
+def distance_to(archive, plot_id, parameters):
+    """
+    Distance from the plot to the archived record holding these parameters.
+    """
+    record = archive.records[(archive.records[NAMES] == parameters).all(axis=1)].iloc[0]
+    return np.linalg.norm(plot_xy(*archive.coordinates[record["plot_id"]])
+                          - plot_xy(*archive.coordinates[str(plot_id)])), record
+
+
+@pytest.mark.parametrize("max_fitness", [None, 500.0, 50.0])
+@pytest.mark.parametrize("plot_id", [0, 7, 33])
+def test_seeds(archive, plot_id, max_fitness):
+    k, year = 5, 2022
+    for crop in ["wheat", "maize"]:
+        history, expected = brute_force(archive, plot_id, crop, year, k, max_fitness)
+        seeds = archive.seeds(plot_id, crop, year, k=k, max_fitness=max_fitness)
+        assert seeds.shape == (len(history) + len(expected), len(NAMES))
+        # The same plot in earlier years first, most recent first
+        np.testing.assert_array_equal(seeds[:len(history)], history[NAMES].to_numpy(dtype=float))
+        neighbours = [distance_to(archive, plot_id, parameters) for parameters in seeds[len(history):]]
+        # The k nearest (ties between the years of a plot may be taken in any order), never the plot itself
+        np.testing.assert_allclose(sorted(distance for distance, _ in neighbours), expected["distance"].to_numpy())
+        for _, record in neighbours:
+            assert record["plot_id"] != str(plot_id)
+            assert record["crop"] == crop
+            assert max_fitness is None or record["fitness"] <= max_fitness
+        fitness = [record["fitness"] for _, record in neighbours]
+        assert fitness == sorted(fitness)
+
+
+def test_max_fitness_widens_the_query(archive):
+    # Few records pass the threshold: the nearest ones are not enough, the query has to widen to the whole crop
+    max_fitness = 30.0
+    passing = archive.records[(archive.records["crop"] == "wheat") & (archive.records["fitness"] <= max_fitness)]
+    assert 0 < len(passing) < 10
+    seeds = archive.seeds(0, "wheat", 2018, k=len(passing) + 5, max_fitness=max_fitness)
+    expected = passing[passing["plot_id"] != "0"]
+    assert len(seeds) == len(expected)
+
+
+def test_unknown_plot(archive):
+    assert archive.seeds("unknown", "wheat", 2022).shape == (0, len(NAMES))
+    assert archive.seeds(0, "rapeseed", 2018).shape == (0, len(NAMES))
@@ -0,0 +1,628 @@
+"""
+Vectorized WOFOST 7.3 water-limited production with the classic water balance (Wofost73_WLP_CWB).
+All the parameter sets of one plot are advanced day by day in lockstep: every state variable is a numpy array
+with one value per parameter set, and the weather, astronomy and reference ET are computed once per day for the
+whole population. It is a port of the pcse modules used by Wofost73_WLP_CWB (DVS_Phenology with vernalisation,
+WOFOST73_Assimilation, WOFOST_Maintenance_Respiration, DVS_Partitioning, Evapotranspiration(CO2), root, stem,
+storage organ and leaf dynamics, WaterbalanceFD), keeping the engine's order of integration and rate calculation.
+Rows that reach the end of their crop cycle are frozen, rows that would crash pcse are NaN.
+Configurations outside of this scope (events, emergence start, overridden tables) raise UnsupportedConfiguration and
+wof_vectorized_simulation falls back to pcse for them. The fallback is timed under the "pcse_fallback" phase of the
+instrumentation and printed once per reason and process.
+
+The __main__ block checks the engine against pcse on a reference set of plots and parameter sets.
+"""
+import time
+import datetime as dt
+import numpy as np
+from pcse.base import ParameterProvider
+from pcse.input import WOFOST73SiteDataProvider
+from pcse.util import Afgen, astro, daylength
+from wof_tools.input_cache import get_agromanagement, get_crop_params, get_soil_params, get_weather
+from wof_tools.memo_store import get_memo_store
+from wof_tools.instrumentation import get_recorder, phase
+from wof_tools.wofost_exec import wof_batch_simulation
+
+SUMMARY_VARS = ("TWSO", "TAGP", "TWLV", "TWST", "TWRT", "DVS", "LAIMAX", "RD", "DOH")
+DEFAULT_RD = 10.  # depth of the upper soil layer without crop (WaterbalanceFD.DEFAULT_RD)
+EMERGING, VEGETATIVE, REPRODUCTIVE, MATURE = 0, 1, 2, 3
+XGAUSS = np.array([0.1127017, 0.5000000, 0.8872983])
+WGAUSS = np.array([0.2777778, 0.4444444, 0.2777778])
+_reported_fallbacks = set()
+
+
+class UnsupportedConfiguration(Exception):
+    """
+    The crop calendar or the overridden parameters are outside of the scope of the batched engine.
+    """
+
+
+class BatchParameters:
+    """
+    Parameter values of a population: the overridden names are arrays with one value per parameter set,
+    all the others are the scalars of the ParameterProvider.
+    """
+    def __init__(self, parameters, names, paramsets):
+        self.parameters = parameters
+        paramsets = np.atleast_2d(np.asarray(paramsets, dtype=float))
+        self.n = len(paramsets)
+        self.overrides = {name: paramsets[:, j] for j, name in enumerate(names)}
+
+    def __contains__(self, name):
+        return name in self.overrides or name in self.parameters
+
+    def __getitem__(self, name):
+        if name in self.overrides:
+            return self.overrides[name]
+        return float(self.parameters[name])
+
+    def get(self, name, default):
+        return self[name] if name in self else default
+
+    def table(self, name):
+        """
+        Return the (x, y) arrays of an AFGEN table, trailing pairs removed as pcse does.
+        """
+        if name in self.overrides:
+            raise UnsupportedConfiguration(f"Table parameter {name} cannot be overridden in the batched engine.")
+        afgen = Afgen(self.parameters[name])
+        return np.array(afgen.x_list), np.array(afgen.y_list)
+
+
+def _interp(x, table):
+    return np.interp(x, table[0], table[1])
+
+
+def driving_variables(weatherdata, days):
+    """
+    Daily driving variables of the whole run as arrays, with the same derived TEMP and DTEMP as the pcse engine,
+    plus the astronomical variables used by the assimilation and the phenology.
+    """
+    drv = {name: np.empty(len(days)) for name in ["TMIN", "TMAX", "TEMP", "DTEMP", "IRRAD", "RAIN", "E0", "ES0",
+                                                  "ET0", "DAYL", "DAYLP", "SINLD", "COSLD", "DIFPP", "DSINBE"]}
+    for i, day in enumerate(days):
+        w = weatherdata(day)
+        temp = w.TEMP if hasattr(w, "TEMP") else (w.TMIN + w.TMAX)/2.
+        dtemp = w.DTEMP if hasattr(w, "DTEMP") else (temp + w.TMAX)/2.
+        DAYL, DAYLP, SINLD, COSLD, DIFPP, ATMTR, DSINBE, ANGOT = astro(day, w.LAT, w.IRRAD)
+        for name, value in [("TMIN", w.TMIN), ("TMAX", w.TMAX), ("TEMP", temp), ("DTEMP", dtemp),
+                            ("IRRAD", w.IRRAD), ("RAIN", w.RAIN), ("E0", w.E0), ("ES0", w.ES0), ("ET0", w.ET0),
+                            ("DAYL", DAYL), ("DAYLP", daylength(day, w.LAT)), ("SINLD", SINLD), ("COSLD", COSLD),
+                            ("DIFPP", DIFPP), ("DSINBE", DSINBE)]:
+            drv[name][i] = value
+    return drv
+
+
+def totass7(DAYL, AMAX, EFF, LAI, KDIF, AVRAD, DIFPP, DSINBE, SINLD, COSLD):
+    """
+    pcse totass7/assim7 (3-point Gaussian integration over the day and over the canopy depth) for arrays
+    AMAX, EFF, LAI and KDIF. The day-level variables are scalars.
+    """
+    SCV = 0.2
+    REFH = (1. - np.sqrt(1. - SCV))/(1. + np.sqrt(1. - SCV))
+    DTGA = np.zeros(np.broadcast(AMAX, LAI).shape)
+    if DAYL <= 0.:
+        return DTGA
+    AMAXC = np.maximum(2.0, AMAX)
+    for hour_x, hour_w in zip(XGAUSS, WGAUSS):
+        HOUR = 12.0 + 0.5*DAYL*hour_x
+        SINB = max(0., SINLD + COSLD*np.cos(2.*np.pi*(HOUR + 12.)/24.))
+        if SINB <= 0.:
+            continue
+        PAR = 0.5*AVRAD*SINB*(1. + 0.4*SINB)/DSINBE
+        PARDIF = min(PAR, SINB*DIFPP)
+        PARDIR = PAR - PARDIF
+        REFS = REFH*2./(1. + 1.6*SINB)
+        KDIRBL = (0.5/SINB)*KDIF/(0.8*np.sqrt(1. - SCV))
+        KDIRT = KDIRBL*np.sqrt(1. - SCV)
+        VISPP = (1. - SCV)*PARDIR/SINB
+        FGROS = 0.
+        for depth_x, depth_w in zip(XGAUSS, WGAUSS):
+            LAIC = LAI*depth_x
+            VISDF = (1. - REFS)*PARDIF*KDIF*np.exp(-KDIF*LAIC)
+            VIST = (1. - REFS)*PARDIR*KDIRT*np.exp(-KDIRT*LAIC)
+            VISD = (1. - SCV)*PARDIR*KDIRBL*np.exp(-KDIRBL*LAIC)
+            VISSHD = VISDF + VIST - VISD
+            FGRSH = AMAX*(1. - np.exp(-VISSHD*EFF/AMAXC))
+            if VISPP <= 0.:
+                FGRSUN = FGRSH
+            else:
+                FGRSUN = AMAX*(1. - (AMAX - FGRSH)*(1. - np.exp(-VISPP*EFF/AMAXC))/(EFF*VISPP))
+            FSLLA = np.exp(-KDIRBL*LAIC)
+            FGROS = FGROS + (FSLLA*FGRSUN + (1. - FSLLA)*FGRSH)*depth_w
+        DTGA = DTGA + FGROS*LAI*hour_w
+    DTGA = DTGA*DAYL
+    return np.where((AMAX > 0.) & (LAI > 0.), DTGA, 0.)
+
+
+def sweaf(ET0, DEPNR):
+    """
+    pcse SWEAF for arrays.
+    """
+    value = 1./(0.76 + 1.5*ET0) - (5. - DEPNR)*0.10
+    if np.any(np.asarray(DEPNR) < 3.):
+        value = np.where(DEPNR < 3., value + (ET0 - 0.6)/(DEPNR*(DEPNR + 3.)), value)
+    return np.clip(value, 0.10, 0.95)
+
+
+def run_wofost_batch(parameters, weatherdata, agromanag_params, names, paramsets, summary_vars=("TWSO", "TAGP", "DOH")):
+    """
+    Run Wofost73_WLP_CWB once per parameter set (overriding names) for one crop calendar.
+    Parameters
+    ----------
+    parameters: ParameterProvider
+        Crop (with the active crop set), soil and site parameters.
+    weatherdata: WeatherDataProvider
+    agromanag_params: dict
+        Parsed agromanagement with a single campaign and no timed/state events.
+    names: list of str
+        Overridden parameter names.
+    paramsets: array (n, len(names))
+    summary_vars: tuple
+        Variables returned, among SUMMARY_VARS.
+    Returns
+    -------
+    dict of arrays (n,) with the summary variables at the end of the crop cycle. Failed rows are NaN (None for DOH).
+    """
+    campaigns = agromanag_params["AgroManagement"] if isinstance(agromanag_params, dict) else agromanag_params
+    if len(campaigns) != 1:
+        raise UnsupportedConfiguration("The batched engine runs a single campaign.")
+    campaign_start, campaign = list(campaigns[0].items())[0]
+    calendar = campaign["CropCalendar"]
+    if campaign.get("TimedEvents") or campaign.get("StateEvents"):
+        raise UnsupportedConfiguration("Timed and state events are not supported by the batched engine.")
+    if calendar["crop_start_type"] != "sowing":
+        raise UnsupportedConfiguration("Only crop_start_type 'sowing' is supported by the batched engine.")
+    crop_start = calendar["crop_start_date"]
+    end_type = calendar["crop_end_type"]
+    max_duration = calendar.get("max_duration")
+    max_end = crop_start + dt.timedelta(days=max_duration) if max_duration is not None else None
+    if end_type in ["harvest", "earliest"]:
+        harvest = calendar["crop_end_date"]
+        last_day = harvest if max_end is None else min(harvest, max_end)
+    else:
+        harvest = None
+        last_day = max_end
+    days = [campaign_start + dt.timedelta(days=i) for i in range((last_day - campaign_start).days + 1)]
+    i_start = (crop_start - campaign_start).days
+    drv = driving_variables(weatherdata, days)
+    tminsum = np.concatenate([[0.], np.cumsum(drv["TMIN"])])
+
+    p = BatchParameters(parameters, names, paramsets)
+    n = p.n
+    tb = {name: p.table(name) for name in ["DTSMTB", "AMAXTB", "TMPFTB", "KDIFTB", "EFFTB", "TMNFTB", "RFSETB",
+                                           "FRTB", "FLTB", "FSTB", "FOTB", "RDRRTB", "RDRSTB", "SSATB", "SLATB"]}
+    CO2 = p.get("CO2", None)
+    co2amax = _interp(CO2, p.table("CO2AMAXTB")) if CO2 is not None and "CO2AMAXTB" in p else 1.
+    co2eff = _interp(CO2, p.table("CO2EFFTB")) if CO2 is not None and "CO2EFFTB" in p else 1.
+    co2tra = _interp(CO2, p.table("CO2TRATB")) if CO2 is not None and "CO2TRATB" in p else 1.
+    IDSL = p["IDSL"]
+    if np.ndim(IDSL) > 0:
+        raise UnsupportedConfiguration("IDSL cannot be overridden in the batched engine.")
+    if IDSL >= 2:
+        tb["VERNRTB"] = p.table("VERNRTB")
+    ninftb = (np.array([0.0, 0.5, 1.5]), np.array([0.0, 0.0, 1.0]))
+    ones = np.ones(n)
+
+    # Soil water balance (WaterbalanceFD.initialize)
+    SMW, SM0, SMFCF, CRAIRC = p["SMW"]*ones, p["SM0"]*ones, p["SMFCF"]*ones, p["CRAIRC"]*ones
+    SOPE, KSUB, RDMSOL = p["SOPE"]*ones, p["KSUB"]*ones, p["RDMSOL"]*ones
+    SSMAX, NOTINF, IFUNRN = p["SSMAX"], p["NOTINF"], p["IFUNRN"]
+    SMLIM = np.clip(p["SMLIM"], SMW, SM0)
+    RDM_soil = np.maximum(DEFAULT_RD, RDMSOL)
+    RDold = DEFAULT_RD*ones
+    SS = p["SSI"]*ones
+    SM = np.clip(SMW + p["WAV"]/DEFAULT_RD, SMW, SMLIM)
+    W = SM*DEFAULT_RD
+    WLOW = np.clip(p["WAV"] + RDM_soil*SMW - W, 0., SM0*(RDM_soil - DEFAULT_RD))
+    DSLR = np.where(SM >= SMW + 0.5*(SMFCF - SMW), 1., 5.)
+    RINold = np.zeros(n)
+    DSOS = np.zeros(n)
+
+    failed = np.zeros(n, dtype=bool)
+    finished = np.zeros(n, dtype=bool)
+    results = {var: np.full(n, np.nan) for var in summary_vars if var != "DOH"}
+    doh = np.full(n, None, dtype=object)
+    crop = None
+
+    def snapshot(rows, i_day):
+        for var in results:
+            results[var][rows] = crop[var][rows]
+        if harvest is not None and days[i_day] == harvest and (max_end is None or days[i_day] != max_end):
+            doh[rows] = days[i_day]
+
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        for i, day in enumerate(days):
+            if i > 0:
+                # ---------------- state integration (crop first, then soil) ----------------
+                if crop is not None:
+                    c = crop
+                    emerged = c["STAGE"] != EMERGING
+                    veg = c["STAGE"] == VEGETATIVE
+                    if IDSL >= 2:
+                        c["VERN"] = c["VERN"] + np.where(veg, rates["VERNR"], 0.)
+                        c["ISVERNALISED"] = np.where(veg, (c["VERN"] >= p["VERNSAT"]) | c["FORCE_VERN"],
+                                                     c["ISVERNALISED"])
+                    c["DVS"] = c["DVS"] + rates["DVR"]
+                    c["TSUM"] = c["TSUM"] + rates["DTSUM"]
+                    # Stage transitions, checked on the stage before integration
+                    to_veg = (c["STAGE"] == EMERGING) & (c["DVS"] >= 0.)
+                    to_rep = veg & (c["DVS"] >= 1.)
+                    to_mat = (c["STAGE"] == REPRODUCTIVE) & (c["DVS"] >= p["DVSEND"])
+                    c["DVS"] = np.where(to_veg, 0., np.where(to_rep, 1., np.where(to_mat, p["DVSEND"], c["DVS"])))
+                    c["STAGE"] = c["STAGE"] + (to_veg | to_rep | to_mat)
+                    DVS = c["DVS"]
+                    # Partitioning, roots, storage organs and stems of the emerged rows
+                    for f, name in [("FR", "FRTB"), ("FL", "FLTB"), ("FS", "FSTB"), ("FO", "FOTB")]:
+                        c[f] = np.where(emerged, _interp(DVS, tb[name]), c[f])
+                    c["WRT"] = c["WRT"] + rates["GWRT"]
+                    c["DWRT"] = c["DWRT"] + rates["DRRT"]
+                    c["TWRT"] = c["WRT"] + c["DWRT"]
+                    c["RD"] = c["RD"] + rates["RR"]
+                    c["WSO"] = c["WSO"] + rates["GWSO"]
+                    c["TWSO"] = c["WSO"] + c["DWSO"]
+                    c["PAI"] = np.where(emerged, c["WSO"]*p["SPA"], c["PAI"])
+                    c["WST"] = c["WST"] + rates["GWST"]
+                    c["DWST"] = c["DWST"] + rates["DRST"]
+                    c["TWST"] = c["WST"] + c["DWST"]
+                    c["SAI"] = np.where(emerged, c["WST"]*_interp(DVS, tb["SSATB"]), c["SAI"])
+                    # Leaves: death from the oldest classes, ageing, then a new class
+                    k = i - i_start
+                    LV = c["LV"][:, :k]
+                    cum = np.cumsum(LV, axis=1)
+                    LV[:] = np.clip(cum - rates["DRLV"][:, None], 0., LV)
+                    c["AGECUM"] = c["AGECUM"] + rates["FYSAGE"]
+                    c["LV"][:, k] = rates["GRLV"]
+                    c["SLA"][:, k] = rates["SLAT"]
+                    c["BIRTH"][:, k] = c["AGECUM"]
+                    c["LASUM"] = np.where(emerged, np.sum(c["LV"][:, :k+1]*c["SLA"][:, :k+1], axis=1), c["LASUM"])
+                    c["LAI"] = np.where(emerged, c["LASUM"] + c["SAI"] + c["PAI"], c["LAI"])
+                    c["LAIMAX"] = np.maximum(c["LAI"], c["LAIMAX"])
+                    c["LAIEXP"] = c["LAIEXP"] + rates["GLAIEX"]
+                    c["WLV"] = np.where(emerged, np.sum(c["LV"][:, :k+1], axis=1), c["WLV"])
+                    c["DWLV"] = c["DWLV"] + rates["DRLV"]
+                    c["TWLV"] = c["WLV"] + c["DWLV"]
+                    c["TAGP"] = np.where(emerged, c["TWLV"] + c["TWST"] + c["TWSO"], c["TAGP"])
+                    c["LV_REALLOCATED"] = c["LV_REALLOCATED"] + rates["REALLOC_LV"]
+                    c["ST_REALLOCATED"] = c["ST_REALLOCATED"] + rates["REALLOC_ST"]
+                    if end_type in ["maturity", "earliest"]:
+                        newly = to_mat & ~finished
+                        snapshot(newly, i)
+                        finished |= newly
+
+                SS = SS + soil_rates["DSS"]
+                W = W + soil_rates["DW"]
+                failed |= W < 0.
+                WLOW = WLOW + soil_rates["DWLOW"]
+                RD = crop["RD"] if crop is not None else DEFAULT_RD*ones
+                RDchange = RD - RDold
+                WDR = np.where(RDchange > 0.001,
+                               np.minimum(WLOW, WLOW*RDchange/(RDMSOL - RDold)),
+                               W*RDchange/RDold)
+                WLOW = WLOW - WDR
+                W = W + WDR
+                SM = W/RD
+                DSOS = np.where(SM >= SM0 - CRAIRC, DSOS + 1, 0)
+                RDold = RD
+
+            # ---------------- agromanagement ----------------
+            if i == i_start:
+                crop = _init_crop(p, tb, n, len(days) - i_start + 1, IDSL)
+            if day == last_day:
+                if crop is None:
+                    raise ValueError("The crop cycle ends before it starts.")
+                snapshot(~finished, i)
+                finished[:] = True
+                break
+            if np.all(finished | failed):
+                break
+
+            # ---------------- rate calculation (crop first, then soil) ----------------
+            TEMP = drv["TEMP"][i]
+            rates = {}
+            crop_tra = None
+            if crop is not None:
+                c = crop
+                DVS = c["DVS"]
+                stage = c["STAGE"]
+                emerged = stage != EMERGING
+                veg = stage == VEGETATIVE
+                # Phenology
+                DVRED = 1.
+                if IDSL >= 1:
+                    DVRED = np.clip((drv["DAYLP"][i] - p["DLC"])/(p["DLO"] - p["DLC"]), 0., 1.)
+                VERNFAC = 1.
+                if IDSL >= 2:
+                    vernalising = veg & ~c["ISVERNALISED"] & (DVS < p["VERNDVS"])
+                    rates["VERNR"] = np.where(vernalising, _interp(TEMP, tb["VERNRTB"]), 0.)
+                    VERNFAC = np.where(vernalising,
+                                       np.clip((c["VERN"] - p["VERNBASE"])/(p["VERNSAT"] - p["VERNBASE"]), 0., 1.), 1.)
+                    c["FORCE_VERN"] |= veg & ~c["ISVERNALISED"] & (DVS >= p["VERNDVS"])
+                DTSUME = np.clip(TEMP - p["TBASEM"], 0., p["TEFFMX"] - p["TBASEM"])
+                DTSM = _interp(TEMP, tb["DTSMTB"])
+                rates["DTSUM"] = np.select([veg, stage == REPRODUCTIVE], [DTSM*VERNFAC*DVRED, DTSM*ones], 0.)
+                rates["DVR"] = np.select([stage == EMERGING, veg, stage == REPRODUCTIVE],
+                                         [0.1*DTSUME/p["TSUMEM"], rates["DTSUM"]/p["TSUM1"], rates["DTSUM"]/p["TSUM2"]],
+                                         0.)
+                # Assimilation, with the 7-day running mean of TMIN since emergence
+                c["N_ASSIM"] = c["N_ASSIM"] + emerged
+                m = np.clip(c["N_ASSIM"], 1, 7)
+                TMINRA = (tminsum[i+1] - tminsum[i+1-m])/m
+                AMAX = _interp(DVS, tb["AMAXTB"])*co2amax*_interp(drv["DTEMP"][i], tb["TMPFTB"])
+                KDIF = _interp(DVS, tb["KDIFTB"])
+                EFF = _interp(drv["DTEMP"][i], tb["EFFTB"])*co2eff
+                DTGA = totass7(drv["DAYL"][i], AMAX, EFF, c["LAI"], KDIF, drv["IRRAD"][i], drv["DIFPP"][i],
+                               drv["DSINBE"][i], drv["SINLD"][i], drv["COSLD"][i])
+                PGASS = DTGA*_interp(TMINRA, tb["TMNFTB"])*30./44.
+                # Evapotranspiration
+                ET0_CROP = np.maximum(0., p["CFET"]*drv["ET0"][i])
+                EKL = np.exp(-0.75*KDIF*c["LAI"])
+                EVWMX = drv["E0"][i]*EKL
+                EVSMX = np.maximum(0., drv["ES0"][i]*EKL)
+                TRAMX = ET0_CROP*(1. - EKL)*co2tra
+                SMCR = (1. - sweaf(ET0_CROP, p["DEPNR"]))*(SMFCF - SMW) + SMW
+                RFWS = np.clip((SM - SMW)/(SMCR - SMW), 0., 1.)
+                RFOS = 1.
+                if p.get("IAIRDU", 0.) == 0 and p.get("IOX", 0.) == 1:
+                    RFOSMX = np.clip((SM0 - SM)/CRAIRC, 0., 1.)
+                    RFOS = RFOSMX + (1. - np.minimum(DSOS, 4)/4.)*(1. - RFOSMX)
+                RFTRA = RFOS*RFWS
+                TRA = TRAMX*RFTRA
+                crop_tra = (np.where(emerged, TRA, 0.),
+                            np.where(emerged, EVWMX, drv["E0"][i]),
+                            np.where(emerged, EVSMX, drv["ES0"][i]))
+                # Respiration, conversion and partitioning
+                GASS = PGASS*RFTRA
+                PMRES = (p["RMR"]*c["WRT"] + p["RML"]*c["WLV"] + p["RMS"]*c["WST"] + p["RMO"]*c["WSO"]) \
+                    * _interp(DVS, tb["RFSETB"])*p["Q10"]**((TEMP - 25.)/10.)
+                MRES = np.minimum(GASS, PMRES)
+                ASRC = GASS - MRES
+                FR, FL, FS, FO = c["FR"], c["FL"], c["FS"], c["FO"]
+                CVF = 1./((FL/p["CVL"] + FS/p["CVS"] + FO/p["CVO"])*(1. - FR) + FR/p["CVR"])
+                DMI = CVF*ASRC
+                checksum = (GASS - MRES - (FR + (FL + FS + FO)*(1. - FR))*DMI/CVF)/np.maximum(0.0001, GASS)
+                failed |= emerged & ~(np.abs(checksum) < 0.0001)
+                # Reallocation from stems and leaves to the storage organs after REALLOC_DVS
+                realloc = emerged & (DVS >= p["REALLOC_DVS"])
+                starting = realloc & np.isnan(c["WST_REALLOC"])
+                c["WST_REALLOC"] = np.where(starting, c["WST"]*p["REALLOC_STEM_FRACTION"], c["WST_REALLOC"])
+                c["WLV_REALLOC"] = np.where(starting, c["WLV"]*p["REALLOC_LEAF_FRACTION"], c["WLV_REALLOC"])
+                REALLOC_LV = np.where(realloc & (c["LV_REALLOCATED"] < c["WLV_REALLOC"]),
+                                      np.minimum(c["WLV_REALLOC"]*p["REALLOC_LEAF_RATE"],
+                                                 c["WLV_REALLOC"] - c["LV_REALLOCATED"]), 0.)
+                REALLOC_ST = np.where(realloc & (c["ST_REALLOCATED"] < c["WST_REALLOC"]),
+                                      np.minimum(c["WST_REALLOC"]*p["REALLOC_STEM_RATE"],
+                                                 c["WST_REALLOC"] - c["ST_REALLOCATED"]), 0.)
+                REALLOC_SO = (REALLOC_LV + REALLOC_ST)*p["REALLOC_EFFICIENCY"]
+                rates["REALLOC_LV"], rates["REALLOC_ST"] = REALLOC_LV, REALLOC_ST
+                ADMI = (1. - FR)*DMI
+                # Roots
+                rates["GRRT"] = FR*DMI
+                rates["DRRT"] = c["WRT"]*_interp(DVS, tb["RDRRTB"])
+                rates["GWRT"] = np.where(emerged, rates["GRRT"] - rates["DRRT"], 0.)
+                rates["DRRT"] = np.where(emerged, rates["DRRT"], 0.)
+                rates["RR"] = np.where(emerged & (FR != 0.), np.minimum(c["RDM"] - c["RD"], p["RRI"]), 0.)
+                # Stems and storage organs
+                DRST = _interp(DVS, tb["RDRSTB"])*c["WST"]
+                rates["GWST"] = np.where(emerged, ADMI*FS - DRST - REALLOC_ST, 0.)
+                rates["DRST"] = np.where(emerged, DRST, 0.)
+                rates["GWSO"] = np.where(emerged, ADMI*FO + REALLOC_SO, 0.)
+                # Leaves
+                GRLV = ADMI*FL
+                DSLV1 = c["WLV"]*(1. - RFTRA)*p["PERDL"]
+                LAICR = 3.2/KDIF
+                DSLV2 = c["WLV"]*np.clip(0.03*(c["LAI"] - LAICR)/LAICR, 0., 0.03)
+                DSLV = np.maximum(DSLV1, DSLV2)
+                k = i - i_start
+                ages = c["AGECUM"][:, None] - c["BIRTH"][:, :k+1]
+                DALV = np.sum(np.where(ages > np.reshape(p["SPAN"], (-1, 1)), c["LV"][:, :k+1], 0.), axis=1)
+                DRLV = np.maximum(DSLV, DALV)
+                FYSAGE = np.maximum(0., (TEMP - p["TBASE"])/(35. - p["TBASE"]))
+                SLAT = _interp(DVS, tb["SLATB"])*ones
+                growing_lai = c["LAIEXP"] < 6.
+                GLAIEX = np.where(growing_lai, c["LAIEXP"]*p["RGRLAI"]*np.maximum(0., TEMP - p["TBASE"]), 0.)
+                GLA = np.minimum(GLAIEX, GRLV*SLAT)
+                SLAT = np.where(growing_lai & (GRLV > 0.), GLA/GRLV, SLAT)
+                rates["GRLV"] = np.where(emerged, GRLV, 0.)
+                rates["DRLV"] = np.where(emerged, DRLV, 0.)
+                rates["FYSAGE"] = np.where(emerged, FYSAGE, 0.)
+                rates["SLAT"] = SLAT
+                rates["GLAIEX"] = np.where(emerged, GLAIEX, 0.)
+                rates["REALLOC_LV"] = np.where(emerged, REALLOC_LV, 0.)
+                rates["REALLOC_ST"] = np.where(emerged, REALLOC_ST, 0.)
+
+            # Soil water balance
+            if crop_tra is None:
+                WTRA, EVWMX, EVSMX = np.zeros(n), drv["E0"][i]*ones, drv["ES0"][i]*ones
+            else:
+                WTRA, EVWMX, EVSMX = crop_tra
+            ponded = SS > 1.
+            wet = ~ponded & (RINold >= 1)
+            dry = ~ponded & ~wet
+            EVW = np.where(ponded, EVWMX, 0.)
+            EVSMXT = EVSMX*(np.sqrt(DSLR + 1) - np.sqrt(DSLR))
+            EVS = np.select([wet, dry], [EVSMX, np.minimum(EVSMX, EVSMXT + RINold)], 0.)
+            DSLR = np.where(wet, 1., np.where(dry, DSLR + 1, DSLR))
+            RAIN = drv["RAIN"][i]
+            if IFUNRN == 0:
+                RINPRE = (1. - NOTINF)*RAIN
+            else:
+                RINPRE = (1. - NOTINF*_interp(RAIN, ninftb))*RAIN
+            RINPRE = RINPRE + SS
+            RINPRE = np.where(SS > 0.1, np.minimum(SOPE, RINPRE - EVW), RINPRE)
+            RD = crop["RD"] if crop is not None else DEFAULT_RD*ones
+            PERC1 = np.clip((W - SMFCF*RD) - WTRA - EVS, 0., SOPE)
+            LOSS = np.clip(WLOW - SMFCF*(RDM_soil - RD) + PERC1, 0., KSUB)
+            PERC2 = ((RDM_soil - RD)*SM0 - WLOW) + LOSS
+            PERC = np.minimum(PERC1, PERC2)
+            RIN = np.minimum(RINPRE, (SM0 - SM)*RD + WTRA + EVS + PERC)
+            RINold = RIN
+            DW = RIN - WTRA - EVS - PERC
+            Wtmp = W + DW
+            EVS = np.where(Wtmp < 0., EVS + Wtmp, EVS)
+            failed |= EVS < 0.
+            DW = np.where(Wtmp < 0., -W, DW)
+            SStmp = RAIN - EVW - RIN
+            soil_rates = {"DW": DW, "DWLOW": PERC - LOSS, "DSS": np.minimum(SStmp, SSMAX - SS)}
+
+    failed |= ~finished
+    for var in results:
+        results[var][failed] = np.nan
+        failed |= np.isnan(results[var])
+    doh[failed] = None
+    if "DOH" in summary_vars:
+        results["DOH"] = doh
+    return results
+
+
+def _init_crop(p, tb, n, n_days, IDSL):
+    """
+    Crop states at sowing (Wofost73.initialize and its components). The leaf classes are stored by day of birth.
+    """
+    ones = np.ones(n)
+    DVS = -0.1*ones
+    c = {"DVS": DVS, "STAGE": np.full(n, EMERGING), "TSUM": np.zeros(n), "N_ASSIM": np.zeros(n, dtype=int)}
+    for f, name in [("FR", "FRTB"), ("FL", "FLTB"), ("FS", "FSTB"), ("FO", "FOTB")]:
+        c[f] = _interp(DVS, tb[name])
+    TDWI = p["TDWI"]*ones
+    c["WRT"], c["DWRT"] = TDWI*c["FR"], np.zeros(n)
+    c["TWRT"] = c["WRT"].copy()
+    c["RD"] = p["RDI"]*ones
+    c["RDM"] = np.maximum(p["RDI"], np.minimum(p["RDMCR"], p["RDMSOL"]))*ones
+    c["WST"], c["DWST"] = TDWI*(1 - c["FR"])*c["FS"], np.zeros(n)
+    c["TWST"] = c["WST"].copy()
+    c["SAI"] = c["WST"]*_interp(DVS, tb["SSATB"])
+    c["WSO"], c["DWSO"] = TDWI*(1 - c["FR"])*c["FO"], np.zeros(n)
+    c["TWSO"] = c["WSO"].copy()
+    c["PAI"] = c["WSO"]*p["SPA"]
+    c["WLV"], c["DWLV"] = TDWI*(1 - c["FR"])*c["FL"], np.zeros(n)
+    c["TWLV"] = c["WLV"].copy()
+    c["LV"] = np.zeros((n, n_days))
+    c["SLA"] = np.zeros((n, n_days))
+    c["BIRTH"] = np.zeros((n, n_days))
+    c["AGECUM"] = np.zeros(n)
+    c["LV"][:, 0] = c["WLV"]
+    c["SLA"][:, 0] = _interp(DVS, tb["SLATB"])
+    c["LASUM"] = c["LV"][:, 0]*c["SLA"][:, 0]
+    c["LAIEXP"] = c["LASUM"].copy()
+    c["LAI"] = c["LASUM"] + c["SAI"] + c["PAI"]
+    c["LAIMAX"] = c["LAI"].copy()
+    c["TAGP"] = c["TWLV"] + c["TWST"] + c["TWSO"]
+    c["LV_REALLOCATED"], c["ST_REALLOCATED"] = np.zeros(n), np.zeros(n)
+    c["WST_REALLOC"], c["WLV_REALLOC"] = np.full(n, np.nan), np.full(n, np.nan)
+    if IDSL >= 2:
+        c["VERN"] = np.zeros(n)
+        c["ISVERNALISED"] = np.zeros(n, dtype=bool)
+        c["FORCE_VERN"] = np.zeros(n, dtype=bool)
+    return c
+
+
+def wof_vectorized_simulation(params_row,
+                              paramsets,
+                              problem,
+                              wofost_data_path="wofost_data/",
+                              output_path="output",
+                              target=None):
+    """
+    Drop-in replacement of wof_batch_simulation: the whole population of a plot is simulated in one call of the
+    batched engine. Returns the crop-specific yield (or target) per parameter set, NaN for the failed ones.
+    Memoized parameter sets are not simulated again (the pcse fallback stores its own results).
+    """
+    recorder = get_recorder()
+    t0 = time.perf_counter()
+    paramsets = np.atleast_2d(np.asarray(paramsets, dtype=float))
+    y_pred = np.full(len(paramsets), np.nan)
+    if len(paramsets) == 0:
+        return y_pred
+    output_var = target
+    if output_var is None:
+        output_var = "TAGP" if params_row["real_crop"] == "Maïs fourrage" else "TWSO"
+    memo = get_memo_store()
+    todo = np.arange(len(paramsets))
+    if memo is not None:
+        # Same keys as wof_one_simulation, so that both engines share the store.
+        with phase(recorder, "memo_lookup"):
+            paramsets = np.array([memo.quantize(problem["names"], paramset) for paramset in paramsets], dtype=float)
+            keys = [memo.key(params_row, problem["names"], paramset, target, wofost_data_path) for paramset in paramsets]
+            for j, key in enumerate(keys):
+                memoized = memo.get(key)
+                if memoized is not None:
+                    y_pred[j] = memoized
+        todo = np.flatnonzero(np.isnan(y_pred))
+    if len(todo) == 0:
+        return y_pred
+    try:
+        with phase(recorder, "crop_params"):
+            crop_params = get_crop_params(wofost_data_path, params_row["crop"], params_row["variety"])
+        with phase(recorder, "soil_params"):
+            soil_params = get_soil_params(wofost_data_path, params_row["soil"])
+        site_params = WOFOST73SiteDataProvider(WAV=100, CO2=410.0)
+        with phase(recorder, "parameter_provider"):
+            parameters = ParameterProvider(cropdata=crop_params, soildata=soil_params, sitedata=site_params)
+        with phase(recorder, "weather"):
+            weatherdata = get_weather(wofost_data_path, params_row["id"], params_row["crop_end_date"].year)
+        with phase(recorder, "agromanagement"):
+            agromanag_params = get_agromanagement(params_row)
+        with phase(recorder, "batch_run"):
+            results = run_wofost_batch(parameters, weatherdata, agromanag_params,
+                                       problem["names"], paramsets[todo], summary_vars=(output_var,))
+        y_pred[todo] = results[output_var]
+    except UnsupportedConfiguration as e:
+        if str(e) not in _reported_fallbacks:
+            _reported_fallbacks.add(str(e))
+            print(f"Batched engine falls back to pcse for {params_row['id']} (and similar plots): {e}")
+        # The pcse fallback records its own simulations
+        if recorder is not None:
+            recorder.current = None
+        with phase(recorder, "pcse_fallback"):
+            y_pred[todo] = wof_batch_simulation(params_row, paramsets[todo], problem, wofost_data_path=wofost_data_path,
+                                                output_path=output_path, target=target)
+        return y_pred
+    except Exception as e:
+        print(f"Batched simulation failed for {params_row['id']}: {e}")
+        if recorder is not None:
+            recorder.failure(e, len(todo))
+            recorder.count(len(todo), len(todo), time.perf_counter() - t0)
+        return y_pred
+    if memo is not None:
+        with phase(recorder, "memo_store"):
+            for j in todo:
+                if not np.isnan(y_pred[j]):
+                    memo.put(keys[j], y_pred[j])
+    if recorder is not None:
+        n_failed = int(np.isnan(y_pred[todo]).sum())
+        if n_failed:
+            recorder.add_failure("batch_run", "NaNResult", n_failed)
+        recorder.count(len(todo), n_failed, time.perf_counter() - t0)
+    return y_pred
+
+
+if __name__ == "__main__":
+    import pandas as pd
+    from SALib.sample import sobol as sobol_sample
+    from wof_tools.wofost_exec import disable_logging
+    from wof_tools.wof_ea_interface import set_up_problem
+    from wof_tools.sims_table import read_sims_table
+
+    # Reference set: a few plots of each crop, Sobol parameter sets over the calibration problem.
+    disable_logging()
+    sims_data = read_sims_table()
+    simulations = sims_data.groupby("crop").head(3).to_dict(orient="records")
+    problem = set_up_problem()
+    paramsets = sobol_sample.sample(problem, 8, calc_second_order=False)
+    report = []
+    for row in simulations:
+        t0 = time.time()
+        y_ref = wof_batch_simulation(row, paramsets, problem)
+        t1 = time.time()
+        y_vec = wof_vectorized_simulation(row, paramsets, problem)
+        t2 = time.time()
+        both = ~np.isnan(y_ref) & ~np.isnan(y_vec)
+        rel_err = np.abs(y_vec[both] - y_ref[both])/np.maximum(np.abs(y_ref[both]), 1.)
+        report.append({"id": row["id"], "crop": row["crop"],
+                       "n": len(paramsets), "nan_mismatch": int(np.sum(np.isnan(y_ref) != np.isnan(y_vec))),
+                       "max_rel_err": rel_err.max() if len(rel_err) else np.nan,
+                       "pcse_s": t1 - t0, "batched_s": t2 - t1})
+    report = pd.DataFrame(report)
+    print(report.to_string(index=False))
+    print(f"Speed-up: {report['pcse_s'].sum()/report['batched_s'].sum():.1f}x")
@@ -0,0 +1,103 @@
+"""
+Append-only checkpoint store for long runs over many plots.
+Each record kind (finished "results", in-progress EA "states", ...) is a directory of small parquet files:
+every append writes a new file and nothing is ever rewritten, so a crash can at worst lose the record being written
+and concurrent writers (the EA threads) never need a lock. Reading concatenates the files and keeps the last record
+of each plot_id (the unit_id of a row when a plot has several seasons). compact() merges the files of a kind into one at the end of a run.
+"""
+import os
+import time
+import glob
+import uuid
+import pickle
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+class CheckpointStore:
+    """
+    Parameters
+    ----------
+    path: str
+        Directory of the store, created if needed. Use a new directory for a new experiment.
+    """
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _kind_dir(self, kind):
+        return os.path.join(self.path, kind)
+
+    def append(self, kind, records):
+        """
+        Append a list of records (dicts with a "plot_id" key) to a kind. The values must be Arrow-convertible
+        (numbers, strings, lists of numbers, bytes).
+        """
+        if len(records) == 0:
+            return
+        os.makedirs(self._kind_dir(kind), exist_ok=True)
+        written_at = time.time()
+        table = pa.Table.from_pylist([{**record, "plot_id": str(record["plot_id"]), "written_at": written_at}
+                                      for record in records])
+        name = f"part-{time.time_ns()}-{uuid.uuid4().hex[:8]}.parquet"
+        tmp_path = os.path.join(self._kind_dir(kind), f".{name}.tmp")
+        pq.write_table(table, tmp_path)
+        # The rename is atomic: readers never see a half-written file.
+        os.replace(tmp_path, os.path.join(self._kind_dir(kind), name))
+
+    def _parts(self, kind):
+        return sorted(glob.glob(os.path.join(self._kind_dir(kind), "part-*.parquet")))
+
+    def read(self, kind, latest=True):
+        """
+        Return the records of a kind as a DataFrame (empty if there are none).
+        With latest=True only the last record of each plot is kept.
+        """
+        parts = self._parts(kind)
+        if len(parts) == 0:
+            return pd.DataFrame(columns=["plot_id", "written_at"])
+        df = pd.concat([pq.read_table(part).to_pandas() for part in parts], ignore_index=True)
+        df = df.sort_values("written_at", kind="stable")
+        if latest:
+            df = df.drop_duplicates("plot_id", keep="last")
+        return df.reset_index(drop=True)
+
+    def completed(self, kind="results"):
+        """
+        Set of plot ids (as strings) with a record of the given kind.
+        """
+        return set(self.read(kind)["plot_id"])
+
+    def latest_state(self, plot_id, kind="states"):
+        """
+        Last in-progress state recorded for a plot, as a dict, or None.
+        """
+        df = self.read(kind)
+        df = df[df["plot_id"] == str(plot_id)]
+        if len(df) == 0:
+            return None
+        return df.iloc[-1].to_dict()
+
+    def compact(self, kind):
+        """
+        Merge the files of a kind into one (keeping only the last record of each plot).
+        """
+        parts = self._parts(kind)
+        if len(parts) <= 1:
+            return
+        df = self.read(kind).drop(columns="written_at")
+        self.append(kind, df.to_dict(orient="records"))
+        for part in parts:
+            os.remove(part)
+
+
+def dump_rng_state(rng):
+    """
+    Serialize the state of a random.Random so that it can be stored as a binary column.
+    """
+    return pickle.dumps(rng.getstate())
+
+
+def load_rng_state(rng, state):
+    rng.setstate(pickle.loads(state))
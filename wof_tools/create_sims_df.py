@@ -1,9 +1,8 @@
 import pcse
-import pickle
 import random # No permanent import, i have to find a deterministic soil assignment
 import pandas as pd
-import pyarrow as pa
 import pyarrow.parquet as pq
+from wof_tools.sims_table import SIMS_TABLE_PATH, PLOTS_COORDS_PATH, write_sims_table
 
 
 GEOFOLIA_WOF_MAP = {
@@ -38,20 +37,28 @@ GEOFOLIA_WOF_MAP = {
     "Seigle hiver": ("wheat", "Winter_wheat_105"),
 }
 
-def generate_simulations_df(plots_df_path):
-    table = pq.read_table(plots_df_path) 
-    base_df = table.to_pandas()
+SOILS = ["ec1", "ec2", "ec3", "ec4", "ec5", "ec6"]
+WOF_CROPS = {name: crop for name, (crop, variety) in GEOFOLIA_WOF_MAP.items()}
+WOF_VARIETIES = {name: variety for name, (crop, variety) in GEOFOLIA_WOF_MAP.items()}
+
+
+def generate_simulations_df(plots_df_path, output_path=SIMS_TABLE_PATH):
+    base_df = pq.read_table(plots_df_path, columns=["PlotId", "CropName", "SowingDate", "HarvestingDate",
+                                                    "RealizedYield"]).to_pandas()
+    # The crop names are mapped once per distinct name, the crops missing from the map stay empty
+    # (the pre-flight check quarantines them)
+    crop_names = base_df["CropName"].astype("category")
     sims = pd.DataFrame({"id": base_df["PlotId"],
-                         "crop": base_df["CropName"].apply(lambda x: GEOFOLIA_WOF_MAP[x][0]),
-                         "variety": base_df["CropName"].apply(lambda x: GEOFOLIA_WOF_MAP[x][1]),
-                         "soil": [random.choice(["ec1", "ec2", "ec3", "ec4", "ec5", "ec6"]) for _ in range(len(base_df))], # This gonna change
+                         "crop": crop_names.map(WOF_CROPS),
+                         "variety": crop_names.map(WOF_VARIETIES),
+                         "soil": random.choices(SOILS, k=len(base_df)), # This gonna change
                         #  "site": ,
                          "crop_start_date": pd.to_datetime(base_df["SowingDate"], format = "%d/%m/%Y %H:%M:%S", errors='coerce'),
                          "crop_end_date": pd.to_datetime(base_df["HarvestingDate"], format = "%d/%m/%Y %H:%M:%S", errors='coerce'),
                          })
     sims["site"] = "wofost_data/sites_data/mean_site.YAML"
-    sims["weather"] = f"wofost_data/meteo_data/{sims['id']}.csv"
-    sims["real_crop"] = base_df["CropName"]
+    sims["weather"] = "wofost_data/meteo_data/" + base_df["PlotId"].astype(str) + ".csv"
+    sims["real_crop"] = crop_names
     sims["RealizedYield"] = base_df["RealizedYield"]
     # TODO: Remove this to work with the entire data
     print("Using a subset of the dataset for testing purposes.")
@@ -61,9 +68,7 @@ def generate_simulations_df(plots_df_path):
     sims = sims.iloc[index_list, :]
     # sims = sims.iloc[:100, :]  # For testing purposes, only 100 simulations
     ## END TODO
-    with open("src/sims_setup.pickle", "wb") as f:
-        pickle.dump(obj=sims, file=f)
+    write_sims_table(sims, output_path)
 
 if __name__ == "__main__":
-    plots_df_path = "src/raw_data/COORDS_pro_parcelles_02.06.2025.parquet" #TODO: Attention this path is dynamic.
-    generate_simulations_df(plots_df_path)
\ No newline at end of file
+    generate_simulations_df(PLOTS_COORDS_PATH)
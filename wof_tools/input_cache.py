@@ -0,0 +1,156 @@
+"""
+Worker-local cache for the WOFOST inputs that do not change between evaluations.
+During a calibration the same plot is simulated hundreds of times with different parameter overrides,
+so the templates, crop, soil, agromanagement and weather objects are parsed once per process and reused.
+Every cache is bounded and evicts the least recently used entry.
+"""
+import os
+import copy
+import yaml
+from collections import OrderedDict
+from pcse.input import YAMLCropDataProvider
+from pcse.input import CABOFileReader
+from pcse.input import CSVWeatherDataProvider
+from wof_tools.weather_store import WeatherStore, StoreWeatherDataProvider, weather_store_path
+
+TEMPLATES_PATH = "wof_tools/wofost_exec_templates.yaml"
+
+
+class LRUCache:
+    """
+    A small bounded mapping with least recently used eviction.
+    The values are built on demand by the loader given to get_or_load.
+    """
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get_or_load(self, key, loader):
+        """
+        Return the cached value for key, calling loader() to build it on a miss.
+        """
+        if key in self._data:
+            self.hits += 1
+            self._data.move_to_end(key)
+            return self._data[key]
+        self.misses += 1
+        value = loader()
+        self._data[key] = value
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+        return value
+
+    def clear(self):
+        self._data.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+_caches = {"templates": LRUCache(maxsize=4),
+           "crop_repository": LRUCache(maxsize=2),
+           "crop": LRUCache(maxsize=32),
+           "soil": LRUCache(maxsize=32),
+           "agromanagement": LRUCache(maxsize=256),
+           "weather_store": LRUCache(maxsize=8),
+           "weather": LRUCache(maxsize=256),
+           }
+
+
+def configure_input_cache(**maxsizes):
+    """
+    Change the size of one or several caches, e.g. configure_input_cache(weather=1024).
+    """
+    for name, maxsize in maxsizes.items():
+        if name not in _caches:
+            raise ValueError(f"Cache {name} not found. Available caches: {list(_caches)}")
+        _caches[name].maxsize = maxsize
+
+
+def clear_input_cache():
+    for cache in _caches.values():
+        cache.clear()
+
+
+def input_cache_stats():
+    """
+    Return the size, hits and misses of every cache of the current process.
+    """
+    return {name: {"size": len(cache), "hits": cache.hits, "misses": cache.misses}
+            for name, cache in _caches.items()}
+
+
+def get_templates(templates_path=TEMPLATES_PATH):
+    def load():
+        with open(templates_path) as f:
+            return yaml.safe_load(f)
+    return _caches["templates"].get_or_load(templates_path, load)
+
+
+def get_agromanagement(params_row, templates_path=TEMPLATES_PATH):
+    """
+    Return the parsed agromanagement of a plot, built from the agromanage template.
+    """
+    key = (params_row["crop"],
+           params_row["variety"],
+           params_row["crop_start_date"].strftime("%Y-%m-%d"),
+           params_row["crop_end_date"].strftime("%Y-%m-%d"))
+
+    def load():
+        agro_str = get_templates(templates_path)["agromanage"].format(
+                     date_campaign=f"{str(params_row['crop_end_date'].year-1)}-01-01",
+                     crop=key[0],
+                     variety=key[1],
+                     crop_start=key[2],
+                     crop_end=key[3]
+                 )
+        return yaml.safe_load(agro_str)
+    return _caches["agromanagement"].get_or_load(key, load)
+
+
+def get_crop_params(wofost_data_path, crop, variety):
+    """
+    Return a crop data provider with the (crop, variety) already active.
+    The YAML repository is read once and every (crop, variety) gets its own shallow copy,
+    so that activating one variety never changes the parameters handed out for another.
+    """
+    fpath = f"{wofost_data_path}crops_data"
+    def load():
+        repository = _caches["crop_repository"].get_or_load(fpath, lambda: YAMLCropDataProvider(fpath=fpath))
+        crop_params = copy.copy(repository)
+        crop_params.set_active_crop(crop, variety)
+        return crop_params
+    return _caches["crop"].get_or_load((fpath, crop, variety), load)
+
+
+def get_soil_params(wofost_data_path, soil):
+    fname = f"{wofost_data_path}soils_data/{soil}.soil"
+    return _caches["soil"].get_or_load(fname, lambda: CABOFileReader(fname))
+
+
+def get_weather_store(store_path):
+    return _caches["weather_store"].get_or_load(store_path, lambda: WeatherStore(store_path))
+
+
+def get_weather(wofost_data_path, plot_id, year=None):
+    """
+    Return the weather provider of a plot.
+    When a binary store exists for the campaign year and holds the plot, the provider reads from it,
+    otherwise the plot's CSV file is parsed.
+    """
+    if year is not None:
+        store_path = weather_store_path(wofost_data_path, year)
+        if os.path.exists(store_path):
+            store = get_weather_store(store_path)
+            if plot_id in store:
+                return _caches["weather"].get_or_load((store_path, str(plot_id)),
+                                                      lambda: StoreWeatherDataProvider(store, plot_id))
+    fname = f"{wofost_data_path}meteo_data/{plot_id}.csv"
+    return _caches["weather"].get_or_load(fname, lambda: CSVWeatherDataProvider(fname))
@@ -0,0 +1,237 @@
+"""
+Opt-in instrumentation of the simulation hot paths.
+When enabled, every process records the time spent in each phase of a simulation (input parsing, ParameterProvider
+setup, model initialization and run, output conversion, memo store...), the failures by phase and exception type and
+its own throughput, and writes them to one JSON file per process. run_report then merges the files of every worker
+into one report (JSON plus a summary table).
+Like the memo store it is configured through environment variables, so that the worker processes inherit it.
+When it is not configured get_recorder returns None and phase() a shared null context: the cost is one dictionary
+lookup per call. The code that catches a simulation error calls recorder.failure(e), which counts it under the phase
+where it was raised.
+"""
+import os
+import json
+import time
+import glob
+import socket
+import contextlib
+from multiprocessing import util
+import pandas as pd
+
+ENV_DIR = "WOF_INSTRUMENTATION_DIR"
+ENV_FLUSH_INTERVAL = "WOF_INSTRUMENTATION_FLUSH_S"
+_NULL_PHASE = contextlib.nullcontext()
+
+
+class _Phase:
+    __slots__ = ("recorder", "name", "t0", "previous")
+
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+
+    def __enter__(self):
+        self.previous = self.recorder.current
+        self.recorder.current = self.name
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.recorder.add_time(self.name, time.perf_counter() - self.t0)
+        if exc_type is None:
+            self.recorder.current = self.previous
+        # On an exception the phase stays current, so that failure() knows where it was raised
+        return False
+
+
+class Recorder:
+    """
+    Timings, failures and throughput of one process. It is flushed to its file every flush_interval seconds
+    and when the process exits.
+    """
+    def __init__(self, directory, flush_interval=10.0):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.pid = os.getpid()
+        self.path = os.path.join(directory, f"worker-{socket.gethostname()}-{self.pid}.json")
+        self.phases = {}  # name -> [count, total_s, max_s]
+        self.failures = {}  # "phase:ExceptionType" -> count
+        self.simulations = 0
+        self.failed = 0
+        self.busy_s = 0.0
+        self.current = None
+        self.started = time.time()
+        self._last_flush = time.perf_counter()
+        os.makedirs(directory, exist_ok=True)
+        # Run by the exit function of multiprocessing, in the workers as well as in the main process
+        util.Finalize(None, self.flush, exitpriority=10)
+
+    def phase(self, name):
+        return _Phase(self, name)
+
+    def add_time(self, name, elapsed):
+        stats = self.phases.get(name)
+        if stats is None:
+            self.phases[name] = [1, elapsed, elapsed]
+        else:
+            stats[0] += 1
+            stats[1] += elapsed
+            if elapsed > stats[2]:
+                stats[2] = elapsed
+
+    def add_failure(self, phase, exception_name, n=1):
+        key = f"{phase}:{exception_name}"
+        self.failures[key] = self.failures.get(key, 0) + n
+
+    def failure(self, exc, n=1):
+        """
+        Count a caught exception that failed n simulations, under the phase it was raised in.
+        """
+        self.add_failure(self.current or "other", type(exc).__name__, n)
+        self.current = None
+
+    def count(self, n, failed, elapsed):
+        """
+        n simulations done in elapsed seconds, failed of them without a result.
+        """
+        self.simulations += n
+        self.failed += failed
+        self.busy_s += elapsed
+        if time.perf_counter() - self._last_flush > self.flush_interval:
+            self.flush()
+
+    def state(self):
+        return {"host": socket.gethostname(),
+                "pid": self.pid,
+                "started": self.started,
+                "updated": time.time(),
+                "simulations": self.simulations,
+                "failed": self.failed,
+                "busy_s": self.busy_s,
+                "phases": {name: {"count": count, "total_s": total, "max_s": max_s}
+                           for name, (count, total, max_s) in self.phases.items()},
+                "failures": dict(self.failures),
+                }
+
+    def flush(self):
+        if os.getpid() != self.pid:  # A forked child must not overwrite the file of its parent
+            return
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.state(), f)
+        os.replace(tmp_path, self.path)
+        self._last_flush = time.perf_counter()
+
+
+def configure_instrumentation(directory, flush_interval=10.0):
+    """
+    Enable the instrumentation for this process and for the worker processes started afterwards.
+    """
+    os.makedirs(directory, exist_ok=True)
+    os.environ[ENV_DIR] = directory
+    os.environ[ENV_FLUSH_INTERVAL] = str(flush_interval)
+
+
+def disable_instrumentation():
+    os.environ.pop(ENV_DIR, None)
+
+
+_recorders = {}
+
+
+def get_recorder():
+    """
+    Return the recorder of the current process, or None when the instrumentation is not configured.
+    """
+    directory = os.environ.get(ENV_DIR)
+    if not directory:
+        return None
+    key = (os.getpid(), directory)
+    recorder = _recorders.get(key)
+    if recorder is None:
+        recorder = _recorders[key] = Recorder(directory, float(os.environ.get(ENV_FLUSH_INTERVAL, 10.0)))
+    return recorder
+
+
+def phase(recorder, name):
+    """
+    Context manager timing a phase, to use with the recorder of get_recorder() (a no-op when it is None).
+    """
+    return _NULL_PHASE if recorder is None else recorder.phase(name)
+
+
+def run_report(directory, output_path=None):
+    """
+    Merge the files of every process of a run.
+    Returns
+    -------
+    report: dict
+        Totals, phases (count, total, mean, max, share of the simulation time), failed simulations by phase and
+        exception type, and one line per process (simulations, failures, busy time, throughput).
+        Written as JSON to output_path if given.
+    """
+    for recorder in _recorders.values():
+        recorder.flush()
+    states = []
+    for path in sorted(glob.glob(os.path.join(directory, "worker-*.json"))):
+        with open(path) as f:
+            states.append(json.load(f))
+
+    phases, failures = {}, {}
+    for state in states:
+        for name, stats in state["phases"].items():
+            merged = phases.setdefault(name, {"count": 0, "total_s": 0.0, "max_s": 0.0})
+            merged["count"] += stats["count"]
+            merged["total_s"] += stats["total_s"]
+            merged["max_s"] = max(merged["max_s"], stats["max_s"])
+        for key, count in state["failures"].items():
+            failures[key] = failures.get(key, 0) + count
+    busy_s = sum(state["busy_s"] for state in states)
+    if "task_roundtrip" in phases and "task" in phases:
+        # Time between the submission of a task and its result that was not spent in the worker: queues, pickling, IPC
+        phases["ipc_and_queue"] = {"count": phases["task_roundtrip"]["count"],
+                                   "total_s": phases["task_roundtrip"]["total_s"] - phases["task"]["total_s"],
+                                   "max_s": None}
+    for stats in phases.values():
+        stats["mean_ms"] = 1000 * stats["total_s"] / stats["count"]
+        stats["share_of_busy"] = stats["total_s"] / busy_s if busy_s > 0 else None
+
+    workers = [{"host": state["host"],
+                "pid": state["pid"],
+                "simulations": state["simulations"],
+                "failed": state["failed"],
+                "busy_s": state["busy_s"],
+                "simulations_per_busy_s": state["simulations"] / state["busy_s"] if state["busy_s"] > 0 else None,
+                "simulations_per_s": state["simulations"] / max(state["updated"] - state["started"], 1e-9)}
+               for state in states if state["simulations"] > 0]
+    by_exception = {}
+    for key, count in failures.items():
+        exception_name = key.split(":", 1)[1]
+        by_exception[exception_name] = by_exception.get(exception_name, 0) + count
+    report = {"processes": len(states),
+              "simulations": sum(state["simulations"] for state in states),
+              "failed": sum(state["failed"] for state in states),
+              "busy_s": busy_s,
+              "phases": phases,
+              "failures": failures,
+              "failures_by_exception": by_exception,
+              "workers": workers,
+              }
+    if output_path is not None:
+        with open(output_path, "w") as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+def print_run_report(report):
+    print(f"{report['simulations']} simulations ({report['failed']} failed) in {report['processes']} processes, "
+          f"{report['busy_s']:.1f}s of simulation time")
+    phases = pd.DataFrame(report["phases"]).T.sort_values("total_s", ascending=False)
+    print(phases.to_string(float_format=lambda x: f"{x:.3f}"))
+    if report["failures"]:
+        print(pd.Series(report["failures"], name="failures").sort_values(ascending=False).to_string())
+    if report["workers"]:
+        workers = pd.DataFrame(report["workers"])
+        print(f"Per worker simulations/s of busy time: min {workers['simulations_per_busy_s'].min():.2f}, "
+              f"median {workers['simulations_per_busy_s'].median():.2f}, "
+              f"max {workers['simulations_per_busy_s'].max():.2f}")
@@ -0,0 +1,188 @@
+"""
+On-disk memoization of simulation results, shared by every worker process and every experiment.
+A result is keyed by the plot inputs and the parameter values quantized to a configurable resolution,
+so re-running an experiment (or a new algorithm) on the same plots does not simulate known points again.
+The inputs are identified by their content (weather, soil and crop files), not only by their names: a regenerated
+weather or another weather source gives new keys instead of stale results.
+The store is a SQLite database in WAL mode, which allows many concurrent readers and writers,
+and the least recently used entries are evicted when it grows over max_entries. The recency of the hits is written
+by batches, a lookup is a read only; the last batch is written when the store is closed, at the latest when the
+process exits.
+
+The store is configured through environment variables so that the worker processes inherit it.
+"""
+import os
+import json
+import time
+import sqlite3
+import hashlib
+from multiprocessing import util
+from wof_tools.planner import weather_fingerprint
+
+ENV_PATH = "WOF_MEMO_STORE"
+ENV_RESOLUTION = "WOF_MEMO_RESOLUTION"
+ENV_MAX_ENTRIES = "WOF_MEMO_MAX_ENTRIES"
+
+
+class MemoStore:
+    """
+    Parameters
+    ----------
+    path: str
+        SQLite file of the store.
+    resolution: float or dict
+        Quantization step of the parameter values, one for all or one per parameter name.
+    max_entries: int
+        Size bound of the store, the least recently used 10% are removed when it is exceeded.
+    """
+    def __init__(self, path, resolution=1e-3, max_entries=1_000_000):
+        self.path = path
+        self.resolution = resolution
+        self.max_entries = max_entries
+        self.pid = os.getpid()
+        self._puts = 0
+        self._touched = set()
+        self._fingerprints = {}
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS memo (key TEXT PRIMARY KEY, value REAL, last_used REAL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS memo_last_used ON memo (last_used)")
+        self.conn.commit()
+        # Run by the exit function of multiprocessing, in the workers as well as in the main process
+        util.Finalize(None, self.close, exitpriority=10)
+
+    def _step(self, name):
+        if isinstance(self.resolution, dict):
+            return self.resolution.get(name, 1e-3)
+        return self.resolution
+
+    def quantize(self, names, paramset):
+        """
+        Snap every parameter value to the center of its resolution cell.
+        """
+        return [round(value / self._step(name)) * self._step(name) for name, value in zip(names, paramset)]
+
+    def inputs_fingerprint(self, params_row, wofost_data_path="wofost_data/"):
+        """
+        Hashes of the weather, soil and crop files a row is simulated with, computed once per process.
+        """
+        year = params_row["crop_end_date"].year
+        source = (wofost_data_path, str(params_row["id"]), year, params_row["soil"], params_row["crop"])
+        if source not in self._fingerprints:
+            self._fingerprints[source] = {
+                "weather": weather_fingerprint(wofost_data_path, params_row["id"], year),
+                "soil": _file_digest(f"{wofost_data_path}soils_data/{params_row['soil']}.soil"),
+                "crop": _file_digest(f"{wofost_data_path}crops_data/{params_row['crop']}.yaml"),
+            }
+        return self._fingerprints[source]
+
+    def key(self, params_row, names, paramset, target=None, wofost_data_path="wofost_data/"):
+        """
+        Content hash of the plot inputs and of the (already quantized) parameter values.
+        The values are keyed by their cell index, so that no formatting rounds two cells together.
+        """
+        content = {"id": str(params_row["id"]),
+                   "crop": params_row["crop"],
+                   "variety": params_row["variety"],
+                   "soil": params_row["soil"],
+                   "real_crop": params_row.get("real_crop"),
+                   "crop_start_date": params_row["crop_start_date"].strftime("%Y-%m-%d"),
+                   "crop_end_date": params_row["crop_end_date"].strftime("%Y-%m-%d"),
+                   "wofost_data_path": wofost_data_path,
+                   "target": target,
+                   "inputs": self.inputs_fingerprint(params_row, wofost_data_path),
+                   "params": {name: round(value / self._step(name)) for name, value in zip(names, paramset)},
+                   }
+        return hashlib.sha1(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+    def get(self, key):
+        """
+        Return the memoized value or None.
+        """
+        row = self.conn.execute("SELECT value FROM memo WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        self._touched.add(key)
+        if len(self._touched) >= 1000:
+            self.flush_recency()
+        return row[0]
+
+    def flush_recency(self):
+        """
+        Write the last use of the keys read since the previous flush, in one transaction.
+        """
+        if not self._touched:
+            return
+        now = time.time()
+        with self.conn:
+            self.conn.executemany("UPDATE memo SET last_used = ? WHERE key = ?", [(now, key) for key in self._touched])
+        self._touched.clear()
+
+    def put(self, key, value):
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO memo (key, value, last_used) VALUES (?, ?, ?)",
+                              (key, float(value), time.time()))
+        self._puts += 1
+        if self._puts % 1000 == 0:
+            self.evict()
+
+    def evict(self):
+        self.flush_recency()
+        with self.conn:
+            n_entries = self.conn.execute("SELECT COUNT(*) FROM memo").fetchone()[0]
+            if n_entries > self.max_entries:
+                n_removed = n_entries - int(0.9 * self.max_entries)
+                self.conn.execute("DELETE FROM memo WHERE key IN "
+                                  "(SELECT key FROM memo ORDER BY last_used LIMIT ?)", (n_removed,))
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM memo").fetchone()[0]
+
+    def close(self):
+        """
+        Write the pending recency and close the connection. get_memo_store opens a new store afterwards.
+        """
+        if self.conn is None or os.getpid() != self.pid:  # A forked child must not use the connection of its parent
+            return
+        self.flush_recency()
+        self.conn.close()
+        self.conn = None
+        if _open_stores.get((self.pid, self.path)) is self:
+            del _open_stores[(self.pid, self.path)]
+
+
+def configure_memo_store(path, resolution=1e-3, max_entries=1_000_000):
+    """
+    Enable the memo store for this process and for the worker processes started afterwards.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    os.environ[ENV_PATH] = path
+    os.environ[ENV_RESOLUTION] = json.dumps(resolution)
+    os.environ[ENV_MAX_ENTRIES] = str(max_entries)
+
+
+def _file_digest(fname):
+    if not os.path.exists(fname):
+        return None
+    with open(fname, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+_open_stores = {}
+
+
+def get_memo_store():
+    """
+    Return the memo store of the current process, or None when it is not configured.
+    Connections are never shared between processes (a forked worker opens its own).
+    """
+    path = os.environ.get(ENV_PATH)
+    if not path:
+        return None
+    key = (os.getpid(), path)
+    if key not in _open_stores:
+        _open_stores[key] = MemoStore(path,
+                                      resolution=json.loads(os.environ.get(ENV_RESOLUTION, "1e-3")),
+                                      max_entries=int(os.environ.get(ENV_MAX_ENTRIES, 1_000_000)))
+    return _open_stores[key]
@@ -0,0 +1,230 @@
+"""
+Batch ask/tell optimizers on the genes of a ParameterSpace ([0, 1]^n_vars), minimizing the fitness.
+    X = optimizer.ask()              # (batch, n_vars) array of candidates
+    optimizer.tell(X, fitness)       # their fitness, e.g. pool.evaluate(unit_id(row), space.decode(X))
+A whole batch is submitted to the worker pool at once, like a population of the EA. run_optimizer drives the loop up
+to an evaluation budget and records the evaluations needed to reach a target fitness, compare_report summarizes
+them per method. CMA-ES and differential evolution usually need far fewer simulations than the GA on smooth,
+low-dimensional landscapes like the TSUM1/TSUM2 calibration.
+"""
+import numpy as np
+import pandas as pd
+
+
+class BatchOptimizer:
+    """
+    Parameters
+    ----------
+    n_vars: int
+        Number of genes.
+    x0: array
+        Starting point (e.g. the typical individual of the crop), None for none.
+    seed: int
+        Seed of the random generator.
+    """
+    def __init__(self, n_vars, x0=None, seed=None):
+        self.n_vars = n_vars
+        self.x0 = None if x0 is None else np.clip(np.asarray(x0, dtype=float), 0.0, 1.0)
+        self.rng = np.random.default_rng(seed)
+        self.n_evaluations = 0
+        self.best_x = None
+        self.best_f = np.inf
+
+    def ask(self):
+        raise NotImplementedError
+
+    def tell(self, X, fitness):
+        X = np.asarray(X, dtype=float)
+        fitness = np.asarray(fitness, dtype=float)
+        self.n_evaluations += len(fitness)
+        best = int(np.argmin(fitness))
+        if fitness[best] < self.best_f:
+            self.best_x, self.best_f = X[best].copy(), float(fitness[best])
+        self._update(X, fitness)
+
+    def _update(self, X, fitness):
+        pass
+
+
+class RandomSearch(BatchOptimizer):
+    """
+    Uniform random candidates (the random search baseline), batch_size per call, x0 first.
+    """
+    def __init__(self, n_vars, x0=None, seed=None, batch_size=20):
+        super().__init__(n_vars, x0, seed)
+        self.batch_size = batch_size
+
+    def ask(self):
+        X = self.rng.random((self.batch_size, self.n_vars))
+        if self.n_evaluations == 0 and self.x0 is not None:
+            X[0] = self.x0
+        return X
+
+
+class CMAES(BatchOptimizer):
+    """
+    (mu/mu_w, lambda)-CMA-ES with the default parameters of Hansen's tutorial (arXiv:1604.00772).
+    The candidates out of [0, 1] are clipped to the bounds and the clipped ones are used in the update.
+    Parameters
+    ----------
+    sigma0: float
+        Initial step size, in gene units.
+    popsize: int
+        Candidates per batch (default 4 + 3 ln(n_vars)).
+    """
+    def __init__(self, n_vars, x0=None, seed=None, sigma0=0.2, popsize=None):
+        super().__init__(n_vars, x0, seed)
+        n = n_vars
+        self.popsize = popsize or 4 + int(3 * np.log(n))
+        self.mu = self.popsize // 2
+        weights = np.log(self.mu + 0.5) - np.log(np.arange(1, self.mu + 1))
+        self.weights = weights / weights.sum()
+        self.mueff = 1.0 / np.sum(self.weights ** 2)
+        self.cc = (4 + self.mueff / n) / (n + 4 + 2 * self.mueff / n)
+        self.cs = (self.mueff + 2) / (n + self.mueff + 5)
+        self.c1 = 2 / ((n + 1.3) ** 2 + self.mueff)
+        self.cmu = min(1 - self.c1, 2 * (self.mueff - 2 + 1 / self.mueff) / ((n + 2) ** 2 + self.mueff))
+        self.damps = 1 + 2 * max(0.0, np.sqrt((self.mueff - 1) / (n + 1)) - 1) + self.cs
+        self.chi_n = np.sqrt(n) * (1 - 1 / (4 * n) + 1 / (21 * n ** 2))
+
+        self.mean = self.x0.copy() if self.x0 is not None else self.rng.random(n)
+        self.sigma = sigma0
+        self.C = np.eye(n)
+        self.pc = np.zeros(n)
+        self.ps = np.zeros(n)
+        self.generation = 0
+
+    def _eigen(self):
+        eigenvalues, B = np.linalg.eigh(self.C)
+        return B, np.sqrt(np.maximum(eigenvalues, 1e-20))
+
+    def ask(self):
+        B, D = self._eigen()
+        z = self.rng.standard_normal((self.popsize, self.n_vars))
+        return np.clip(self.mean + self.sigma * (z * D) @ B.T, 0.0, 1.0)
+
+    def _update(self, X, fitness):
+        n = self.n_vars
+        B, D = self._eigen()
+        order = np.argsort(fitness, kind="stable")[:self.mu]
+        old_mean = self.mean
+        steps = (X[order] - old_mean) / self.sigma
+        y_w = self.weights @ steps
+        self.mean = old_mean + self.sigma * y_w
+        self.generation += 1
+
+        inv_sqrt_C = B @ np.diag(1 / D) @ B.T
+        self.ps = (1 - self.cs) * self.ps + np.sqrt(self.cs * (2 - self.cs) * self.mueff) * inv_sqrt_C @ y_w
+        ps_norm = np.linalg.norm(self.ps) / np.sqrt(1 - (1 - self.cs) ** (2 * self.generation))
+        h_sigma = float(ps_norm / self.chi_n < 1.4 + 2 / (n + 1))
+        self.pc = (1 - self.cc) * self.pc + h_sigma * np.sqrt(self.cc * (2 - self.cc) * self.mueff) * y_w
+        rank_one = np.outer(self.pc, self.pc) + (1 - h_sigma) * self.cc * (2 - self.cc) * self.C
+        rank_mu = (steps * self.weights[:, None]).T @ steps
+        self.C = (1 - self.c1 - self.cmu) * self.C + self.c1 * rank_one + self.cmu * rank_mu
+        self.C = (self.C + self.C.T) / 2
+        # The step size is capped to the width of the gene space
+        self.sigma = min(self.sigma * np.exp((self.cs / self.damps) * (np.linalg.norm(self.ps) / self.chi_n - 1)), 1.0)
+
+
+class DifferentialEvolution(BatchOptimizer):
+    """
+    DE/rand/1/bin: the first batch is the initial population (x0 included), every next batch holds one trial vector
+    per member of the population, which replaces it if it is at least as good.
+    A mutant component out of [0, 1] is put halfway between the target and the violated bound.
+    Parameters
+    ----------
+    popsize: int
+        Size of the population and of the batches (default 10 * n_vars, at least 8).
+    F: float
+        Differential weight.
+    CR: float
+        Crossover probability.
+    """
+    def __init__(self, n_vars, x0=None, seed=None, popsize=None, F=0.7, CR=0.9):
+        super().__init__(n_vars, x0, seed)
+        self.popsize = popsize or max(8, 10 * n_vars)
+        self.F = F
+        self.CR = CR
+        self.population = None
+        self.fitness = None
+
+    def ask(self):
+        if self.population is None:
+            X = self.rng.random((self.popsize, self.n_vars))
+            if self.x0 is not None:
+                X[0] = self.x0
+            return X
+        n, d = self.popsize, self.n_vars
+        # Three distinct members other than the target for each trial
+        others = np.array([self.rng.choice(np.delete(np.arange(n), i), 3, replace=False) for i in range(n)])
+        a, b, c = (self.population[others[:, k]] for k in range(3))
+        mutant = a + self.F * (b - c)
+        mutant = np.where(mutant < 0, self.population / 2, mutant)
+        mutant = np.where(mutant > 1, (self.population + 1) / 2, mutant)
+        cross = self.rng.random((n, d)) < self.CR
+        cross[np.arange(n), self.rng.integers(0, d, n)] = True
+        return np.where(cross, mutant, self.population)
+
+    def _update(self, X, fitness):
+        if self.population is None:
+            self.population, self.fitness = X.copy(), fitness.copy()
+            return
+        improved = fitness <= self.fitness
+        self.population[improved] = X[improved]
+        self.fitness[improved] = fitness[improved]
+
+
+OPTIMIZERS = {"random": RandomSearch, "cmaes": CMAES, "de": DifferentialEvolution}
+
+
+def run_optimizer(optimizer, evaluate, max_evaluations=1000, target=None, stop_at_target=False):
+    """
+    Ask/tell loop until the evaluation budget is spent (the last batch is complete, it may go over the budget).
+    Parameters
+    ----------
+    evaluate: callable
+        evaluate(X) -> fitness array of a batch of genes.
+    target: float
+        Fitness to reach. stop_at_target ends the run as soon as it is reached.
+    Returns
+    -------
+    result: dict
+        best_x, best_f, n_evaluations, evaluations_to_target (the number of evaluations until the first candidate
+        at or below the target, None if it was not reached) and trace (evaluations, best fitness) after each batch.
+    """
+    evaluations_to_target = None
+    trace = []
+    while optimizer.n_evaluations < max_evaluations:
+        X = optimizer.ask()
+        fitness = np.asarray(evaluate(X), dtype=float)
+        if target is not None and evaluations_to_target is None:
+            reached = np.flatnonzero(fitness <= target)
+            if len(reached) > 0:
+                evaluations_to_target = optimizer.n_evaluations + int(reached[0]) + 1
+        optimizer.tell(X, fitness)
+        trace.append((optimizer.n_evaluations, optimizer.best_f))
+        if stop_at_target and evaluations_to_target is not None:
+            break
+    return {"best_x": optimizer.best_x,
+            "best_f": optimizer.best_f,
+            "n_evaluations": optimizer.n_evaluations,
+            "evaluations_to_target": evaluations_to_target,
+            "trace": trace}
+
+
+def compare_report(runs):
+    """
+    Per method summary of runs, a list of dicts with the method, best_f, n_evaluations and evaluations_to_target
+    of one plot: number of plots, share of them reaching the target, median and mean evaluations to the target
+    (over the plots reaching it), median best fitness and median evaluations spent.
+    """
+    df = pd.DataFrame(runs)
+    df["reached"] = df["evaluations_to_target"].notna()
+    df["evaluations_to_target"] = df["evaluations_to_target"].astype(float)
+    report = df.groupby("method").agg(plots=("reached", "size"),
+                                      reached=("reached", "mean"),
+                                      median_evaluations_to_target=("evaluations_to_target", "median"),
+                                      mean_evaluations_to_target=("evaluations_to_target", "mean"),
+                                      median_best_fitness=("best_f", "median"),
+                                      median_evaluations=("n_evaluations", "median"))
+    return report.sort_values("median_evaluations_to_target")
@@ -0,0 +1,124 @@
+"""
+Work planner: the rows of the simulations table that would give the same simulations are run only once.
+Each row is reduced to a content hash of the inputs of its simulations: crop, variety, soil, sowing and harvest dates
+and the content of its weather (not the plot id, two plots with the same weather are the same work). Rows with the same
+hash form one work unit, the experiments run one representative row per unit and the results are fanned back out
+to every row of the unit.
+"""
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from wof_tools.weather_store import WEATHER_VARIABLES, weather_store_path
+from wof_tools.input_cache import get_weather_store
+
+
+def _date_str(date):
+    return "NaT" if pd.isna(date) else date.strftime("%Y-%m-%d")
+
+
+def weather_fingerprint(wofost_data_path, plot_id, year=None):
+    """
+    Hash of the weather a plot is simulated with (the same source as input_cache.get_weather),
+    None when the plot has no weather.
+    """
+    h = hashlib.sha1()
+    if year is not None:
+        store_path = weather_store_path(wofost_data_path, year)
+        if os.path.exists(store_path):
+            store = get_weather_store(store_path)
+            if plot_id in store:
+                site, arrays = store.plot_arrays(plot_id)
+                h.update(json.dumps(site, sort_keys=True).encode())
+                for name in ["DAY"] + WEATHER_VARIABLES:
+                    h.update(arrays[name].tobytes())
+                return h.hexdigest()
+    fname = f"{wofost_data_path}meteo_data/{plot_id}.csv"
+    if not os.path.exists(fname):
+        return None
+    with open(fname, "rb") as f:
+        lines = f.read().splitlines()
+    # The first lines of the header name the plot: only the site line (coordinates) and the observations are hashed
+    site_line = next((i for i, line in enumerate(lines) if line.startswith(b"Longitude")), 0)
+    for line in lines[site_line:]:
+        h.update(line)
+        h.update(b"\n")
+    return h.hexdigest()
+
+
+def work_key(row, weather, extra_keys=()):
+    """
+    Content hash of the inputs of a row's simulations (and of the extra_keys columns, e.g. the realized yield
+    for a calibration whose fitness depends on it).
+    """
+    content = {"crop": row["crop"],
+               "variety": row["variety"],
+               "soil": row["soil"],
+               "crop_start_date": _date_str(row["crop_start_date"]),
+               "crop_end_date": _date_str(row["crop_end_date"]),
+               # Without weather nothing can be shared: the plot stays its own unit
+               "weather": weather if weather is not None else f"missing:{row['id']}",
+               }
+    for name in extra_keys:
+        content[name] = str(row[name])
+    return hashlib.sha1(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+
+class SimulationPlan:
+    """
+    Parameters
+    ----------
+    simulations: list of dict
+        The simulation rows (sims_setup records).
+    wofost_data_path: str
+        Data directory the weather is read from.
+    extra_keys: tuple of str
+        Columns that must also be equal for two rows to share their work (e.g. ("RealizedYield",) for a calibration).
+    n_threads: int
+        Threads hashing the weather files.
+    """
+    def __init__(self, simulations, wofost_data_path="wofost_data/", extra_keys=(), n_threads=16):
+        self.simulations = simulations
+        # One fingerprint per distinct (plot, year): the duplicated rows do not read their weather again
+        sources = list(dict.fromkeys((row["id"], None if pd.isna(row["crop_end_date"]) else row["crop_end_date"].year)
+                                     for row in simulations))
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            fingerprints = dict(zip(sources, executor.map(lambda source: weather_fingerprint(wofost_data_path, *source),
+                                                          sources)))
+        self.keys = [work_key(row, fingerprints[(row["id"], None if pd.isna(row["crop_end_date"])
+                                                 else row["crop_end_date"].year)], extra_keys)
+                     for row in simulations]
+        unique_keys, first, self.unit_of_row = np.unique(self.keys, return_index=True, return_inverse=True)
+        # The units keep the order of their first row
+        order = np.argsort(first)
+        self.unit_of_row = np.argsort(order)[self.unit_of_row]
+        self.units = [simulations[i] for i in first[order]]
+
+    def fan_out(self, unit_results):
+        """
+        Results of the units (in the order of self.units) -> results of every row (in the order of the simulations).
+        """
+        return [unit_results[unit] for unit in self.unit_of_row]
+
+    def report(self):
+        """
+        Number of rows, of units, of rows that duplicate another row of the same plot, of rows sharing the work of
+        another plot, and the dedup ratio (fraction of the rows that are not simulated).
+        """
+        ids = pd.Series([str(row["id"]) for row in self.simulations])
+        units = pd.Series(self.unit_of_row)
+        same_plot = int(pd.DataFrame({"unit": units, "id": ids}).duplicated().sum())
+        return {"rows": len(self.simulations),
+                "units": len(self.units),
+                "duplicated_rows": same_plot,
+                "shared_with_other_plots": len(self.simulations) - len(self.units) - same_plot,
+                "dedup_ratio": 1 - len(self.units) / max(len(self.simulations), 1),
+                }
+
+    def print_report(self):
+        report = self.report()
+        print(f"{report['rows']} simulation rows -> {report['units']} work units "
+              f"(dedup ratio {report['dedup_ratio']:.1%}: {report['duplicated_rows']} duplicated rows, "
+              f"{report['shared_with_other_plots']} rows sharing the inputs of another plot)")
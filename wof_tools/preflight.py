@@ -0,0 +1,144 @@
+"""
+Pre-flight validation of the simulations table: the plots that cannot be simulated are found before any optimization
+budget is spent on them. Every row goes through the same checks as a real run, in order:
+dates (no NaT, sowing before harvest), crop and variety, soil, weather coverage of the campaign window and one
+baseline run with the default parameters. The first failing check puts the row in quarantine with its reason.
+"""
+import math
+import datetime as dt
+import pandas as pd
+from joblib import Parallel, delayed
+from pcse.input import WOFOST73SiteDataProvider
+from pcse.base import ParameterProvider
+from wof_tools.input_cache import get_agromanagement, get_crop_params, get_soil_params, get_weather
+from wof_tools.wofost_exec import disable_logging, run_wofost
+
+CHECKED_KEYS = ("id", "crop", "variety", "soil", "crop_start_date", "crop_end_date")
+
+
+def _is_missing(value):
+    return value is None or (isinstance(value, float) and math.isnan(value)) or value is pd.NaT
+
+
+def check_dates(row):
+    for name in ["crop_start_date", "crop_end_date"]:
+        if pd.isna(row[name]):
+            return f"{name} is missing"
+    if row["crop_start_date"] >= row["crop_end_date"]:
+        return f"crop_start_date {row['crop_start_date'].date()} is not before crop_end_date {row['crop_end_date'].date()}"
+    return None
+
+
+def check_weather(weatherdata, row):
+    """
+    The weather must cover the whole run: from the start of the campaign (January 1st of the year before the harvest,
+    see the agromanage template) to the day after the harvest.
+    """
+    campaign_start = dt.date(row["crop_end_date"].year - 1, 1, 1)
+    run_end = row["crop_end_date"].date() + dt.timedelta(days=1)
+    if weatherdata.first_date > campaign_start or weatherdata.last_date < run_end:
+        return (f"weather from {weatherdata.first_date} to {weatherdata.last_date} "
+                f"does not cover {campaign_start} to {run_end}")
+    return None
+
+
+def check_row(row, wofost_data_path="wofost_data/", baseline=True, target="TWSO"):
+    """
+    Run the checks of one row.
+    Returns
+    -------
+    check: str
+        The first failing check (dates, crop, soil, weather, baseline), None if the row is valid
+    reason: str
+        Why it failed
+    """
+    reason = check_dates(row)
+    if reason is not None:
+        return "dates", reason
+    if _is_missing(row["crop"]) or _is_missing(row["variety"]):
+        return "crop", f"crop {row['crop']} / variety {row['variety']} is not mapped"
+    try:
+        crop_params = get_crop_params(wofost_data_path, row["crop"], row["variety"])
+    except Exception as e:
+        return "crop", f"{type(e).__name__}: {e}"
+    try:
+        soil_params = get_soil_params(wofost_data_path, row["soil"])
+    except Exception as e:
+        return "soil", f"{type(e).__name__}: {e}"
+    try:
+        weatherdata = get_weather(wofost_data_path, row["id"], row["crop_end_date"].year)
+    except Exception as e:
+        return "weather", f"{type(e).__name__}: {e}"
+    reason = check_weather(weatherdata, row)
+    if reason is not None:
+        return "weather", reason
+    if not baseline:
+        return None, None
+    try:
+        parameters = ParameterProvider(cropdata=crop_params,
+                                       soildata=soil_params,
+                                       sitedata=WOFOST73SiteDataProvider(WAV=100, CO2=410.0))
+        crop_cycle, _ = run_wofost(parameters, weatherdata, get_agromanagement(row),
+                                   row["crop_end_date"].date(), summary_vars=(target,))
+    except Exception as e:
+        return "baseline", f"{type(e).__name__}: {e}"
+    if _is_missing(crop_cycle[target]):
+        return "baseline", f"the baseline run gives no {target}"
+    return None, None
+
+
+def _check_block(rows, wofost_data_path, baseline, target):
+    disable_logging()
+    return [check_row(row, wofost_data_path, baseline, target) for row in rows]
+
+
+def preflight(simulations, wofost_data_path="wofost_data/", baseline=True, target="TWSO", require=(),
+              n_jobs=-1, chunk_size=64):
+    """
+    Check every simulation row in parallel.
+    The identical rows are checked once. A row that passes the checks but misses one of the require columns
+    (e.g. ("RealizedYield",) for a calibration) is quarantined too.
+    Parameters
+    ----------
+    simulations: list of dict
+        The simulation rows (sims_setup records).
+    baseline: bool
+        Also run each row once with the default parameters (the slowest check).
+    Returns
+    -------
+    valid: list of dict
+        The rows that passed every check, in their order
+    quarantine: pd.DataFrame
+        One line per rejected row: its position in simulations, id, the failed check and the reason
+    """
+    keys = [tuple(str(row[name]) for name in CHECKED_KEYS) for row in simulations]
+    distinct = list(dict.fromkeys(keys))
+    first_row = {}
+    for row, key in zip(simulations, keys):
+        first_row.setdefault(key, row)
+    rows = [first_row[key] for key in distinct]
+    blocks = [rows[i:i + chunk_size] for i in range(0, len(rows), chunk_size)]
+    checked = Parallel(n_jobs=n_jobs)(delayed(_check_block)(block, wofost_data_path, baseline, target)
+                                      for block in blocks)
+    outcome = dict(zip(distinct, [result for block in checked for result in block]))
+
+    valid, rejected = [], []
+    for i, (row, key) in enumerate(zip(simulations, keys)):
+        check, reason = outcome[key]
+        if check is None:
+            missing = [name for name in require if _is_missing(row.get(name))]
+            if missing:
+                check, reason = "required", f"{', '.join(missing)} is missing"
+        if check is None:
+            valid.append(row)
+        else:
+            rejected.append({"row": i, "id": row["id"], "check": check, "reason": reason})
+    quarantine = pd.DataFrame(rejected, columns=["row", "id", "check", "reason"])
+    return valid, quarantine
+
+
+def print_preflight_report(valid, quarantine):
+    print(f"Pre-flight: {len(valid)} of {len(valid) + len(quarantine)} rows can be simulated, "
+          f"{len(quarantine)} quarantined")
+    if len(quarantine) > 0:
+        print(quarantine["check"].value_counts().to_string())
@@ -0,0 +1,161 @@
+"""
+Global task scheduler for the (plot x parameter set) evaluations of a run.
+Every submitted batch is cut into chunks that go into one FIFO work queue shared by all plots,
+and at most max_in_flight chunks are running or waiting in the process pool at any time.
+Whatever the number of plots or the size of the populations, the workers always have the next chunk ready.
+It exposes the same submit/simulate/evaluate interface as PlotAffinePool.
+"""
+import os
+import gc
+import queue
+import threading
+import time
+import numpy as np
+from concurrent.futures import Future, ProcessPoolExecutor
+from wof_tools.wofost_exec import wof_batch_simulation, disable_logging
+from wof_tools.batch_wofost import wof_vectorized_simulation
+from wof_tools.wof_ea_interface import compute_fitness
+from wof_tools.sims_table import SimsTable, unit_id
+from wof_tools.instrumentation import get_recorder, phase
+
+_worker_state = {}
+
+
+def _init_worker(table, problem, wofost_data_path, target, vectorized):
+    disable_logging()
+    _worker_state.update(table=table, problem=problem, wofost_data_path=wofost_data_path, target=target,
+                         simulate=wof_vectorized_simulation if vectorized else wof_batch_simulation)
+
+
+def _run_chunk(position, paramsets):
+    with phase(get_recorder(), "task"):
+        return _worker_state["simulate"](_worker_state["table"].row(position),
+                                         paramsets,
+                                         _worker_state["problem"],
+                                         wofost_data_path=_worker_state["wofost_data_path"],
+                                         target=_worker_state["target"])
+
+
+class _Batch:
+    """
+    Gathers the chunks of one submitted batch and resolves its future when the last one is done.
+    """
+    def __init__(self, n_chunks):
+        self.future = Future()
+        self.parts = [None] * n_chunks
+        self.remaining = n_chunks
+        self.lock = threading.Lock()
+
+    def chunk_done(self, i, chunk_future):
+        # The chunks complete in several threads: the check and the resolution of the future must not interleave,
+        # or two failing chunks would both try to set its exception
+        with self.lock:
+            if self.future.done():
+                return
+            if chunk_future.exception() is not None:
+                self.future.set_exception(chunk_future.exception())
+                return
+            self.parts[i] = chunk_future.result()
+            self.remaining -= 1
+            if self.remaining == 0:
+                self.future.set_result(np.concatenate(self.parts))
+
+
+class TaskScheduler:
+    """
+    Parameters
+    ----------
+    simulations: list of dict
+        The simulation rows (sims_setup records or a SimsTable), sent once to every worker as a SimsTable.
+        The tasks only carry the position of their row. A row is addressed by its unit_id (plot and harvest year),
+        rows sharing one must be the same simulation (e.g. the units of a SimulationPlan).
+    problem: dict
+        Problem dictionary whose names are overridden with each parameter set.
+    n_workers: int
+        Number of worker processes (default: all cores).
+    chunk_size: int
+        Number of parameter sets of the same plot run by a worker in one task
+        (default: 8, or the whole batch with the vectorized engine).
+    max_in_flight: int
+        Maximum number of chunks handed to the process pool (default: 2 per worker).
+    target: str
+        Summary variable to return instead of the crop-specific yield (see wof_one_simulation).
+    vectorized: bool
+        Run each chunk with the batched engine (batch_wofost.py) in one call instead of one pcse run per
+        parameter set.
+    """
+    def __init__(self, simulations, problem, n_workers=None, chunk_size=None, max_in_flight=None,
+                 wofost_data_path="wofost_data/", target=None, vectorized=False):
+        self.n_workers = n_workers or os.cpu_count()
+        self.vectorized = vectorized
+        self.chunk_size = chunk_size or (None if vectorized else 8)
+        table = SimsTable.from_records(simulations)
+        self.rows = {}
+        self.positions = {}
+        for i, row in enumerate(table.records()):
+            self.rows[unit_id(row)] = row
+            self.positions[unit_id(row)] = i
+        self._slots = threading.Semaphore(max_in_flight or 2 * self.n_workers)
+        self._queue = queue.Queue()
+        # The workers are forked: the garbage of an earlier pool (executor, queues) is collected here first, a worker
+        # collecting it would run its finalizers on locks copied in whatever state they had at the fork and hang
+        gc.collect()
+        self._executor = ProcessPoolExecutor(max_workers=self.n_workers,
+                                             initializer=_init_worker,
+                                             initargs=(table, problem, wofost_data_path, target, vectorized))
+        self._dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self._dispatcher.start()
+
+    def _dispatch(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch, i, unit, chunk = item
+            self._slots.acquire()
+            chunk_future = self._executor.submit(_run_chunk, self.positions[unit], chunk)
+            chunk_future.add_done_callback(lambda f, batch=batch, i=i, t0=time.perf_counter(): self._chunk_done(batch, i, f, t0))
+
+    def _chunk_done(self, batch, i, chunk_future, t0):
+        self._slots.release()
+        recorder = get_recorder()
+        if recorder is not None:
+            recorder.add_time("task_roundtrip", time.perf_counter() - t0)
+        batch.chunk_done(i, chunk_future)
+
+    def submit(self, unit, paramsets):
+        """
+        Queue a batch of parameter sets for a row, given its unit_id. The future resolves to the array of simulated
+        yields.
+        """
+        if unit not in self.rows:
+            raise KeyError(f"Plot season {unit} was not given to the scheduler.")
+        paramsets = np.asarray(paramsets, dtype=float)
+        chunk_size = self.chunk_size or max(len(paramsets), 1)
+        starts = range(0, len(paramsets), chunk_size)
+        batch = _Batch(len(starts))
+        if len(starts) == 0:
+            batch.future.set_result(np.array([], dtype=float))
+        for i, start in enumerate(starts):
+            self._queue.put((batch, i, unit, paramsets[start:start+chunk_size]))
+        return batch.future
+
+    def simulate(self, unit, paramsets):
+        return self.submit(unit, paramsets).result()
+
+    def evaluate(self, unit, paramsets):
+        """
+        Simulate a population for a row and return its fitness array.
+        """
+        return compute_fitness(self.rows[unit]["RealizedYield"], self.simulate(unit, paramsets))
+
+    def close(self):
+        self._queue.put(None)
+        self._dispatcher.join()
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
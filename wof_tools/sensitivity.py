@@ -0,0 +1,290 @@
+"""
+Execution engine of the sensitivity studies (sobol.py, FAST.py).
+A study lives in one directory: the sample matrix is written once (paramsets.npy) and every worker maps it read-only,
+the model outputs go straight into a preallocated memory-mapped (plots x samples) array (outputs.npy), and a mask of
+the simulated entries (done.npy) lets an interrupted study resume where it stopped.
+Tasks are (plot, chunk of samples) pairs, so that a few slow plots do not leave the other workers idle.
+"""
+import os
+import gc
+import json
+import time
+import numpy as np
+import pandas as pd
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from joblib import Parallel, delayed
+from scipy.stats import norm
+from tqdm import tqdm
+from wof_tools.wofost_exec import wof_batch_simulation, disable_logging
+from wof_tools.batch_wofost import wof_vectorized_simulation
+from wof_tools.sims_table import SimsTable, unit_id
+from wof_tools.instrumentation import get_recorder, phase
+
+_worker_state = {}
+
+
+def _init_worker(study_path, table, problem, wofost_data_path, target, vectorized):
+    disable_logging()
+    _worker_state.update(table=table, problem=problem, wofost_data_path=wofost_data_path, target=target,
+                         simulate=wof_vectorized_simulation if vectorized else wof_batch_simulation,
+                         paramsets=np.load(os.path.join(study_path, "paramsets.npy"), mmap_mode="r"),
+                         outputs=np.load(os.path.join(study_path, "outputs.npy"), mmap_mode="r+"))
+
+
+def _run_task(plot_idx, sample_idx):
+    with phase(get_recorder(), "task"):
+        paramsets = np.asarray(_worker_state["paramsets"][sample_idx])
+        y = _worker_state["simulate"](_worker_state["table"].row(plot_idx),
+                                      paramsets,
+                                      _worker_state["problem"],
+                                      wofost_data_path=_worker_state["wofost_data_path"],
+                                      target=_worker_state["target"])
+        outputs = _worker_state["outputs"]
+        outputs[plot_idx, sample_idx] = np.asarray(y, dtype=float)
+        outputs.flush()
+    return len(sample_idx)
+
+
+class SampleStudy:
+    """
+    Parameters
+    ----------
+    path: str
+        Directory of the study. If it already holds a study, its sample and outputs are reused (the plots must be the
+        same), otherwise it is created from paramsets.
+    simulations: list of dict
+        The simulation rows (sims_setup records), one row of the outputs per plot in this order.
+    problem: dict
+        Problem dictionary whose names are overridden with each parameter set.
+    paramsets: np.array
+        (n_samples, n_vars) sample matrix. Ignored when the study already exists.
+    """
+    def __init__(self, path, simulations, problem, paramsets=None):
+        self.path = path
+        self.simulations = simulations
+        self.problem = problem
+        os.makedirs(path, exist_ok=True)
+        units = [unit_id(row) for row in simulations]
+        info_path = os.path.join(path, "study.json")
+        if os.path.exists(info_path):
+            with open(info_path) as f:
+                info = json.load(f)
+            if info["units"] != units:
+                raise ValueError(f"The study in {path} was created for other plots.")
+            print(f"Resuming the study in {path}")
+        else:
+            if paramsets is None:
+                raise ValueError(f"No study in {path} and no sample to create one.")
+            paramsets = np.asarray(paramsets, dtype=float)
+            np.save(os.path.join(path, "paramsets.npy"), paramsets)
+            outputs = np.lib.format.open_memmap(os.path.join(path, "outputs.npy"), mode="w+", dtype=np.float64,
+                                                shape=(len(simulations), len(paramsets)))
+            outputs[:] = np.nan
+            outputs.flush()
+            np.save(os.path.join(path, "done.npy"), np.zeros((len(simulations), len(paramsets)), dtype=bool))
+            # Written last: a study without it is incomplete and is created again
+            with open(info_path, "w") as f:
+                json.dump({"units": units, "names": problem["names"]}, f)
+        self.paramsets = np.load(os.path.join(path, "paramsets.npy"), mmap_mode="r")
+        self.done = np.load(os.path.join(path, "done.npy"), mmap_mode="r+")
+
+    @property
+    def n_samples(self):
+        return len(self.paramsets)
+
+    def outputs(self, stop=None):
+        """
+        Read-only view of the (plots x samples) outputs, restricted to the first stop samples.
+        """
+        return np.load(os.path.join(self.path, "outputs.npy"), mmap_mode="r")[:, :stop]
+
+    def tasks(self, stop=None, chunk_size=256, plots=None):
+        """
+        The (plot index, sample indices) pairs still to simulate among the first stop samples (of the given plot indices).
+        """
+        tasks = []
+        for plot_idx in (range(len(self.simulations)) if plots is None else plots):
+            todo = np.flatnonzero(~self.done[plot_idx, :stop])
+            tasks.extend((plot_idx, todo[start:start+chunk_size]) for start in range(0, len(todo), chunk_size))
+        return tasks
+
+    def run(self, stop=None, n_workers=None, chunk_size=256, wofost_data_path="wofost_data/", target="TWSO",
+            vectorized=True, plots=None):
+        """
+        Simulate every (plot, sample) among the first stop samples that is not done yet (only the given plot indices
+        if plots is not None).
+        Returns the number of simulations run.
+        """
+        tasks = self.tasks(stop, chunk_size, plots)
+        if len(tasks) == 0:
+            return 0
+        # The workers get the rows as one table, the tasks only carry (plot index, sample indices)
+        table = SimsTable.from_records(self.simulations)
+        n_simulated = 0
+        recorder = get_recorder()
+        # The adaptive loop starts a pool per step: the garbage of the previous one is collected before forking
+        # (see TaskScheduler)
+        gc.collect()
+        with ProcessPoolExecutor(max_workers=n_workers or os.cpu_count(),
+                                 initializer=_init_worker,
+                                 initargs=(self.path, table, self.problem, wofost_data_path, target, vectorized)) as executor:
+            futures = {executor.submit(_run_task, plot_idx, sample_idx): (plot_idx, sample_idx, time.perf_counter())
+                       for plot_idx, sample_idx in tasks}
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Parallel process track..."):
+                plot_idx, sample_idx, t0 = futures[future]
+                if recorder is not None:
+                    recorder.add_time("task_roundtrip", time.perf_counter() - t0)
+                n_simulated += future.result()
+                # The worker has flushed its outputs: the chunk can be marked as done
+                self.done[plot_idx, sample_idx] = True
+                self.done.flush()
+        return n_simulated
+
+
+def sobol_indices(Y, D, calc_second_order=True, num_resamples=100, conf_level=0.95, seed=None):
+    """
+    Sobol indices of one output vector, same estimators as SALib.analyze.sobol.analyze, but the bootstrap of
+    every parameter is computed at once. With the same seed, the results are the same as SALib's.
+    Returns
+    -------
+    dict with S1, S1_conf, ST, ST_conf (and S2, S2_conf as (D, D) arrays, NaN below the diagonal)
+    """
+    step = 2 * D + 2 if calc_second_order else D + 2
+    if Y.size % step != 0:
+        raise RuntimeError("Incorrect number of samples in model output file.")
+    N = Y.size // step
+    rng = np.random.default_rng(seed).integers if seed else np.random.randint
+    Y = (Y - Y.mean()) / Y.std()
+    Y = Y.reshape(N, step)
+    A, B, AB = Y[:, 0], Y[:, -1], Y[:, 1:D+1]
+    BA = Y[:, D+1:2*D+1] if calc_second_order else None
+    r = rng(N, size=(N, num_resamples))
+    Z = norm.ppf(0.5 + conf_level / 2)
+    eps = np.finfo(float).eps
+
+    def normalized(numerator, var):
+        return np.divide(numerator, var, out=np.zeros_like(numerator), where=var > eps)
+
+    # Point estimates (constant outputs give 0 like SALib)
+    constant = np.ptp(np.r_[A, B]) <= eps
+    y_var = np.var(np.r_[A, B])
+    S1 = normalized(np.mean(B[:, None] * (AB - A[:, None]), axis=0), np.full(D, y_var))
+    ST = normalized(0.5 * np.mean((A[:, None] - AB) ** 2, axis=0), np.full(D, y_var))
+    if constant:
+        S1, ST = np.zeros(D), np.zeros(D)
+
+    # Bootstrap: (N, resamples) for A and B, (N, resamples, D) for AB
+    Ar, Br, ABr = A[r], B[r], AB[r]
+    r_var = np.var(np.concatenate([Ar, Br]), axis=0)[:, None]
+    r_constant = np.ptp(np.concatenate([Ar, Br])) <= eps
+    S1_r = normalized(np.mean(Br[:, :, None] * (ABr - Ar[:, :, None]), axis=0), np.broadcast_to(r_var, (num_resamples, D)))
+    ST_r = normalized(0.5 * np.mean((Ar[:, :, None] - ABr) ** 2, axis=0), np.broadcast_to(r_var, (num_resamples, D)))
+    S = {"S1": S1, "S1_conf": np.zeros(D) if r_constant else Z * S1_r.std(axis=0, ddof=1),
+         "ST": ST, "ST_conf": np.zeros(D) if r_constant else Z * ST_r.std(axis=0, ddof=1)}
+
+    if calc_second_order:
+        S["S2"] = np.full((D, D), np.nan)
+        S["S2_conf"] = np.full((D, D), np.nan)
+        AB_r = A[r] * B[r]
+        for j in range(D - 1):
+            k = np.arange(j + 1, D)
+            # Vjk - Sj - Sk, one row of the matrix at a time to bound the size of the resampled arrays
+            Vjk = normalized(np.mean(BA[:, [j]] * AB[:, k] - (A * B)[:, None], axis=0), np.full(len(k), y_var))
+            S["S2"][j, k] = 0.0 if constant else Vjk - S1[j] - S1[k]
+            Vjk_r = normalized(np.mean(BA[r, j][:, :, None] * ABr[:, :, k] - AB_r[:, :, None], axis=0),
+                               np.broadcast_to(r_var, (num_resamples, len(k))))
+            S2_r = Vjk_r - S1_r[:, [j]] - S1_r[:, k]
+            S["S2_conf"][j, k] = 0.0 if r_constant else Z * S2_r.std(axis=0, ddof=1)
+    return S
+
+
+def _analyze_block(outputs_path, plot_idxs, stop, analyze):
+    outputs = np.load(outputs_path, mmap_mode="r")
+    return [analyze(np.asarray(outputs[plot_idx, :stop])) for plot_idx in plot_idxs]
+
+
+def analyze_study(study, analyze, stop=None, n_jobs=-1, plots=None):
+    """
+    Apply analyze (a picklable function of the output vector of one plot) to every plot of a study (or to the given
+    plot indices), on its first stop samples, in parallel over blocks of plots read from the outputs array.
+    Returns the list of the results of each plot.
+    """
+    plots = np.arange(len(study.simulations)) if plots is None else np.asarray(plots)
+    blocks = np.array_split(plots, max(1, min(len(plots), os.cpu_count())))
+    results = Parallel(n_jobs=n_jobs)(
+        delayed(_analyze_block)(os.path.join(study.path, "outputs.npy"), block, stop, analyze)
+        for block in blocks if len(block) > 0)
+    return [result for block in results for result in block]
+
+
+def analyze_sobol(study, calc_second_order=True, stop=None, n_jobs=-1, num_resamples=100, conf_level=0.95, seed=None,
+                  plots=None):
+    """
+    Sobol indices of every plot of a study (on its first stop samples), see sobol_indices.
+    """
+    return analyze_study(study, partial(sobol_indices, D=study.problem["num_vars"], calc_second_order=calc_second_order,
+                                        num_resamples=num_resamples, conf_level=conf_level, seed=seed),
+                         stop=stop, n_jobs=n_jobs, plots=plots)
+
+
+def adaptive_sobol(study, n_start=32, tol=0.05, budget=None, calc_second_order=True, seed=None, **run_kwargs):
+    """
+    Sobol indices with a base sample size N grown plot by plot until they have converged.
+    N starts at n_start and is doubled at each step: only the new rows of the sample are simulated, every simulation
+    already done is reused. After each step the plots whose S1 and ST confidence intervals (the *_conf half widths)
+    are all below tol are settled and are not simulated any further. The loop stops when every plot is settled, when
+    the sample of the study is exhausted, or when the next step would exceed the budget (total number of simulations
+    of the study).
+    The study must hold a seeded Sobol sample (SALib.sample.sobol) of a power of two N: the sample of size N/2, N/4...
+    with the same seed is its first rows.
+    Parameters
+    ----------
+    run_kwargs:
+        Passed to SampleStudy.run (n_workers, chunk_size, target...)
+    Returns
+    -------
+    results: list of dict
+        Indices of each plot at its last N
+    n_used: np.array
+        The base sample size N of each plot
+    log: pd.DataFrame
+        One row per step, also written to convergence.csv in the study directory
+    """
+    D = study.problem["num_vars"]
+    step = 2 * D + 2 if calc_second_order else D + 2
+    n_max = study.n_samples // step
+    results = [None] * len(study.simulations)
+    n_used = np.zeros(len(study.simulations), dtype=int)
+    active = np.arange(len(study.simulations))
+    log = []
+    N = n_start
+    while len(active) > 0 and N <= n_max:
+        stop = N * step
+        needed = int((~study.done[active, :stop]).sum())
+        if budget is not None and study.done.sum() + needed > budget:
+            print(f"N={N}: the {needed} simulations of this step would exceed the budget of {budget}, stopping.")
+            break
+        n_simulated = study.run(stop=stop, plots=active, **run_kwargs)
+        step_results = analyze_sobol(study, calc_second_order=calc_second_order, stop=stop, seed=seed, plots=active)
+        width = np.array([max(np.max(S["S1_conf"]), np.max(S["ST_conf"])) for S in step_results])
+        for plot_idx, S in zip(active, step_results):
+            results[plot_idx] = S
+            n_used[plot_idx] = N
+        # Failed simulations give meaningless indices (0 with a 0 interval, like SALib), these plots are dropped
+        failed = np.isnan(study.outputs(stop)[active]).any(axis=1)
+        settled = ~failed & (width < tol)
+        log.append({"N": N, "active_plots": len(active), "simulated": n_simulated,
+                    "total_simulations": int(study.done.sum()), "settled": int(settled.sum()),
+                    "failed": int(failed.sum()),
+                    "max_conf": float(np.max(width[~failed])) if not failed.all() else np.nan,
+                    "median_conf": float(np.median(width[~failed])) if not failed.all() else np.nan})
+        print(", ".join(f"{key}={value:.4g}" if isinstance(value, float) else f"{key}={value}"
+                        for key, value in log[-1].items()))
+        active = active[~settled & ~failed]
+        N *= 2
+    if len(active) > 0:
+        print(f"{len(active)} plots did not reach the tolerance {tol}.")
+    log = pd.DataFrame(log)
+    log.to_csv(os.path.join(study.path, "convergence.csv"), index=False)
+    return results, n_used, log
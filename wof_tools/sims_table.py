@@ -0,0 +1,113 @@
+"""
+The simulations table as a typed parquet file (src/sims_setup.parquet) instead of a pickled DataFrame.
+crop, variety, soil, site and real_crop are dictionary encoded (categorical in pandas), the dates are timestamps and
+the harvest year is stored as a column, so that the entry points read only the rows they need (by id, crop or year)
+with the filters pushed down to the parquet reader.
+In memory, SimsTable keeps the rows as columns: it is what the worker processes receive, the tasks then only carry the
+position of their row.
+"""
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+SIMS_TABLE_PATH = "src/sims_setup.parquet"
+PLOTS_COORDS_PATH = "src/raw_data/COORDS_pro_parcelles_02.06.2025.parquet" #TODO: Attention this path is dynamic.
+CATEGORICAL_COLUMNS = ["crop", "variety", "soil", "site", "real_crop"]
+
+
+def typed_sims_df(sims):
+    """
+    The simulations DataFrame with the columns types of the table (categorical columns, harvest year).
+    """
+    sims = sims.reset_index(drop=True)
+    sims = sims.astype({col: "category" for col in CATEGORICAL_COLUMNS if col in sims.columns})
+    sims["year"] = sims["crop_end_date"].dt.year.astype("Int32")
+    return sims
+
+
+def write_sims_table(sims, path=SIMS_TABLE_PATH, row_group_size=65_536):
+    """
+    Write the simulations DataFrame, sorted by harvest year and crop so that the row groups of a filtered read
+    can be skipped from their statistics.
+    """
+    sims = typed_sims_df(sims).sort_values(["year", "crop", "id"], kind="stable")
+    table = pa.Table.from_pandas(sims, preserve_index=False)
+    pq.write_table(table, path, row_group_size=row_group_size)
+    return len(sims)
+
+
+def read_sims_table(path=SIMS_TABLE_PATH, ids=None, crops=None, years=None, columns=None, limit=None):
+    """
+    Read the rows of the simulations table matching every given filter.
+    Parameters
+    ----------
+    ids, crops, years: list
+        Keep only these plot ids, crops or harvest years. None for no filter.
+    columns: list of str
+        Columns to read (default: all).
+    limit: int
+        Read at most this number of rows (the first ones in the file order).
+    """
+    dataset = ds.dataset(path, format="parquet")
+    conditions = []
+    if ids is not None:
+        conditions.append(pc.field("id").isin(pa.array(list(ids)).cast(dataset.schema.field("id").type)))
+    if crops is not None:
+        conditions.append(pc.field("crop").isin(list(crops)))
+    if years is not None:
+        conditions.append(pc.field("year").isin([int(year) for year in years]))
+    filter = None
+    for condition in conditions:
+        filter = condition if filter is None else filter & condition
+    if limit is not None:
+        table = dataset.head(limit, columns=columns, filter=filter)
+    else:
+        table = dataset.to_table(columns=columns, filter=filter)
+    return table.to_pandas()
+
+
+def unit_id(row):
+    """
+    Key of a simulation row in the worker pools and the checkpoint stores: "<plot id>_<harvest year>".
+    A plot has one row per season, its id alone would merge them.
+    """
+    year = "NaT" if pd.isna(row["crop_end_date"]) else row["crop_end_date"].year
+    return f"{row['id']}_{year}"
+
+
+class SimsTable:
+    """
+    Columnar container of the simulation rows, addressed by position.
+    A table of every plot pickles into a few arrays (categorical codes, datetime64...) instead of one dict per row,
+    so it is cheap to send to the workers. The dict of a row (the same as a to_dict(orient="records") record)
+    is built the first time the row is used.
+    """
+    def __init__(self, df):
+        self.df = df.reset_index(drop=True)
+        self._rows = {}
+
+    @classmethod
+    def from_records(cls, simulations):
+        if isinstance(simulations, SimsTable):
+            return simulations
+        df = pd.DataFrame(list(simulations))
+        return cls(df.astype({col: "category" for col in CATEGORICAL_COLUMNS if col in df.columns}))
+
+    def __len__(self):
+        return len(self.df)
+
+    def __getstate__(self):
+        return {"df": self.df}
+
+    def __setstate__(self, state):
+        self.__init__(state["df"])
+
+    def row(self, i):
+        if i not in self._rows:
+            self._rows[i] = self.df.iloc[[i]].to_dict(orient="records")[0]
+        return self._rows[i]
+
+    def records(self):
+        return self.df.to_dict(orient="records")
@@ -0,0 +1,160 @@
+"""
+Asynchronous steady-state evolutionary algorithm on the worker pools (TaskScheduler or PlotAffinePool).
+inspyred's EvolutionaryComputation.evolve is generational: the whole offspring is evaluated before the next one is bred,
+so every generation waits for its slowest simulation while the other workers idle. SteadyStateEA keeps up to
+max_in_flight candidates submitted at all times: when a batch of evaluations completes, its individuals enter the
+population through the replacer, and as many new candidates are bred from the current population and submitted.
+The operators are the inspyred ones with their usual signatures, set as attributes like on EvolutionaryComputation
+(selector, variator, replacer, observer, terminator). The replacer is called with the completed individuals as the
+offspring and must keep the size of the population: plus_replacement (an offspring replaces the worst individual if it
+is better), steady_state_replacement (it always does), crowding_replacement...
+"""
+import copy
+from concurrent.futures import wait, FIRST_COMPLETED
+import inspyred
+
+
+def _as_list(operators):
+    return list(operators) if isinstance(operators, (list, tuple)) else [operators]
+
+
+class SteadyStateEA:
+    """
+    Parameters
+    ----------
+    random: random.Random
+        Generator used by every operator.
+    Attributes
+    ----------
+    on_evaluated: callable
+        Called as on_evaluated(candidates, fitness, args) with every completed batch, in the thread running evolve
+        (e.g. to record the evaluations of a surrogate).
+    """
+    def __init__(self, random):
+        self._random = random
+        self.selector = inspyred.ec.selectors.tournament_selection
+        self.variator = [inspyred.ec.variators.uniform_crossover, inspyred.ec.variators.gaussian_mutation]
+        self.replacer = inspyred.ec.replacers.plus_replacement
+        self.observer = inspyred.ec.observers.default_observer
+        self.terminator = inspyred.ec.terminators.evaluation_termination
+        self.on_evaluated = None
+        self.bounder = None
+        self.maximize = True
+        self.population = []
+        self.num_evaluations = 0
+        self.num_generations = 0
+        self._kwargs = {}
+
+    def _breed(self, n):
+        """
+        At least n new candidates bred from the current population, each with its parents.
+        """
+        offspring = []
+        while len(offspring) < n:
+            # The crossovers pair the selected parents, so at least two of them
+            self._kwargs["num_selected"] = max(2, n - len(offspring) + (n - len(offspring)) % 2)
+            parents = self.selector(random=self._random, population=list(self.population), args=self._kwargs)
+            candidates = [copy.deepcopy(parent.candidate) for parent in parents]
+            for variator in _as_list(self.variator):
+                candidates = variator(random=self._random, candidates=candidates, args=self._kwargs)
+            offspring.extend((candidate, parents) for candidate in candidates)
+        return offspring
+
+    def _update(self, individuals, parents):
+        missing = self._kwargs["pop_size"] - len(self.population)
+        # The first evaluations fill the initial population, the next ones go through the replacer
+        self.population.extend(individuals[:missing])
+        if len(individuals) > missing:
+            self.population = self.replacer(random=self._random, population=self.population, parents=parents,
+                                            offspring=individuals[max(missing, 0):], args=self._kwargs)
+
+    def _observe(self):
+        for observer in _as_list(self.observer):
+            observer(population=list(self.population), num_generations=self.num_generations,
+                     num_evaluations=self.num_evaluations, args=self._kwargs)
+
+    def _terminate(self):
+        return any(terminator(population=list(self.population), num_generations=self.num_generations,
+                              num_evaluations=self.num_evaluations, args=self._kwargs)
+                   for terminator in _as_list(self.terminator))
+
+    def evolve(self, generator, submitter, pop_size=100, seeds=None, maximize=True, bounder=None,
+               max_in_flight=16, batch_size=4, **args):
+        """
+        Run the EA and return the final population, best individual first.
+        Parameters
+        ----------
+        generator: callable
+            generator(random, args) -> candidate, as for inspyred.
+        submitter: callable
+            submitter(candidates, args) -> Future of the list of fitness of the candidates. It must not block.
+        max_in_flight: int
+            Number of candidates being evaluated at any time.
+        batch_size: int
+            Number of candidates per submission. The batched engine would simulate each small batch at the cost of a
+            whole population: the pool should run the pcse engine.
+        args:
+            Passed to the operators, as the keyword arguments of EvolutionaryComputation.evolve.
+            With max_evaluations, no more candidates than that are submitted.
+        A generation is counted every pop_size evaluations after the initial population, the observers are called
+        once per generation.
+        """
+        self._kwargs = args
+        self._kwargs["_ec"] = self
+        self._kwargs["pop_size"] = pop_size
+        self.maximize = maximize
+        self.bounder = bounder if bounder is not None else inspyred.ec.Bounder()
+        self.population = []
+        self.num_evaluations = 0
+        self.num_generations = 0
+        budget = args.get("max_evaluations")
+
+        seeds = list(seeds or [])[:pop_size]
+        initial = seeds + [generator(random=self._random, args=self._kwargs) for _ in range(pop_size - len(seeds))]
+        queued = [(candidate, []) for candidate in initial]
+        in_flight = {}
+        n_in_flight = n_submitted = 0
+        stopped = False
+        while True:
+            while not stopped and n_in_flight < max_in_flight and (budget is None or n_submitted < budget):
+                n = min(batch_size, max_in_flight - n_in_flight)
+                if budget is not None:
+                    n = min(n, budget - n_submitted)
+                if len(queued) == 0:
+                    if len(self.population) < 2:
+                        break  # Nothing to breed from until the first evaluations of the initial population are back
+                    queued.extend(self._breed(n))
+                batch, queued = queued[:n], queued[n:]
+                future = submitter([candidate for candidate, _ in batch], self._kwargs)
+                in_flight[future] = batch
+                n_in_flight += len(batch)
+                n_submitted += len(batch)
+            if len(in_flight) == 0:
+                break
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                batch = in_flight.pop(future)
+                n_in_flight -= len(batch)
+                fitness = list(future.result())
+                candidates = [candidate for candidate, _ in batch]
+                if self.on_evaluated is not None:
+                    self.on_evaluated(candidates, fitness, self._kwargs)
+                individuals = []
+                for candidate, value in zip(candidates, fitness):
+                    individual = inspyred.ec.Individual(candidate, maximize=maximize)
+                    individual.fitness = value
+                    individuals.append(individual)
+                parents = list({id(parent): parent for _, batch_parents in batch for parent in batch_parents}.values())
+                was_full = len(self.population) >= pop_size
+                self._update(individuals, parents)
+                self.num_evaluations += len(individuals)
+                if len(self.population) >= pop_size:
+                    generation = (self.num_evaluations - pop_size) // pop_size
+                    if not was_full or generation > self.num_generations:
+                        self.num_generations = generation
+                        self._observe()
+            # The evaluations still running when the EA stops are collected, not wasted
+            if not stopped and self._terminate():
+                stopped = True
+        self.population.sort(reverse=True)
+        return self.population
@@ -0,0 +1,70 @@
+"""
+Surrogate model of the fitness landscape of one plot, used to pre-screen the offspring of the EA.
+Only the candidates with the best predicted fitness are sent to WOFOST.
+"""
+import numpy as np
+from scipy.interpolate import RBFInterpolator
+
+
+class RBFSurrogate:
+    """
+    Radial basis function model fitted incrementally on the evaluated candidates (in gene space).
+    Parameters
+    ----------
+    min_points: int
+        Number of finite evaluations needed before the model is used.
+    refit_after: int
+        Number of new evaluations after which the model is refitted, so that the fit cost is amortized over generations.
+    max_points: int
+        The model is fitted on the most recent max_points evaluations only.
+    smoothing: float
+        RBF smoothing, it also makes the fit robust to (almost) duplicated candidates.
+    """
+    def __init__(self, min_points=20, refit_after=30, max_points=500, kernel="thin_plate_spline", smoothing=1e-3):
+        self.min_points = min_points
+        self.refit_after = refit_after
+        self.max_points = max_points
+        self.kernel = kernel
+        self.smoothing = smoothing
+        self.X = []
+        self.y = []
+        self.n_fits = 0
+        self._model = None
+        self._n_new = 0
+
+    def add(self, candidates, fitness):
+        """
+        Record evaluated candidates. Failed simulations (infinite fitness) are not learned.
+        """
+        for candidate, value in zip(candidates, fitness):
+            if np.isfinite(value):
+                self.X.append(list(candidate))
+                self.y.append(value)
+                self._n_new += 1
+
+    @property
+    def ready(self):
+        return len(self.y) >= self.min_points
+
+    def _fit(self):
+        X = np.array(self.X[-self.max_points:])
+        y = np.array(self.y[-self.max_points:])
+        X, unique_idx = np.unique(X, axis=0, return_index=True)
+        self._model = RBFInterpolator(X, y[unique_idx], kernel=self.kernel, smoothing=self.smoothing)
+        self._n_new = 0
+        self.n_fits += 1
+
+    def predict(self, candidates):
+        if self._model is None or self._n_new >= self.refit_after:
+            self._fit()
+        return self._model(np.atleast_2d(np.asarray(candidates, dtype=float)))
+
+    def screen(self, candidates, fraction):
+        """
+        Return the fraction of candidates with the lowest predicted fitness (all of them while the model is not ready).
+        """
+        if not self.ready or len(candidates) == 0:
+            return candidates
+        n_kept = max(1, int(round(fraction * len(candidates))))
+        order = np.argsort(self.predict(candidates))
+        return [candidates[i] for i in order[:n_kept]]
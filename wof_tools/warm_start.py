@@ -0,0 +1,125 @@
+"""
+Warm start of the calibrations from an archive of the previous ones.
+The archive holds the best calibrated parameters of every (plot, harvest year) with its crop and fitness. For a new
+plot, seeds returns the parameters of the same plot in earlier years (the most recent first), then the k nearest
+calibrations of other plots with the same crop (one KD-tree per crop over the plot coordinates), best ones first.
+The EA starts its population from them instead of the typical individual of the crop.
+"""
+import os
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+from wof_tools.wof_ea_interface import CALIBRATED_PARAMETERS
+
+ARCHIVE_PATH = "output/warm_start_archive.parquet"
+
+
+def plot_xy(longitude, latitude):
+    """
+    Approximate coordinates in km (equirectangular projection), enough to rank the neighbours of a region.
+    """
+    longitude = np.asarray(longitude, dtype=float)
+    latitude = np.asarray(latitude, dtype=float)
+    return np.column_stack([111.32 * longitude * np.cos(np.radians(latitude)), 110.57 * latitude])
+
+
+class WarmStartArchive:
+    """
+    Parameters
+    ----------
+    coordinates: pd.DataFrame
+        PlotId, Longitude and Latitude of the plots (the plots coordinates file), for the archived plots and the
+        plots to seed.
+    records: pd.DataFrame
+        Archived calibrations: plot_id, year, crop, fitness and one column per parameter of names.
+    names: list of str
+        The calibrated parameters, in the order of the seeds.
+    """
+    def __init__(self, coordinates, records=None, names=CALIBRATED_PARAMETERS):
+        self.names = list(names)
+        coordinates = coordinates.drop_duplicates("PlotId")
+        self.coordinates = dict(zip(coordinates["PlotId"].astype(str),
+                                    zip(coordinates["Longitude"].astype(float), coordinates["Latitude"].astype(float))))
+        self.records = pd.DataFrame(columns=["plot_id", "year", "crop", "fitness"] + self.names)
+        self._trees = None
+        if records is not None:
+            self.add(records)
+
+    @classmethod
+    def load(cls, coordinates, path=ARCHIVE_PATH, names=CALIBRATED_PARAMETERS):
+        """
+        The archive saved at path, an empty one if there is none.
+        """
+        records = pd.read_parquet(path) if os.path.exists(path) else None
+        return cls(coordinates, records, names)
+
+    def save(self, path=ARCHIVE_PATH):
+        self.records.to_parquet(path, index=False)
+
+    def __len__(self):
+        return len(self.records)
+
+    def add(self, records):
+        """
+        Add calibrations (same columns as the records). Only the best one of each (plot, year) is kept.
+        """
+        records = pd.DataFrame(records)[list(self.records.columns)].astype({"plot_id": str, "year": int,
+                                                                           "crop": str, "fitness": float})
+        records = records[np.isfinite(records["fitness"])]
+        df = pd.concat([self.records, records], ignore_index=True) if len(self.records) else records
+        self.records = (df.sort_values("fitness", kind="stable")
+                          .drop_duplicates(["plot_id", "year"])
+                          .reset_index(drop=True))
+        self._trees = None
+
+    def _index(self):
+        """
+        Per crop: the KD-tree of the archived calibrations with known coordinates, their rows and the number of
+        records of each plot.
+        """
+        if self._trees is None:
+            self._trees = {}
+            located = self.records[self.records["plot_id"].isin(self.coordinates.keys())]
+            for crop, df in located.groupby("crop"):
+                lon, lat = np.array([self.coordinates[plot_id] for plot_id in df["plot_id"]]).T
+                self._trees[crop] = (cKDTree(plot_xy(lon, lat)), df.reset_index(drop=True),
+                                     df["plot_id"].value_counts().to_dict())
+        return self._trees
+
+    def seeds(self, plot_id, crop, year, k=5, max_fitness=None):
+        """
+        Parameter sets to start the calibration of a plot from, as an (n_seeds, len(names)) array (possibly empty):
+        the same plot in earlier years, most recent first, then the k nearest calibrations of other plots with the
+        same crop (any year) whose fitness is at most max_fitness, best fitness first.
+        """
+        plot_id = str(plot_id)
+        records = self.records
+        if max_fitness is not None:
+            records = records[records["fitness"] <= max_fitness]
+        history = records[(records["plot_id"] == plot_id) & (records["year"] < year)].sort_values("year",
+                                                                                                   ascending=False)
+        seeds = [history[self.names].to_numpy(dtype=float)]
+        trees = self._index()
+        if crop in trees and plot_id in self.coordinates:
+            tree, located, n_years = trees[crop]
+            # The records of the plot itself (its other years) are at distance 0, they are queried and dropped.
+            # With max_fitness, the nearest records are queried until k of them pass it (or there are none left).
+            n_queried = max(min(len(located), k + n_years.get(plot_id, 0)), 1)
+            while True:
+                _, idxs = tree.query(plot_xy(*self.coordinates[plot_id])[0], k=n_queried)
+                neighbours = located.iloc[np.atleast_1d(idxs)]
+                neighbours = neighbours[neighbours["plot_id"] != plot_id]
+                if max_fitness is not None:
+                    neighbours = neighbours[neighbours["fitness"] <= max_fitness]
+                if len(neighbours) >= k or n_queried == len(located):
+                    break
+                n_queried = min(2 * n_queried, len(located))
+            neighbours = neighbours.head(k).sort_values("fitness", kind="stable")
+            seeds.append(neighbours[self.names].to_numpy(dtype=float))
+        return np.vstack(seeds) if len(seeds) > 1 else seeds[0]
+
+    def seeds_for(self, row, k=5, max_fitness=None):
+        """
+        seeds of a simulation row (sims_setup record).
+        """
+        return self.seeds(row["id"], row["crop"], row["crop_end_date"].year, k, max_fitness)
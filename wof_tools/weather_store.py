@@ -0,0 +1,149 @@
+"""
+Binary weather store: one Arrow IPC file per campaign year holding the daily weather of every plot.
+The rows are sorted by plot and day, the variables are float64 columns and the position of each plot
+is kept in the file metadata, so a plot's weather is a zero-copy slice of the memory-mapped file.
+float64 keeps the exact values of the CSV files, so that both weather sources give the same simulations.
+The values are stored in the same units as the PCSE CSV files (kJ/m2, mm, kPa).
+"""
+import json
+import datetime as dt
+import numpy as np
+import pyarrow as pa
+from pcse.base import WeatherDataContainer, WeatherDataProvider
+from pcse.exceptions import WeatherDataProviderError
+from pcse.util import reference_ET, check_angstromAB
+
+WEATHER_VARIABLES = ["TMAX", "TMIN", "TEMP", "IRRAD", "RAIN", "WIND", "VAP"]
+EPOCH = dt.date(1970, 1, 1)
+
+
+def tdew_to_kpa_array(tdew):
+    """
+    Vapour pressure (kPa) from the dew point temperature (°C).
+    Vectorized version of pcse.util.ea_from_tdew, with the same validity range.
+    """
+    tdew = np.asarray(tdew, dtype=np.float64)
+    invalid = (tdew < -95.0) | (tdew > 65.0)
+    if invalid.any():
+        raise ValueError(f'tdew={tdew[invalid][0]} is not in range -95 to +60 deg C')
+    return 0.6108 * np.exp((17.27 * tdew) / (tdew + 237.3))
+
+
+def weather_store_path(wofost_data_path, year):
+    return f"{wofost_data_path}meteo_store/weather_{year}.arrow"
+
+
+def write_weather_store(df, output_path, elevation=30):
+    """
+    Write a campaign year of daily weather to a columnar store file.
+    Parameters
+    ----------
+    df: pd.DataFrame
+        Columns PlotId, DAY (datetime), Longitude, Latitude and the WEATHER_VARIABLES in PCSE CSV units.
+    output_path: str
+        Path of the .arrow file.
+    elevation: float
+        Elevation written for every plot (the CSV files use the same constant).
+    """
+    df = df.sort_values(["PlotId", "DAY"], kind="stable").reset_index(drop=True)
+    plot_ids, starts, counts = np.unique(df["PlotId"].to_numpy(), return_index=True, return_counts=True)
+    lon = df["Longitude"].to_numpy()[starts]
+    lat = df["Latitude"].to_numpy()[starts]
+    index = {str(plot_id): [int(start), int(count), float(lo), float(la), float(elevation)]
+             for plot_id, start, count, lo, la in zip(plot_ids, starts, counts, lon, lat)}
+
+    days = (df["DAY"].dt.normalize() - np.datetime64("1970-01-01")).dt.days.to_numpy(dtype=np.int32)
+    columns = {"DAY": pa.array(days, type=pa.int32())}
+    for var in WEATHER_VARIABLES:
+        columns[var] = pa.array(df[var].to_numpy(dtype=np.float64), type=pa.float64())
+    table = pa.table(columns)
+    table = table.replace_schema_metadata({"plot_index": json.dumps(index)})
+    # No compression: the file must stay memory-mappable.
+    with pa.OSFile(output_path, "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+
+class WeatherStore:
+    """
+    A memory-mapped view over one store file. Opening it only reads the footer and the plot index.
+    """
+    def __init__(self, store_path):
+        self.store_path = store_path
+        self._source = pa.memory_map(store_path, "r")
+        self.table = pa.ipc.open_file(self._source).read_all()
+        self.plot_index = json.loads(self.table.schema.metadata[b"plot_index"])
+
+    def __contains__(self, plot_id):
+        return str(plot_id) in self.plot_index
+
+    def plot_arrays(self, plot_id):
+        """
+        Return the site description and the zero-copy numpy slices of one plot.
+        """
+        if plot_id not in self:
+            raise KeyError(f"Plot {plot_id} not found in {self.store_path}")
+        start, count, lon, lat, elev = self.plot_index[str(plot_id)]
+        arrays = {name: self.table.column(name).slice(start, count).to_numpy()
+                  for name in ["DAY"] + WEATHER_VARIABLES}
+        return {"LON": lon, "LAT": lat, "ELEV": elev}, arrays
+
+
+class StoreWeatherDataProvider(WeatherDataProvider):
+    """
+    WeatherDataProvider serving one plot from a WeatherStore.
+    Nothing is parsed: the daily containers are built from the memory-mapped arrays the first time a day is requested,
+    applying the same unit conversions and reference ET as pcse's CSVWeatherDataProvider.
+    Like the CSV provider, TEMP is not passed to the model, which then uses (TMIN + TMAX)/2.
+    """
+    def __init__(self, weather_store, plot_id, ETmodel="PM", angstA=0.18, angstB=0.55):
+        WeatherDataProvider.__init__(self)
+        site, self._arrays = weather_store.plot_arrays(plot_id)
+        self.longitude = site["LON"]
+        self.latitude = site["LAT"]
+        self.elevation = site["ELEV"]
+        self.angstA, self.angstB = check_angstromAB(angstA, angstB)
+        self.ETmodel = ETmodel
+        self.description = [f"Weather data for plot {plot_id} from {weather_store.store_path}"]
+        self._days = self._arrays["DAY"]
+
+    @property
+    def first_date(self):
+        return EPOCH + dt.timedelta(days=int(self._days[0]))
+
+    @property
+    def last_date(self):
+        return EPOCH + dt.timedelta(days=int(self._days[-1]))
+
+    @property
+    def missing(self):
+        return int(self._days[-1] - self._days[0]) + 1 - len(self._days)
+
+    def _make_WeatherDataContainer(self, keydate):
+        i = np.searchsorted(self._days, (keydate - EPOCH).days)
+        if i == len(self._days) or self._days[i] != (keydate - EPOCH).days:
+            raise WeatherDataProviderError(f"No weather data for {keydate}.")
+        row = {"DAY": keydate,
+               "TMAX": float(self._arrays["TMAX"][i]),
+               "TMIN": float(self._arrays["TMIN"][i]),
+               "IRRAD": float(self._arrays["IRRAD"][i]) * 1000.,  # kJ/m2 -> J/m2
+               "RAIN": float(self._arrays["RAIN"][i]) / 10.,  # mm -> cm
+               "WIND": float(self._arrays["WIND"][i]),
+               "VAP": float(self._arrays["VAP"][i]) * 10.,  # kPa -> hPa
+               }
+        e0, es0, et0 = reference_ET(LAT=self.latitude, ELEV=self.elevation,
+                                    ANGSTA=self.angstA, ANGSTB=self.angstB,
+                                    ETMODEL=self.ETmodel, **row)
+        # mm/day -> cm/day
+        row["E0"] = e0/10.
+        row["ES0"] = es0/10.
+        row["ET0"] = et0/10.
+        return WeatherDataContainer(LAT=self.latitude, LON=self.longitude, ELEV=self.elevation, **row)
+
+    def __call__(self, day, member_id=0):
+        if member_id != 0:
+            raise WeatherDataProviderError(f"Retrieving ensemble weather is not supported by {self.__class__.__name__}")
+        keydate = self.check_keydate(day)
+        if (keydate, 0) not in self.store:
+            self._store_WeatherDataContainer(self._make_WeatherDataContainer(keydate), keydate)
+        return self.store[(keydate, 0)]
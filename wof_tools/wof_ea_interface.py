@@ -1,77 +1,155 @@
 """
 This script has as objective to provide the communication tools between the WOFOST model and the evolutionary algorithm.
-TODO: The first test is going to be to learn better TSUM1 and TSUM2. Then we will add the other parameters.
 """
+import numpy as np
 
-def set_up_problem():
-    """
-    Creates the problem dictionaries for sensitivity analysis.
-    """
-    RANGES_VAR = {
-                  "TSUM1": (100, 2000),
-                  "TSUM2": (100, 2000),
-                #   "SPAN":  (10, 70),
-                #   "CFET": (0.1, 1.0),
-                #   "CVL": (0.1, 1.0),
-                #   "CVO": (0.1, 1.0),
-                #   "CVR": (0.1, 1.0),
-                #   "CVS": (0.1, 1.0),
-                #   "TBASE": (0, 15),
-                #   "TBASEM": (0, 15),
-                #   "VERNBASE": (5, 15),
-                #   "RDI": (9, 11),
-                #   "RDMCR": (60, 300),
-                #   "RGRLAI": (0.001, 0.8),
-                  }
-
-    RANGES_SOIL = {
-                #    "K0": (10, 100),
-                #    "SOPE": (0.2, 15),
-                #    "KSUB": (0.1, 30),
-                #    "RDMSOL": (90, 150),
-                   }
-    
-    problem = {
-        "num_vars": len(RANGES_VAR) + len(RANGES_SOIL),
-        "names": list(RANGES_VAR.keys()) + list(RANGES_SOIL.keys()),
-        "bounds": [list(bounds) for bounds in RANGES_VAR.values()] + [list(bounds) for bounds in RANGES_SOIL.values()]
-        }
- 
-    return problem
-
-class WofostTranslator:
+# Ranges of the parameters screened by the sensitivity analysis (sensitivity_anlaysis/sobol.py), defined only here.
+CROP_PARAMETER_RANGES = {"TSUM1": (100, 2000),
+                         "TSUM2": (100, 2000),
+                         "SPAN":  (10, 70),
+                         "CFET": (0.1, 1.0),
+                         "CVL": (0.1, 1.0),
+                         "CVO": (0.1, 1.0),
+                         "CVR": (0.1, 1.0),
+                         "CVS": (0.1, 1.0),
+                         "TBASE": (0, 15),
+                         "TBASEM": (0, 15),
+                         "VERNBASE": (5, 15),
+                         "RDI": (9, 11),
+                         "RDMCR": (60, 300),
+                         "RGRLAI": (0.001, 0.8),
+                         }
+
+SOIL_PARAMETER_RANGES = {"K0": (10, 100),
+                         "SOPE": (0.2, 15),
+                         "KSUB": (0.1, 30),
+                         "RDMSOL": (90, 150),
+                         # "SMW": (0.01, 0.5),
+                         # "SMFCF": (0.01, 0.6),
+                         # "CRAIRC": (0.01, 0.1),
+                         }
+
+PARAMETER_RANGES = {**CROP_PARAMETER_RANGES, **SOIL_PARAMETER_RANGES}
+
+# TODO: The first test is going to be to learn better TSUM1 and TSUM2. Then we will add the other parameters.
+CALIBRATED_PARAMETERS = ["TSUM1", "TSUM2"]
+
+# Typical values of some parameters per crop, the starting point of a calibration without a warm start.
+# A parameter without a typical value starts from the middle of its range (see ParameterSpace.typical).
+CROP_INITIAL_VALUES = {"wheat": {"TSUM1": 706, "TSUM2": 975},
+                       "barley": {"TSUM1": 800, "TSUM2": 750},
+                       "fababean": {"TSUM1": 833, "TSUM2": 1351},
+                       "maize": {"TSUM1": 600, "TSUM2": 1211},
+                       "sunflower": {"TSUM1": 1050, "TSUM2": 1000},
+                       "sorghum": {"TSUM1": 730, "TSUM2": 600},
+                       "rapeseed": {"TSUM1": 240, "TSUM2": 600},
+                       "millet": {"TSUM1": 772, "TSUM2": 483},
+                       }
+
+
+class ParameterSpace:
     """
-    This class provides methods to translate WOFOST model parameters to genes and vice versa.
+    The calibrated parameters, their bounds and their encoding as genes in [0, 1].
+    Every method works on one parameter set (n_vars,) or on a whole population (n, n_vars) at once.
+    Parameters
+    ----------
+    names: list of str
+        Parameters of the space, in this order (default: all the PARAMETER_RANGES).
+    bounds: dict
+        Bounds replacing the PARAMETER_RANGES of some parameters (needed for a parameter that is not in them).
+    log_scale: list of str
+        Parameters encoded on a log scale (their bounds must be > 0): a gene step is then a relative change.
     """
-    def __init__(self):
-        self.ranges_dic = {"TSUM1": (100, 2000),
-                           "TSUM2": (800, 2000),
-                          }
-        self.ranges = [i for i in self.ranges_dic.values()]
-        
-    def print_available_parameters(self):
+    def __init__(self, names=None, bounds=None, log_scale=()):
+        self.names = list(PARAMETER_RANGES) if names is None else list(names)
+        ranges = {**PARAMETER_RANGES, **(bounds or {})}
+        missing = [name for name in self.names if name not in ranges]
+        if missing:
+            raise ValueError(f"Parameters {missing} have no range.")
+        unknown = [name for name in log_scale if name not in self.names]
+        if unknown:
+            raise ValueError(f"Log scaled parameters {unknown} are not in the space.")
+        self.lower = np.array([ranges[name][0] for name in self.names], dtype=float)
+        self.upper = np.array([ranges[name][1] for name in self.names], dtype=float)
+        self.log = np.array([name in log_scale for name in self.names])
+        if np.any(self.lower[self.log] <= 0):
+            raise ValueError("Log scaled parameters must have positive bounds.")
+        # Encoding bounds: the log of the bounds for the log scaled parameters
+        self._lo, self._hi = self.lower.copy(), self.upper.copy()
+        self._lo[self.log], self._hi[self.log] = np.log(self.lower[self.log]), np.log(self.upper[self.log])
+        for crop, values in CROP_INITIAL_VALUES.items():
+            outside = [name for name, lo, hi in zip(self.names, self.lower, self.upper)
+                       if name in values and not lo <= values[name] <= hi]
+            if outside:
+                raise ValueError(f"Typical values of {outside} for {crop} are out of their ranges.")
+
+    @property
+    def num_vars(self):
+        return len(self.names)
+
+    @property
+    def problem(self):
         """
-        Print the available parameters and their ranges.
+        SALib problem dictionary (the bounds are the parameter bounds, whatever the encoding).
         """
-        print("Available parameters and their ranges:")
-        for parameter, (min_val, max_val) in self.ranges_dic.items():
-            print(f"{parameter}: {min_val} - {max_val}")
-    
-    def get_one_range(self, parameter):
+        return {"num_vars": self.num_vars,
+                "names": list(self.names),
+                "bounds": [[float(lo), float(hi)] for lo, hi in zip(self.lower, self.upper)]}
+
+    def encode(self, values):
         """
-        Get the min and max values of a parameter from the ranges dictionary.
+        Parameter values -> genes in [0, 1].
         """
-        #TODO: In the future we will have to add the other parameters depeding on the results of the sensitivity analysis.
-        if parameter in self.ranges_dic:
-            return self.ranges_dic[parameter]
-        else:
-            raise ValueError(f"Parameter {parameter} not found in ranges.")
+        values = np.array(values, dtype=float)
+        values[..., self.log] = np.log(values[..., self.log])
+        return (values - self._lo) / (self._hi - self._lo)
 
-    def wofost_to_genes(self, wof_values):
-        list_of_genes = [(w_v - min) / (max - min) for w_v, (min, max) in zip(wof_values, self.ranges)]
-        return list_of_genes
+    def decode(self, genes):
+        """
+        Genes in [0, 1] -> parameter values.
+        """
+        values = self._lo + np.asarray(genes, dtype=float) * (self._hi - self._lo)
+        values[..., self.log] = np.exp(values[..., self.log])
+        return values
 
-    def genes_to_wofost(self, gen_values):
-        list_of_wofost = [g_v * (max - min) + min for g_v, (min, max) in zip(gen_values, self.ranges)]
-        return list_of_wofost
+    def sample(self, n, rng=np.random):
+        """
+        n parameter sets drawn uniformly in the gene space (log-uniformly for the log scaled parameters).
+        """
+        return self.decode(rng.random((n, self.num_vars)))
+
+    def typical(self, crop):
+        """
+        Typical parameter set of a crop: its CROP_INITIAL_VALUES, the middle of the gene range for the parameters
+        that have none.
+        """
+        if crop not in CROP_INITIAL_VALUES:
+            raise ValueError(f"Crop {crop} not found in initial values.")
+        middle = self.decode(np.full(self.num_vars, 0.5))
+        return np.array([CROP_INITIAL_VALUES[crop].get(name, default) for name, default in zip(self.names, middle)])
+
+    def overrides(self, values):
+        """
+        The set_override mapping {name: value} of one parameter set, or the list of them for a population.
+        """
+        values = np.asarray(values, dtype=float)
+        if values.ndim == 2:
+            return [dict(zip(self.names, row.tolist())) for row in values]
+        return dict(zip(self.names, values.tolist()))
 
+
+def set_up_problem():
+    """
+    Creates the problem dictionaries for the calibration.
+    """
+    return ParameterSpace(CALIBRATED_PARAMETERS).problem
+
+def compute_fitness(realized_yield, y_pred):
+    """
+    Absolute error between the realized yield and the simulated ones.
+    Failed simulations (None or NaN) get an infinite fitness so that they are never selected.
+    """
+    y_pred = np.array([np.nan if y is None else y for y in np.atleast_1d(y_pred)], dtype=float)
+    fitness = np.abs(realized_yield - y_pred)
+    fitness[np.isnan(fitness)] = np.inf
+    return fitness
@@ -1,16 +1,18 @@
 import os
-import yaml
-import pickle
+import time
+import numpy as np
 import pandas as pd
 import logging
-from pcse.input import YAMLCropDataProvider
-from pcse.input import CABOFileReader
+import datetime as dt
 from pcse.input import WOFOST73SiteDataProvider
-from pcse.input import CSVWeatherDataProvider
 from pcse.base import ParameterProvider
 from pcse.models import Wofost73_WLP_CWB, Wofost73_PP
 from joblib import Parallel, delayed, effective_n_jobs
 from joblib_progress import joblib_progress
+from wof_tools.input_cache import get_agromanagement, get_crop_params, get_soil_params, get_weather
+from wof_tools.memo_store import get_memo_store
+from wof_tools.instrumentation import get_recorder, phase
+from wof_tools.sims_table import read_sims_table
 
 def disable_logging():
     logger = logging.getLogger("pcse")
@@ -21,68 +23,160 @@ def disable_logging():
         handler.close()
 
 
+class LeanWofost73_WLP_CWB(Wofost73_WLP_CWB):
+    """
+    Wofost73_WLP_CWB without the daily output collection, only the summary output is kept.
+    """
+    def _save_output(self, day):
+        self.flag_output = False
+
+
+def run_wofost(parameters, weatherdata, agromanag_params, crop_end_date,
+               summary_vars=("TWSO", "TAGP", "DOH"), daily_output=False):
+    """
+    Run one WOFOST simulation and return the summary of the crop cycle (only summary_vars are collected).
+    In lean mode (default) no daily output is stored and the run stops at the crop end date;
+    with daily_output=True the full model runs and the daily output is returned as a DataFrame too.
+    """
+    recorder = get_recorder()
+    if daily_output:
+        with phase(recorder, "model_init"):
+            wofsim = Wofost73_WLP_CWB(parameters,
+                                      weatherdata,
+                                      agromanag_params,
+                                      summary_vars=tuple(summary_vars))
+        with phase(recorder, "model_run"):
+            wofsim.run_till_terminate()
+        with phase(recorder, "output"):
+            dfPP = pd.DataFrame(wofsim.get_output()).set_index("day")
+    else:
+        with phase(recorder, "model_init"):
+            wofsim = LeanWofost73_WLP_CWB(parameters,
+                                          weatherdata,
+                                          agromanag_params,
+                                          output_vars=(),
+                                          summary_vars=tuple(summary_vars),
+                                          terminal_vars=())
+        with phase(recorder, "model_run"):
+            wofsim.run_till(crop_end_date + dt.timedelta(days=1))
+        dfPP = None
+    with phase(recorder, "output"):
+        crop_cycle = wofsim.get_summary_output()[0]
+    return crop_cycle, dfPP
+
+
 def wof_one_simulation(params_row,
                        wofost_data_path="wofost_data/",
                        output_path="output",
                        # From here only in optimization mode
                        override_params_mode=False,
                        paramset = [],
-                       problem={}):
+                       problem={},
+                       target=None,
+                       # Output control
+                       summary_vars=("TWSO", "TAGP", "DOH"),
+                       daily_output=False):
+    """
+    Without optimization mode the returned value is (id, *summary_vars).
+    In optimization mode the returned value is the crop-specific yield (TAGP for fodder maize, TWSO otherwise),
+    unless a summary variable is given as target.
+    When a memo store is configured, optimization mode results are looked up there before running.
+    daily_output=True is meant for diagnostics: the daily output of the run is written to output_path.
+    With the instrumentation enabled (see instrumentation.py) the time of each phase and the failures are recorded.
+    """
+    recorder = get_recorder()
+    t0 = time.perf_counter()
     os.makedirs(output_path, exist_ok=True)
-    with open("wof_tools/wofost_exec_templates.yaml") as f:
-        templates = yaml.safe_load(f)
-    
-    agro_str = templates["agromanage"].format(
-                 date_campaign=f"{str(params_row['crop_end_date'].year-1)}-01-01",
-                 crop=params_row["crop"],
-                 variety=params_row["variety"],
-                 crop_start= params_row["crop_start_date"].strftime("%Y-%m-%d"),
-                 crop_end=params_row["crop_end_date"].strftime("%Y-%m-%d")
-             )
-
-    agromanag_params = yaml.safe_load(agro_str)
-
+    memo = get_memo_store() if override_params_mode else None
+    if memo is not None:
+        with phase(recorder, "memo_lookup"):
+            paramset = memo.quantize(problem["names"], paramset)
+            memo_key = memo.key(params_row, problem["names"], paramset, target, wofost_data_path)
+            memoized = memo.get(memo_key)
+        if memoized is not None:
+            return memoized
     try:
         disable_logging()
-        crop_params = YAMLCropDataProvider(fpath=f"{wofost_data_path}crops_data")
-        crop_params.set_active_crop(params_row["crop"], params_row["variety"])
-        soil_params = CABOFileReader(f"{wofost_data_path}soils_data/{params_row['soil']}.soil")
+        # Only the overrides change between evaluations, the inputs come from the worker-local cache.
+        with phase(recorder, "agromanagement"):
+            agromanag_params = get_agromanagement(params_row)
+        with phase(recorder, "crop_params"):
+            crop_params = get_crop_params(wofost_data_path, params_row["crop"], params_row["variety"])
+        with phase(recorder, "soil_params"):
+            soil_params = get_soil_params(wofost_data_path, params_row["soil"])
         site_params = WOFOST73SiteDataProvider(WAV=100, CO2=410.0)
-        weatherdata = CSVWeatherDataProvider(f"{wofost_data_path}meteo_data/{params_row['id']}.csv")
+        with phase(recorder, "weather"):
+            weatherdata = get_weather(wofost_data_path, params_row["id"], params_row["crop_end_date"].year)
 
-        parameters = ParameterProvider(cropdata=crop_params,
-                                    soildata=soil_params,
-                                    sitedata=site_params
-                                    )
-        if override_params_mode:
-            for name, value in zip(problem["names"], paramset):
-                parameters.set_override(name, value)
+        with phase(recorder, "parameter_provider"):
+            parameters = ParameterProvider(cropdata=crop_params,
+                                        soildata=soil_params,
+                                        sitedata=site_params
+                                        )
+            if override_params_mode:
+                for name, value in zip(problem["names"], paramset):
+                    parameters.set_override(name, value)
 
-        wofsim = Wofost73_WLP_CWB(parameters,
-                        weatherdata,
-                        agromanag_params)
-        wofsim.run_till_terminate()
-        output = wofsim.get_output()
-        dfPP = pd.DataFrame(output).set_index("day")
-        # dfPP.to_csv(os.path.join(output_path, f"{params_row['id']}.csv")) #To save une file by simulation
-        summary_output = wofsim.get_summary_output()
-        crop_cycle = summary_output[0]
-        # print(params_row["id"], msg.format(**crop_cycle))
         if override_params_mode:
-            return crop_cycle["TAGP"] if params_row["real_crop"] == "Maïs fourrage" else crop_cycle["TWSO"]
+            summary_vars = (target,) if target is not None else ("TWSO", "TAGP")
+        crop_cycle, dfPP = run_wofost(parameters,
+                                      weatherdata,
+                                      agromanag_params,
+                                      params_row["crop_end_date"].date(),
+                                      summary_vars=summary_vars,
+                                      daily_output=daily_output)
+        if daily_output:
+            dfPP.to_csv(os.path.join(output_path, f"{params_row['id']}.csv")) #To save une file by simulation
+        if override_params_mode:
+            if target is not None:
+                y_pred = crop_cycle[target]
+            else:
+                y_pred = crop_cycle["TAGP"] if params_row["real_crop"] == "Maïs fourrage" else crop_cycle["TWSO"]
+            if memo is not None and y_pred is not None:
+                with phase(recorder, "memo_store"):
+                    memo.put(memo_key, y_pred)
+            if recorder is not None:
+                if y_pred is None:
+                    recorder.add_failure("output", f"Missing{target or 'Yield'}")
+                recorder.count(1, int(y_pred is None), time.perf_counter() - t0)
+            return y_pred
         else:
-            return params_row["id"], crop_cycle["TWSO"], crop_cycle["TAGP"], crop_cycle["DOH"]
+            if recorder is not None:
+                recorder.count(1, 0, time.perf_counter() - t0)
+            return (params_row["id"], *[crop_cycle[var] for var in summary_vars])
     except Exception as e:
         print(f"Simulation failed for {params_row['id']}: {e}") #TODO: How to handle errors during optimization?
+        if recorder is not None:
+            recorder.failure(e)
+            recorder.count(1, 1, time.perf_counter() - t0)
         if override_params_mode:
             return None
         else:
-            return params_row["id"], None, None, None
+            return (params_row["id"], *[None for _ in summary_vars])
+
+
+def wof_batch_simulation(params_row,
+                         paramsets,
+                         problem,
+                         wofost_data_path="wofost_data/",
+                         output_path="output",
+                         target=None):
+    """
+    Run one plot once per parameter set (optimization mode) and return the predictions as an array.
+    Failed simulations are NaN.
+    """
+    y_pred = [wof_one_simulation(params_row,
+                                 wofost_data_path=wofost_data_path,
+                                 output_path=output_path,
+                                 override_params_mode=True,
+                                 paramset=paramset,
+                                 problem=problem,
+                                 target=target) for paramset in paramsets]
+    return np.array([np.nan if y is None else y for y in y_pred], dtype=float)
 
 
 if __name__ == "__main__":
-    with open("src/sims_setup_100_obs.pickle", 'rb') as f:
-        sims_data = pickle.load(f)
+    sims_data = read_sims_table(limit=100)
     simulations = sims_data.to_dict(orient="records")
     print(f"Total simulations to run: {len(simulations)}")
     with joblib_progress(description="Running parallel WOFOST simulations...", total=len(simulations)):
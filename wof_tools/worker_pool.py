@@ -0,0 +1,148 @@
+"""
+Long-lived pool of WOFOST workers with plot affinity.
+Every plot is always simulated by the same worker process, so the inputs parsed for that plot stay in the
+worker-local cache (see input_cache.py) for the whole run. The rows and the problem are sent once, when the
+workers start; afterwards only (row position, population) batches go through the queues.
+"""
+import os
+import gc
+import zlib
+import itertools
+import threading
+import time
+import multiprocessing
+import numpy as np
+from concurrent.futures import Future
+from wof_tools.wofost_exec import wof_batch_simulation, disable_logging
+from wof_tools.batch_wofost import wof_vectorized_simulation
+from wof_tools.wof_ea_interface import compute_fitness
+from wof_tools.sims_table import SimsTable, unit_id
+from wof_tools.instrumentation import get_recorder, phase
+
+
+def _worker_loop(tasks, results, table, problem, wofost_data_path, target, vectorized):
+    disable_logging()
+    simulate = wof_vectorized_simulation if vectorized else wof_batch_simulation
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        task_id, position, paramsets = task
+        try:
+            with phase(get_recorder(), "task"):
+                y_pred = simulate(table.row(position), paramsets, problem,
+                                  wofost_data_path=wofost_data_path, target=target)
+            results.put((task_id, y_pred, None))
+        except Exception as e:
+            results.put((task_id, None, f"{type(e).__name__}: {e}"))
+
+
+class PlotAffinePool:
+    """
+    Parameters
+    ----------
+    simulations: list of dict
+        The simulation rows (sims_setup records or a SimsTable). Rows sharing an id are the same plot, all its
+        seasons go to the same worker. A row is addressed by its unit_id (plot and harvest year), rows sharing one
+        must be the same simulation (e.g. the units of a SimulationPlan).
+        Each worker receives the rows of its plots as a SimsTable, the tasks only carry the position of their row.
+    problem: dict
+        Problem dictionary whose names are overridden with each parameter set.
+    n_workers: int
+        Number of worker processes (default: all cores).
+    target: str
+        Summary variable to return instead of the crop-specific yield (see wof_one_simulation).
+    vectorized: bool
+        Simulate each population with the batched engine (batch_wofost.py) in one call.
+    """
+    def __init__(self, simulations, problem, n_workers=None, wofost_data_path="wofost_data/", target=None,
+                 vectorized=False):
+        self.n_workers = n_workers or os.cpu_count()
+        self.vectorized = vectorized
+        table = SimsTable.from_records(simulations)
+        self.rows = {unit_id(row): row for row in table.records()}
+        self._task_ids = itertools.count()
+        self._futures = {}
+        self._lock = threading.Lock()
+
+        # The garbage of an earlier pool is collected before forking (see TaskScheduler)
+        gc.collect()
+        ctx = multiprocessing.get_context()
+        self._results = ctx.Queue()
+        self._tasks = [ctx.Queue() for _ in range(self.n_workers)]
+        # Each worker gets a table of its own plots, a plot is then addressed by its position in that table
+        rows_by_worker = [[] for _ in range(self.n_workers)]
+        self.positions = {}
+        for unit, i in {unit_id(row): i for i, row in enumerate(table.records())}.items():
+            worker_rows = rows_by_worker[self.worker_of(self.rows[unit]["id"])]
+            self.positions[unit] = len(worker_rows)
+            worker_rows.append(i)
+        self._workers = [ctx.Process(target=_worker_loop,
+                                     args=(self._tasks[i], self._results, SimsTable(table.df.iloc[rows_by_worker[i]]), problem, wofost_data_path, target,
+                                           vectorized),
+                                     daemon=True)
+                         for i in range(self.n_workers)]
+        for worker in self._workers:
+            worker.start()
+        self._collector = threading.Thread(target=self._collect, daemon=True)
+        self._collector.start()
+
+    def worker_of(self, plot_id):
+        """
+        Index of the worker owning a plot. Stable across runs (unlike hash() on strings).
+        """
+        return zlib.crc32(str(plot_id).encode()) % self.n_workers
+
+    def _collect(self):
+        while True:
+            message = self._results.get()
+            if message is None:
+                break
+            task_id, y_pred, error = message
+            with self._lock:
+                future, t0 = self._futures.pop(task_id)
+            recorder = get_recorder()
+            if recorder is not None:
+                recorder.add_time("task_roundtrip", time.perf_counter() - t0)
+            if error is None:
+                future.set_result(y_pred)
+            else:
+                future.set_exception(RuntimeError(error))
+
+    def submit(self, unit, paramsets):
+        """
+        Queue a batch of parameter sets for a row, given its unit_id. The future resolves to the array of simulated
+        yields.
+        """
+        if unit not in self.rows:
+            raise KeyError(f"Plot season {unit} was not given to the pool.")
+        task_id = next(self._task_ids)
+        future = Future()
+        with self._lock:
+            self._futures[task_id] = (future, time.perf_counter())
+        self._tasks[self.worker_of(self.rows[unit]["id"])].put((task_id, self.positions[unit],
+                                                               np.asarray(paramsets, dtype=float)))
+        return future
+
+    def simulate(self, unit, paramsets):
+        return self.submit(unit, paramsets).result()
+
+    def evaluate(self, unit, paramsets):
+        """
+        Simulate a population for a row and return its fitness array.
+        """
+        return compute_fitness(self.rows[unit]["RealizedYield"], self.simulate(unit, paramsets))
+
+    def close(self):
+        for tasks in self._tasks:
+            tasks.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._results.put(None)
+        self._collector.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()